@@ -1,42 +1,181 @@
+import base64
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
+import re
 import shutil
+import sqlite3
+import sys
+import threading
+import time
+import types
 import uuid
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 import fitz  # PyMuPDF
 import chromadb
+import httpx
 from dotenv import load_dotenv
-from flask import (Flask, Response, jsonify, render_template, request,
-                   send_from_directory)
+from flask import (Flask, Request, Response, g, jsonify, render_template, request,
+                   send_from_directory, stream_with_context)
 from langchain.chains import RetrievalQA
 # *** UPDATED Chroma Import ***
 from langchain_chroma import Chroma
-from langchain_community.document_loaders import PyMuPDFLoader
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from openai import APIError, OpenAI
+from openai import APIError, DefaultHttpxClient, OpenAI
+
+import context_packer
+import metrics
+import pdf_utils
+import retrieval
+
+if __name__ == '__main__':
+    # `python app.py`: spawned worker processes re-run the __main__ script before taking work, which here would repeat
+    # the whole start-up (AI clients, a second Chroma client on chroma_db/, migrations...). Register this module as
+    # `app` and leave a bare __main__, so PDF parse workers only import what their tasks need (pdf_utils).
+    sys.modules['app'] = sys.modules['__main__']; sys.modules['__main__'] = types.ModuleType('__main__')
 
 # Load environment variables
 load_dotenv()
 
 # --- Logging Configuration ---
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s'
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s - %(levelname)s - [%(threadName)s] [%(trace_id)s] - %(message)s'
 )
 
+class TraceIdFilter(logging.Filter):
+    """Adds the current request / job trace id (see metrics.start_trace) to log records; '-' outside one."""
+    def filter(self, record):
+        trace = metrics.current_trace(); record.trace_id = trace.trace_id if trace else '-'
+        return True
+
+for handler in logging.getLogger().handlers: handler.addFilter(TraceIdFilter())
+logging.getLogger('httpx').setLevel(logging.WARNING) # One INFO line per upstream call; latencies are in /metrics instead
+
 # --- Flask App Configuration ---
+class AppRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Werkzeug spools file parts over 500 KB to a temp file; /transcribe keeps recordings in memory (its
+        # body is capped at TRANSCRIBE_MAX_BYTES before parsing).
+        if self.endpoint == 'transcribe_audio': return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 app = Flask(__name__)
+app.request_class = AppRequest
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['CHROMA_DB_FOLDER'] = 'chroma_db'
 app.config['ALLOWED_EXTENSIONS'] = {'pdf'}
 app.config['TEMP_FOLDER'] = 'temp_audio'
+app.config['CACHE_FOLDER'] = 'cache' # Content-addressed caches; survive /clear_data
+app.config['PAGE_TEXT_FOLDER'] = 'page_texts' # Pre-extracted page texts, one store file per paper
+app.config['PAGE_STORE_POOL_SIZE'] = int(os.getenv('PAGE_STORE_POOL_SIZE', '128')) # Open (memory-mapped) page stores
+app.config['PDF_DOC_POOL_SIZE'] = int(os.getenv('PDF_DOC_POOL_SIZE', '8')) # Open fitz documents for papers without a page store
+# Translation cache
+app.config['TRANSLATION_CACHE_MEMORY_SIZE'] = int(os.getenv('TRANSLATION_CACHE_MEMORY_SIZE', '2048')) # In-memory LRU entries
+app.config['TRANSLATION_CACHE_MAX_ENTRIES'] = int(os.getenv('TRANSLATION_CACHE_MAX_ENTRIES', '100000')) # Persistent entries
+app.config['TRANSLATION_CACHE_TTL_DAYS'] = float(os.getenv('TRANSLATION_CACHE_TTL_DAYS', '30'))
+app.config['TRANSLATION_BATCH_MAX_ITEMS'] = int(os.getenv('TRANSLATION_BATCH_MAX_ITEMS', '32'))
+app.config['TRANSLATION_BATCH_MAX_CHARS'] = int(os.getenv('TRANSLATION_BATCH_MAX_CHARS', '200')) # Longer texts are translated individually
+# Page analysis (server-side rendering + result cache)
+app.config['ANALYZE_PAGE_DPI'] = int(os.getenv('ANALYZE_PAGE_DPI', '110'))
+app.config['ANALYZE_PAGE_JPEG_QUALITY'] = int(os.getenv('ANALYZE_PAGE_JPEG_QUALITY', '75'))
+app.config['ANALYZE_IMAGE_DETAIL'] = os.getenv('ANALYZE_IMAGE_DETAIL', 'auto') # 'low' / 'high' / 'auto'
+app.config['ANALYZE_MAX_IMAGE_BYTES'] = int(os.getenv('ANALYZE_MAX_IMAGE_BYTES', str(8 * 1024 * 1024))) # Client-supplied data URLs
+app.config['ANALYSIS_CACHE_MEMORY_SIZE'] = int(os.getenv('ANALYSIS_CACHE_MEMORY_SIZE', '256'))
+app.config['ANALYSIS_CACHE_MAX_ENTRIES'] = int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '20000'))
+app.config['ANALYSIS_CACHE_TTL_DAYS'] = float(os.getenv('ANALYSIS_CACHE_TTL_DAYS', '90'))
+# Text-to-speech (sentence segments synthesized in parallel, on-disk audio cache)
+app.config['TTS_MODEL'] = os.getenv('TTS_MODEL', 'tts-1')
+app.config['TTS_VOICE'] = os.getenv('TTS_VOICE', 'alloy')
+app.config['TTS_SEGMENT_MAX_CHARS'] = int(os.getenv('TTS_SEGMENT_MAX_CHARS', '400'))
+app.config['TTS_FIRST_SEGMENT_MAX_CHARS'] = int(os.getenv('TTS_FIRST_SEGMENT_MAX_CHARS', '120')) # Short first segment = faster start
+app.config['TTS_MAX_CONCURRENCY'] = int(os.getenv('TTS_MAX_CONCURRENCY', '4'))
+app.config['TTS_CACHE_MAX_BYTES'] = int(os.getenv('TTS_CACHE_MAX_BYTES', str(500 * 1024 * 1024)))
+# Speech-to-text (uploads stay in memory; optional silence trimming needs pydub, and ffmpeg for non-WAV input)
+app.config['TRANSCRIBE_MAX_BYTES'] = int(os.getenv('TRANSCRIBE_MAX_BYTES', str(25 * 1024 * 1024))) # Whisper upload limit
+app.config['TRANSCRIBE_MAX_CONCURRENCY'] = int(os.getenv('TRANSCRIBE_MAX_CONCURRENCY', '4'))
+app.config['TRANSCRIBE_QUEUE_TIMEOUT'] = float(os.getenv('TRANSCRIBE_QUEUE_TIMEOUT', '10')) # Seconds to wait for a slot before 503
+app.config['TRANSCRIBE_TRIM_SILENCE'] = os.getenv('TRANSCRIBE_TRIM_SILENCE', 'false').lower() in ('1', 'true', 'yes')
+app.config['TRANSCRIBE_SILENCE_MIN_MS'] = int(os.getenv('TRANSCRIBE_SILENCE_MIN_MS', '700')) # Silences at least this long are dropped
+app.config['TRANSCRIBE_SILENCE_THRESH_DB'] = float(os.getenv('TRANSCRIBE_SILENCE_THRESH_DB', '-16')) # Relative to the clip's average loudness
+app.config['TRANSCRIBE_SILENCE_PAD_MS'] = int(os.getenv('TRANSCRIBE_SILENCE_PAD_MS', '150')) # Audio kept around each voiced segment
+# Hybrid retrieval (per-paper BM25 + vector search, fused and de-duplicated with MMR)
+app.config['CHUNK_FOLDER'] = 'paper_chunks' # Per-paper chunk texts backing the in-memory lexical indexes
+app.config['RETRIEVAL_MODE'] = os.getenv('RETRIEVAL_MODE', 'hybrid') # 'hybrid' or 'vector' (filtered similarity search only)
+app.config['RETRIEVAL_K'] = int(os.getenv('RETRIEVAL_K', '10'))
+app.config['RETRIEVAL_FETCH_K'] = int(os.getenv('RETRIEVAL_FETCH_K', '30')) # Candidates per retriever before fusion
+app.config['RETRIEVAL_MMR_LAMBDA'] = float(os.getenv('RETRIEVAL_MMR_LAMBDA', '0.7'))
+app.config['RETRIEVAL_DUPLICATE_THRESHOLD'] = float(os.getenv('RETRIEVAL_DUPLICATE_THRESHOLD', '0.8')) # Token-set Jaccard
+app.config['RETRIEVAL_INDEX_CACHE_SIZE'] = int(os.getenv('RETRIEVAL_INDEX_CACHE_SIZE', '64')) # Papers kept in memory
+app.config['QUERY_EMBED_CACHE_SIZE'] = int(os.getenv('QUERY_EMBED_CACHE_SIZE', '1024'))
+# Chat context packing (page text + retrieved snippets fitted to a token budget)
+app.config['CONTEXT_PACKING'] = os.getenv('CONTEXT_PACKING', 'true').lower() in ('1', 'true', 'yes') # false = paste chunks as retrieved
+app.config['CONTEXT_TOKEN_BUDGET'] = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000')) # Page text + snippets
+app.config['CONTEXT_TOKEN_ENCODING'] = os.getenv('CONTEXT_TOKEN_ENCODING', 'o200k_base') # tiktoken encoding; character estimate if unavailable
+app.config['CATALOG_DB'] = os.getenv('CATALOG_DB', 'paper_catalog.sqlite3') # paper_id -> file / counts / status
+# Vector storage: papers hashed into a fixed set of Chroma shard collections
+app.config['CHROMA_SHARDS'] = int(os.getenv('CHROMA_SHARDS', '32')) # Changing it re-shards existing chunks on the next start
+app.config['STORAGE_QUOTA_MB'] = float(os.getenv('STORAGE_QUOTA_MB', '0')) # 0 = unlimited; beyond it the least-recently-read papers are deleted
+app.config['MIGRATION_BATCH_SIZE'] = int(os.getenv('MIGRATION_BATCH_SIZE', '2000')) # Chunks copied per page when migrating collections
+# Background ingestion (upload -> extract / split / embed / persist)
+app.config['INGEST_WORKERS'] = int(os.getenv('INGEST_WORKERS', '2'))
+app.config['INGEST_QUEUE_SIZE'] = int(os.getenv('INGEST_QUEUE_SIZE', '16')) # Max queued + running jobs
+app.config['INGEST_JOB_RETENTION'] = int(os.getenv('INGEST_JOB_RETENTION', '200')) # Finished jobs kept for status queries
+app.config['PDF_PARSE_PROCESSES'] = int(os.getenv('PDF_PARSE_PROCESSES', str(min(4, os.cpu_count() or 1)))) # 0/1 = parse inline
+app.config['PDF_PARSE_MIN_PAGES'] = int(os.getenv('PDF_PARSE_MIN_PAGES', '32')) # Smaller PDFs are parsed inline
+app.config['EMBED_BATCH_SIZE'] = int(os.getenv('EMBED_BATCH_SIZE', '64'))
+# Chunk embedding cache
+app.config['EMBED_CACHE_MAX_ENTRIES'] = int(os.getenv('EMBED_CACHE_MAX_ENTRIES', '500000')) # ~6 KB each for 1536-dim vectors
+app.config['EMBED_API_BATCH_SIZE'] = int(os.getenv('EMBED_API_BATCH_SIZE', '256')) # Texts per embeddings API request
+app.config['EMBED_TOKENIZE'] = os.getenv('EMBED_TOKENIZE', 'true').lower() in ('1', 'true', 'yes') # false = send raw text (no tiktoken encoding download; chunks are far below the input limit)
+app.config['EMBED_MAX_CONCURRENCY'] = int(os.getenv('EMBED_MAX_CONCURRENCY', '4')) # Parallel embeddings API requests (process-wide)
+# Upstream API runtime (shared connection pool, retries, per-upstream concurrency limits)
+app.config['UPSTREAM_MAX_CONNECTIONS'] = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', '64')) # Pooled keep-alive connections shared by all OpenAI calls
+app.config['UPSTREAM_TIMEOUT'] = float(os.getenv('UPSTREAM_TIMEOUT', '120')) # Seconds per upstream request
+app.config['UPSTREAM_MAX_RETRIES'] = int(os.getenv('UPSTREAM_MAX_RETRIES', '3')) # 429 / 5xx / connection errors, jittered exponential backoff
+app.config['UPSTREAM_QUEUE_TIMEOUT'] = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '10')) # Seconds to wait for a slot before 503
+app.config['UPSTREAM_RETRY_AFTER'] = int(os.getenv('UPSTREAM_RETRY_AFTER', '2')) # Retry-After seconds sent with 503
+app.config['CHAT_MAX_CONCURRENCY'] = int(os.getenv('CHAT_MAX_CONCURRENCY', '16')) # Chat + translation LLM calls
+app.config['VISION_MAX_CONCURRENCY'] = int(os.getenv('VISION_MAX_CONCURRENCY', '4')) # Page analysis calls
+
+# Metrics / tracing
+app.config['TRACE_HEADERS'] = os.getenv('TRACE_HEADERS', 'true').lower() in ('1', 'true', 'yes') # X-Trace-Id + Server-Timing on responses
 
 # --- Global Variables & Setup ---
-for folder_key in ['UPLOAD_FOLDER', 'CHROMA_DB_FOLDER', 'TEMP_FOLDER']:
+for folder_key in ['UPLOAD_FOLDER', 'CHROMA_DB_FOLDER', 'TEMP_FOLDER', 'CACHE_FOLDER', 'PAGE_TEXT_FOLDER', 'CHUNK_FOLDER']:
     folder_path = app.config[folder_key]
     os.makedirs(folder_path, exist_ok=True)
     logging.info(f"Directory ensured: {folder_path}")
 
+# --- Metrics & Tracing ---
+# Stage latencies, request counts and chunk / token / cache counters, exported in Prometheus text format
+# at /metrics. Each request gets a trace id (the client's X-Request-ID when usable) that is added to its log
+# lines and returned as X-Trace-Id, with a Server-Timing header breaking the request down by stage.
+metrics_registry = metrics.Registry(prefix='paper_assistant_')
+stage_seconds = metrics_registry.histogram('stage_duration_seconds', "Latency of pipeline stages (PDF load, embed, retrieval, LLM, ...).", ('stage',))
+request_seconds = metrics_registry.histogram('http_request_duration_seconds', "HTTP request latency until the response is returned (stream bodies excluded).", ('endpoint', 'method'))
+requests_total = metrics_registry.counter('http_requests_total', "HTTP requests by endpoint and status.", ('endpoint', 'method', 'status'))
+ingested_pages_total = metrics_registry.counter('ingested_pages_total', "PDF pages extracted by ingestion.")
+ingested_chunks_total = metrics_registry.counter('ingested_chunks_total', "Chunks embedded and persisted by ingestion.")
+retrievals_total = metrics_registry.counter('retrievals_total', "Chat retrievals by mode (lexical / hybrid / vector).", ('mode',))
+retrieved_chunks_total = metrics_registry.counter('retrieved_chunks_total', "Chunks returned by chat retrievals.")
+prompt_tokens_total = metrics_registry.counter('prompt_tokens_total', "Chat prompt tokens before and after context packing.", ('stage',))
+llm_tokens_total = metrics_registry.counter('llm_tokens_total', "Tokens reported by the chat model (non-streaming calls).", ('type',))
+QUIET_ENDPOINTS = {'/metrics', '/upload_status/<job_id>'} # Polled endpoints: no per-request log line
+
+def span(stage):
+    """Times a block into the stage latency histogram and the current trace (yields a timer with .ms)."""
+    return metrics.span(stage_seconds, stage)
+
 # --- Initialize AI Components (Globally) ---
 openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
@@ -45,60 +184,615 @@ if not openai_api_key:
 else:
     logging.info("OpenAI API Key loaded.")
 
+# --- Embedding Cache ---
+def normalize_chunk_text(text):
+    """Normalizes chunk text so identical content maps to the same cache key."""
+    return " ".join((text or "").split())
+
+class EmbeddingCache:
+    """
+    Persistent SQLite cache of embedding vectors keyed by sha256(model + normalized text).
+    Least-recently-used entries are evicted once max_entries is exceeded.
+    """
+    def __init__(self, path, max_entries):
+        self.path = path; self.max_entries = max_entries
+        self.hits = 0; self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, normalized_text):
+        return hashlib.sha256(f"{model}\0{normalized_text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """Returns {key: vector} for cached keys and refreshes their LRU timestamp."""
+        found = {}
+        if not keys: return found
+        with self._lock:
+            for start in range(0, len(keys), 500): # Stay under SQLite's bound-parameter limit
+                batch = keys[start:start + 500]
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+                for key, blob in rows: found[key] = array('f', blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._conn.commit()
+            self.hits += len(found); self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Stores {key: vector} and evicts the least-recently-used overflow."""
+        if not items: return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                                   [(key, array('f', vector).tobytes(), now) for key, vector in items.items()])
+            overflow = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (overflow,))
+                logging.info(f"Embedding cache evicted {overflow} entries.")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {"entries": entries, "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings model with the persistent chunk cache.
+    Cache misses are de-duplicated and sent in batches with a bounded number of concurrent requests;
+    an optional UpstreamLimiter caps API calls across all callers (queries fail fast when it is full).
+    """
+    def __init__(self, base, cache, batch_size=256, max_concurrency=4, query_cache_size=1024, limiter=None):
+        self.base = base; self.cache = cache; self.limiter = limiter
+        self.model = getattr(base, 'model', type(base).__name__)
+        self.batch_size = max(1, batch_size); self.max_concurrency = max(1, max_concurrency)
+        self.query_cache_size = query_cache_size; self.query_hits = 0; self.query_misses = 0
+        self._query_cache: OrderedDict = OrderedDict(); self._query_lock = threading.Lock()
+
+    def embed_documents(self, texts, progress=None):
+        """Embeds texts, reusing cached vectors. `progress(done, total)` is called as misses are embedded."""
+        normalized = [normalize_chunk_text(t) for t in texts]
+        keys = [EmbeddingCache.make_key(self.model, n) for n in normalized]
+        vectors = self.cache.get_many(list(dict.fromkeys(keys)))
+        missing = {}  # key -> normalized text, de-duplicated
+        for key, text in zip(keys, normalized):
+            if key not in vectors: missing.setdefault(key, text)
+        cached_count = sum(1 for key in keys if key in vectors)
+        logging.info(f"Embeddings: {len(texts)} texts, {cached_count} from cache, {len(missing)} unique misses.")
+        if missing:
+            miss_keys = list(missing)
+            batches = [miss_keys[i:i + self.batch_size] for i in range(0, len(miss_keys), self.batch_size)]
+            logging.info(f"Embedding {len(miss_keys)} uncached chunks in {len(batches)} batches (concurrency {self.max_concurrency}).")
+            done = 0
+            def embed_batch(batch_keys):
+                with self._slot(wait=True): return dict(zip(batch_keys, self.base.embed_documents([missing[k] for k in batch_keys])))
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches)), thread_name_prefix='embed') as pool:
+                for result in pool.map(embed_batch, batches):
+                    self.cache.put_many(result); vectors.update(result)
+                    done += len(result)
+                    if progress: progress(min(len(texts), cached_count + done), len(texts))
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        """Embeds a query, memoized in a small in-memory LRU (repeat questions skip the API round-trip)."""
+        key = normalize_chunk_text(text)
+        with self._query_lock:
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key); self.query_hits += 1
+                return self._query_cache[key]
+            self.query_misses += 1
+        with self._slot(): vector = self.base.embed_query(text)
+        with self._query_lock:
+            self._query_cache[key] = vector
+            while len(self._query_cache) > self.query_cache_size: self._query_cache.popitem(last=False)
+        return vector
+
+    def _slot(self, wait=False):
+        return self.limiter.slot(wait=wait) if self.limiter else nullcontext()
+
+# --- Open Resource Pool ---
+class ResourcePool:
+    """
+    Thread-safe LRU of open resources (memory-mapped page stores, fitz documents).
+    Each entry has its own lock, so a resource is never used concurrently or closed while in use.
+    """
+    def __init__(self, opener, max_size):
+        self._opener = opener; self.max_size = max(1, max_size)
+        self._entries: OrderedDict = OrderedDict()  # key -> [resource, lock]
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry: self._entries.move_to_end(key); return entry
+        resource = self._opener(key)
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry: evicted.append([resource, threading.Lock()]) # Lost an open race; keep the existing one
+            else:
+                entry = self._entries[key] = [resource, threading.Lock()]
+                while len(self._entries) > self.max_size: evicted.append(self._entries.popitem(last=False)[1])
+        for old in evicted: self._close(old)
+        return entry
+
+    @staticmethod
+    def _close(entry):
+        with entry[1]:
+            if entry[0] is not None:
+                try: entry[0].close()
+                except Exception as e: logging.warning(f"Error closing pooled resource: {e}")
+                entry[0] = None
+
+    @contextmanager
+    def acquire(self, key):
+        """Yields the open resource for key, opening it (and evicting the LRU entry) if needed."""
+        while True:
+            entry = self._get_entry(key)
+            with entry[1]:
+                if entry[0] is not None: # None means it was evicted between lookup and lock
+                    yield entry[0]; return
+
+    def discard(self, key):
+        with self._lock: entry = self._entries.pop(key, None)
+        if entry: self._close(entry)
+
+    def clear(self):
+        with self._lock: entries = list(self._entries.values()); self._entries.clear()
+        for entry in entries: self._close(entry)
+
+def page_store_path(paper_id):
+    return os.path.join(app.config['PAGE_TEXT_FOLDER'], f"{paper_id}.pages")
+
+page_store_pool = ResourcePool(lambda paper_id: pdf_utils.PageStore(page_store_path(paper_id)), app.config['PAGE_STORE_POOL_SIZE'])
+pdf_doc_pool = ResourcePool(fitz.open, app.config['PDF_DOC_POOL_SIZE'])
+
+# --- Result Caches ---
+class TextResultCache:
+    """
+    Two-tier cache for generated text (translations, page analyses): an in-memory LRU in
+    front of a persistent SQLite table with TTL and size-bounded LRU eviction.
+    Tracks per-tier hit counts and hit / miss latency for sizing.
+    """
+    PRUNE_INTERVAL = 64 # Puts between expiry / size pruning passes (the table may briefly exceed max_entries by this much)
+
+    def __init__(self, path, memory_size, max_entries, ttl_seconds):
+        self.memory_size = max(0, memory_size); self.max_entries = max_entries; self.ttl_seconds = ttl_seconds
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_last_used ON results(last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_created_at ON results(created_at)")
+        self._conn.commit()
+        self._puts_since_prune = self.PRUNE_INTERVAL # Prune on the first put after startup
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "hit_seconds": 0.0, "miss_seconds": 0.0}
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256("\0".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+    def _remember(self, key, value):
+        """Adds to the memory tier. Caller holds the lock."""
+        if not self.memory_size: return
+        self._memory[key] = value; self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size: self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Returns (value, tier) where tier is 'memory', 'disk' or None on a miss."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key); self.counters["memory_hits"] += 1
+                return self._memory[key], 'memory'
+            now = time.time()
+            row = self._conn.execute("SELECT value, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key)); self._conn.commit()
+                self._remember(key, row[0]); self.counters["disk_hits"] += 1
+                return row[0], 'disk'
+            if row: self._conn.execute("DELETE FROM results WHERE key = ?", (key,)); self._conn.commit() # Expired
+            self.counters["misses"] += 1
+            return None, None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value)
+            self._conn.execute("INSERT OR REPLACE INTO results (key, value, created_at, last_used) VALUES (?, ?, ?, ?)", (key, value, now, now))
+            self._puts_since_prune += 1
+            if self._puts_since_prune >= self.PRUNE_INTERVAL: self._prune(now)
+            self._conn.commit()
+
+    def _prune(self, now):
+        """Drops expired rows, then least-recently-used rows beyond max_entries. Caller holds the lock."""
+        self._puts_since_prune = 0
+        self._conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_seconds,))
+        overflow = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+        if overflow > 0: self._conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (overflow,))
+
+    def record(self, counter, value=1):
+        with self._lock: self.counters[counter] += value
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear(); self._conn.execute("DELETE FROM results"); self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            c = dict(self.counters)
+            entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            memory_entries = len(self._memory)
+        hits = c["memory_hits"] + c["disk_hits"]; lookups = hits + c["misses"]
+        return {"memory_hits": c["memory_hits"], "disk_hits": c["disk_hits"], "misses": c["misses"], "coalesced": c["coalesced"],
+                "hit_rate": round(hits / lookups, 4) if lookups else None,
+                "avg_hit_ms": round(c["hit_seconds"] / hits * 1000, 2) if hits else None,
+                "avg_miss_ms": round(c["miss_seconds"] / c["misses"] * 1000, 2) if c["misses"] else None,
+                "memory_entries": memory_entries, "memory_size": self.memory_size, "entries": entries, "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds}
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one upstream call; followers wait for its result."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict = {}  # key -> Future
+
+    def do(self, key, fn):
+        """Returns (result, shared) where shared is True if another caller's in-flight result was reused."""
+        with self._lock:
+            future = self._calls.get(key); leader = future is None
+            if leader: future = self._calls[key] = Future()
+        if not leader: return future.result(), True
+        try: future.set_result(fn())
+        except BaseException as e: future.set_exception(e)
+        finally:
+            with self._lock: self._calls.pop(key, None)
+        return future.result(), False
+
+    def do_many(self, keys, fn):
+        """
+        Batch form of do(): fn(led_keys) computes the keys not already in flight in one call and returns
+        {key: result}; the other keys wait for their leaders. Returns ({key: result}, set of shared keys).
+        """
+        futures = {}; led = []
+        with self._lock:
+            for key in keys:
+                future = self._calls.get(key)
+                if future is None: future = self._calls[key] = Future(); led.append(key)
+                futures[key] = future
+        if led:
+            try:
+                results = fn(led)
+                for key in led: futures[key].set_result(results[key])
+            except BaseException as e:
+                for key in led:
+                    if not futures[key].done(): futures[key].set_exception(e)
+            finally:
+                with self._lock:
+                    for key in led: self._calls.pop(key, None)
+        return {key: future.result() for key, future in futures.items()}, set(futures) - set(led)
+
+translation_cache = TextResultCache(os.path.join(app.config['CACHE_FOLDER'], 'translations.sqlite3'), app.config['TRANSLATION_CACHE_MEMORY_SIZE'],
+                                    app.config['TRANSLATION_CACHE_MAX_ENTRIES'], app.config['TRANSLATION_CACHE_TTL_DAYS'] * 86400)
+translation_flights = SingleFlight()
+analysis_cache = TextResultCache(os.path.join(app.config['CACHE_FOLDER'], 'analyses.sqlite3'), app.config['ANALYSIS_CACHE_MEMORY_SIZE'],
+                                 app.config['ANALYSIS_CACHE_MAX_ENTRIES'], app.config['ANALYSIS_CACHE_TTL_DAYS'] * 86400)
+analysis_flights = SingleFlight()
+
+class AudioFileCache:
+    """
+    Content-addressed on-disk cache of synthesized audio segments (one file per segment).
+    Evicts least-recently-used files (by mtime, refreshed on hit) once max_bytes is exceeded.
+    """
+    LOW_WATER = 0.9 # Eviction frees down to this fraction of max_bytes, so the directory is scanned once per ~10% of capacity written
+
+    def __init__(self, folder, max_bytes, extension='mp3'):
+        self.folder = folder; self.max_bytes = max_bytes; self.extension = extension
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0; self.misses = 0
+        self.total_bytes = sum(e.stat().st_size for e in os.scandir(folder) if e.is_file())
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.{self.extension}")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f: data = f.read()
+            os.utime(path, None)
+        except FileNotFoundError:
+            with self._lock: self.misses += 1
+            return None
+        with self._lock: self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key); tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f: f.write(data)
+        with self._lock:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path); self.total_bytes += len(data) - previous
+            if self.total_bytes > self.max_bytes: self._evict()
+
+    def _evict(self):
+        """Removes the oldest files until under the low-water mark. Caller holds the lock."""
+        entries = sorted((e for e in os.scandir(self.folder) if e.is_file() and e.name.endswith(f".{self.extension}")), key=lambda e: e.stat().st_mtime)
+        removed = 0; target = self.max_bytes * self.LOW_WATER
+        for entry in entries:
+            if self.total_bytes <= target: break
+            try: size = entry.stat().st_size; os.unlink(entry.path); self.total_bytes -= size; removed += 1
+            except OSError: pass
+        logging.info(f"Audio cache evicted {removed} files ({self.total_bytes} bytes remain).")
+
+    def stats(self):
+        with self._lock: return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+tts_cache = AudioFileCache(os.path.join(app.config['CACHE_FOLDER'], 'tts'), app.config['TTS_CACHE_MAX_BYTES'])
+tts_flights = SingleFlight()
+tts_executor = ThreadPoolExecutor(max_workers=max(1, app.config['TTS_MAX_CONCURRENCY']), thread_name_prefix='tts')
+
+# --- Paper Catalog ---
+class PaperCatalog:
+    """
+    Persistent SQLite index of uploaded papers (paper_id -> filename, page / chunk counts, ingest status).
+    Written at ingestion time so /papers and find_pdf_path are indexed lookups.
+    """
+    COLUMNS = ('paper_id', 'filename', 'display_name', 'page_count', 'chunk_count', 'status', 'error', 'created_at', 'updated_at', 'ingested_at',
+               'storage_bytes', 'last_read_at', 'content_sha256')
+    TOUCH_INTERVAL = 60 # Seconds between last_read_at writes for the same paper
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS papers (
+            paper_id TEXT PRIMARY KEY, filename TEXT, display_name TEXT NOT NULL,
+            page_count INTEGER, chunk_count INTEGER, status TEXT NOT NULL, error TEXT,
+            created_at REAL NOT NULL, updated_at REAL NOT NULL, ingested_at REAL,
+            storage_bytes INTEGER, last_read_at REAL, content_sha256 TEXT)""")
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(papers)")}
+        for column, column_type in (('storage_bytes', 'INTEGER'), ('last_read_at', 'REAL'), ('content_sha256', 'TEXT')): # Catalogs created before the storage quota / bulk import
+            if column not in existing: self._conn.execute(f"ALTER TABLE papers ADD COLUMN {column} {column_type}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_status_name ON papers(status, display_name)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_content_sha256 ON papers(content_sha256)")
+        self._conn.commit()
+        self._touched = {} # paper_id -> last last_read_at write
+
+    def add(self, paper_id, filename, display_name, status='queued', **fields):
+        now = time.time()
+        row = {"paper_id": paper_id, "filename": filename, "display_name": display_name, "status": status,
+               "created_at": now, "updated_at": now, **fields}
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO papers ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})", list(row.values()))
+            self._conn.commit()
+
+    def upsert(self, paper_id, filename, display_name, status, **fields):
+        """Inserts an entry, or updates the given fields of an existing one (created_at and last_read_at are kept)."""
+        now = time.time()
+        row = {"paper_id": paper_id, "filename": filename, "display_name": display_name, "status": status,
+               "created_at": now, "updated_at": now, **fields}
+        updates = ', '.join(f"{k} = excluded.{k}" for k in row if k not in ('paper_id', 'created_at'))
+        with self._lock:
+            self._conn.execute(f"INSERT INTO papers ({', '.join(row)}) VALUES ({', '.join('?' * len(row))}) ON CONFLICT(paper_id) DO UPDATE SET {updates}",
+                               list(row.values()))
+            self._conn.commit()
+
+    def update(self, paper_id, **fields):
+        fields = {k: v for k, v in fields.items() if k in self.COLUMNS and k != 'paper_id'}
+        fields['updated_at'] = time.time()
+        with self._lock:
+            self._conn.execute(f"UPDATE papers SET {', '.join(f'{k} = ?' for k in fields)} WHERE paper_id = ?", [*fields.values(), paper_id])
+            self._conn.commit()
+
+    def get(self, paper_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM papers WHERE paper_id = ?", (paper_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_by_content_hash(self, content_sha256):
+        """Returns the entry for a PDF with this content hash (a 'ready' one first), or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM papers WHERE content_sha256 = ? ORDER BY status != 'ready', created_at LIMIT 1", (content_sha256,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self, status='ready'):
+        """Entries with a status (None = all), by display name."""
+        with self._lock:
+            if status is None: rows = self._conn.execute("SELECT * FROM papers ORDER BY display_name").fetchall()
+            else: rows = self._conn.execute("SELECT * FROM papers WHERE status = ? ORDER BY display_name", (status,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def touch(self, paper_id):
+        """Records that a paper was read (at most one write per TOUCH_INTERVAL)."""
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(paper_id, 0) < self.TOUCH_INTERVAL: return
+            self._touched[paper_id] = now
+            self._conn.execute("UPDATE papers SET last_read_at = ? WHERE paper_id = ?", (now, paper_id)); self._conn.commit()
+
+    def eviction_candidates(self):
+        """Finished papers (ready / failed), least recently read first."""
+        with self._lock:
+            rows = self._conn.execute("""SELECT * FROM papers WHERE status IN ('ready', 'failed')
+                ORDER BY COALESCE(last_read_at, ingested_at, created_at)""").fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self):
+        with self._lock: return self._conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+
+    def delete(self, paper_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM papers WHERE paper_id = ?", (paper_id,)); self._conn.commit(); self._touched.pop(paper_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM papers"); self._conn.commit(); self._touched.clear()
+
+paper_catalog = PaperCatalog(app.config['CATALOG_DB'])
+
+# --- Upstream Runtime ---
+# Every OpenAI call goes through one pooled HTTP client (keep-alive connections are reused across requests
+# and threads) and the SDK's retries: 429 / 5xx / connection errors back off exponentially with jitter,
+# honouring Retry-After. Each upstream also has a concurrency limit; a request that can't get a slot within
+# UPSTREAM_QUEUE_TIMEOUT is rejected with 503 + Retry-After instead of queueing without bound.
+upstream_http_client = DefaultHttpxClient(limits=httpx.Limits(max_connections=app.config['UPSTREAM_MAX_CONNECTIONS'],
+                                                              max_keepalive_connections=app.config['UPSTREAM_MAX_CONNECTIONS']))
+
+class UpstreamBusy(Exception):
+    """Raised when an upstream's concurrency slots stay full past the queue timeout."""
+    def __init__(self, upstream, retry_after):
+        super().__init__(f"Upstream '{upstream}' busy"); self.upstream = upstream; self.retry_after = retry_after
+
+class UpstreamLimiter:
+    """Bounds concurrent requests to one upstream API and counts waiting / in-flight / rejected calls."""
+    def __init__(self, name, max_concurrency, queue_timeout):
+        self.name = name; self.max_concurrency = max(1, max_concurrency); self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(self.max_concurrency); self._lock = threading.Lock()
+        self.waiting = 0; self.in_flight = 0; self.rejected = 0
+
+    def acquire(self, wait=False):
+        """Takes a slot, waiting up to queue_timeout (then raises UpstreamBusy), or indefinitely if wait=True (background work)."""
+        with self._lock: self.waiting += 1
+        with span(f"{self.name}_queue"): acquired = self._slots.acquire() if wait else self._slots.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self.waiting -= 1
+            if acquired: self.in_flight += 1
+            else: self.rejected += 1
+        if not acquired:
+            logging.warning(f"Upstream '{self.name}' busy ({self.max_concurrency} in flight), rejecting request.")
+            raise UpstreamBusy(self.name, app.config['UPSTREAM_RETRY_AFTER'])
+
+    def release(self):
+        with self._lock: self.in_flight -= 1
+        self._slots.release()
+
+    @contextmanager
+    def slot(self, wait=False):
+        self.acquire(wait=wait)
+        try: yield
+        finally: self.release()
+
+    def stats(self):
+        with self._lock: return {"max_concurrency": self.max_concurrency, "in_flight": self.in_flight, "waiting": self.waiting, "rejected": self.rejected}
+
+upstream_limiters = {
+    'chat': UpstreamLimiter('chat', app.config['CHAT_MAX_CONCURRENCY'], app.config['UPSTREAM_QUEUE_TIMEOUT']),
+    'embeddings': UpstreamLimiter('embeddings', app.config['EMBED_MAX_CONCURRENCY'], app.config['UPSTREAM_QUEUE_TIMEOUT']),
+    'vision': UpstreamLimiter('vision', app.config['VISION_MAX_CONCURRENCY'], app.config['UPSTREAM_QUEUE_TIMEOUT']),
+    'tts': UpstreamLimiter('tts', app.config['TTS_MAX_CONCURRENCY'], app.config['UPSTREAM_QUEUE_TIMEOUT']),
+    'whisper': UpstreamLimiter('whisper', app.config['TRANSCRIBE_MAX_CONCURRENCY'], app.config['TRANSCRIBE_QUEUE_TIMEOUT']),
+}
+
+def busy_response(e, message="AI 服務目前請求過多，請稍後再試。"):
+    """503 + Retry-After for a request rejected by an upstream limiter (or a full queue)."""
+    return jsonify({"error": message}), 503, {"Retry-After": str(e.retry_after if isinstance(e, UpstreamBusy) else app.config['UPSTREAM_RETRY_AFTER'])}
+
+class ReadWriteLock:
+    """Shared / exclusive lock. Waiting writers block new readers, so a writer isn't starved. Not reentrant."""
+    def __init__(self):
+        self._cond = threading.Condition(); self._readers = 0; self._writer = False; self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting: self._cond.wait()
+            self._readers += 1
+        try: yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers: self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers: self._cond.wait()
+            self._writers_waiting -= 1; self._writer = True
+        try: yield
+        finally:
+            with self._cond: self._writer = False; self._cond.notify_all()
+
+# Readers: retrieval, ingestion persist, single-paper deletes; writer: /clear_data (drops every collection and file)
+chroma_data_lock = ReadWriteLock()
+
 # Initialize globals to None initially
-vectorstore: Chroma | None = None # Add type hint
-embeddings: OpenAIEmbeddings | None = None
+chroma_client: chromadb.ClientAPI | None = None # Persistent client shared by all shard collections
+embeddings: CachedEmbeddings | None = None
+embedding_cache: EmbeddingCache | None = None
 llm: ChatOpenAI | None = None
 openai_client: OpenAI | None = None
+shard_stores: dict[str, Chroma] = {} # Shard collection name -> LangChain Chroma wrapper
+shard_stores_lock = threading.Lock()
+ai_components_lock = threading.RLock() # Serializes (re-)initialization
 LLM_MODEL_NAME = "gpt-4.1"
 VISION_MODEL_NAME = "gpt-4.1" # Assuming same model
 
 def initialize_ai_components():
     """
     Initializes or re-initializes AI components.
+    The new components are built first and swapped in together, so concurrent requests see either
+    the previous set or the new one, never a half-reset state. On failure the previous set stays.
     Returns True on success, False on failure.
     """
-    global vectorstore, embeddings, llm, openai_client
-    logging.info("Attempting to initialize AI components...")
-    try:
-        # Ensure components are re-initialized cleanly
-        vectorstore = None
-        embeddings = None
-        llm = None
-        openai_client = None
-
-        LLM_MODEL_NAME = "gpt-4.1"
-        VISION_MODEL_NAME = "gpt-4.1" # Assuming same model
-
-        embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
-        llm = ChatOpenAI(model_name=LLM_MODEL_NAME, temperature=0, openai_api_key=openai_api_key)
-        openai_client = OpenAI(api_key=openai_api_key)
-        logging.info(f"Initialized OpenAI parts (model: {LLM_MODEL_NAME})")
-
-        # Initialize ChromaDB Vectorstore using the new import
-        vectorstore = Chroma(
-            persist_directory=app.config['CHROMA_DB_FOLDER'],
-            embedding_function=embeddings
-        )
-        logging.info(f"Chroma vectorstore initialized for '{app.config['CHROMA_DB_FOLDER']}'.")
-        return True # Success
-    except Exception as e:
-        logging.critical(f"CRITICAL: AI components init failed: {e}", exc_info=True)
-        # Reset globals on failure
-        vectorstore = None; embeddings = None; llm = None; openai_client = None
-        return False # Failure
+    global chroma_client, embeddings, embedding_cache, llm, openai_client
+    with ai_components_lock:
+        logging.info("Attempting to initialize AI components...")
+        try:
+            upstream = {"http_client": upstream_http_client, "max_retries": app.config['UPSTREAM_MAX_RETRIES']}
+            if embedding_cache is None:
+                embedding_cache = EmbeddingCache(os.path.join(app.config['CACHE_FOLDER'], 'embeddings.sqlite3'), app.config['EMBED_CACHE_MAX_ENTRIES'])
+            new_embeddings = CachedEmbeddings(OpenAIEmbeddings(openai_api_key=openai_api_key, request_timeout=app.config['UPSTREAM_TIMEOUT'],
+                                                               check_embedding_ctx_length=app.config['EMBED_TOKENIZE'], **upstream), embedding_cache,
+                                              batch_size=app.config['EMBED_API_BATCH_SIZE'], max_concurrency=app.config['EMBED_MAX_CONCURRENCY'],
+                                              query_cache_size=app.config['QUERY_EMBED_CACHE_SIZE'], limiter=upstream_limiters['embeddings'])
+            new_llm = ChatOpenAI(model_name=LLM_MODEL_NAME, temperature=0, openai_api_key=openai_api_key, request_timeout=app.config['UPSTREAM_TIMEOUT'], **upstream)
+            new_openai_client = OpenAI(api_key=openai_api_key, timeout=app.config['UPSTREAM_TIMEOUT'], **upstream)
+            logging.info(f"Initialized OpenAI parts (model: {LLM_MODEL_NAME})")
+
+            # Initialize the ChromaDB client; chunks go to per-paper shard collections (see get_paper_vectorstore)
+            new_chroma_client = chromadb.PersistentClient(path=app.config['CHROMA_DB_FOLDER'])
+            with shard_stores_lock: # Cached wrappers hold the previous client / embeddings
+                chroma_client, embeddings, llm, openai_client = new_chroma_client, new_embeddings, new_llm, new_openai_client
+                shard_stores.clear()
+            logging.info(f"Chroma client initialized for '{app.config['CHROMA_DB_FOLDER']}'.")
+            return True # Success
+        except Exception as e:
+            logging.critical(f"CRITICAL: AI components init failed: {e}", exc_info=True)
+            return False # Failure
 
 # --- Initial call ---
 # We attempt initialization here, but routes will also check and re-attempt if needed.
 initialize_ai_components()
 
 # --- Helper Function: Ensure AI Components ---
+def ai_components_ready():
+    return bool(chroma_client and embeddings and llm and openai_client)
+
 def ensure_ai_components():
-    """Checks if AI components are initialized, tries to initialize if not."""
-    if not vectorstore or not embeddings or not llm or not openai_client:
+    """Checks if AI components are initialized; if not, one thread re-initializes while concurrent callers wait for it."""
+    if ai_components_ready(): return True
+    with ai_components_lock:
+        if ai_components_ready(): return True # Another thread finished initializing while we waited
         logging.warning("AI components not ready, attempting re-initialization...")
         return initialize_ai_components()
-    return True
+
+def invoke_llm(prompt):
+    """Calls the chat model within a 'chat' upstream slot; returns the reply text."""
+    with upstream_limiters['chat'].slot(), span('llm'):
+        response = llm.invoke(prompt)
+    usage = getattr(response, 'usage_metadata', None) or {}
+    if usage: llm_tokens_total.inc(usage.get('input_tokens', 0), type='input'); llm_tokens_total.inc(usage.get('output_tokens', 0), type='output')
+    return response.content if hasattr(response, 'content') else str(response)
 
 # --- Other Helper Functions ---
 def allowed_file(filename):
@@ -106,65 +800,516 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def process_pdf_for_rag(pdf_path, paper_id):
-    """Processes PDF for RAG and persists data."""
+# --- Sharded Vector Store ---
+# Chunks live in a fixed set of shard collections named 'papers-<shard count>-<shard>'; a paper's chunks
+# all sit in one shard, chosen by a stable hash of its paper_id. Searches are filtered by paper_id within
+# that shard, so their cost grows with corpus / CHROMA_SHARDS. (Chroma keeps every opened collection
+# resident - about 3 MB each - so a collection per paper does not scale to thousands of papers.)
+LEGACY_COLLECTION_NAME = 'langchain' # Single shared collection used before sharding
+
+def shard_collection_name(paper_id):
+    shards = max(1, app.config['CHROMA_SHARDS'])
+    return f"papers-{shards}-{int(hashlib.md5(paper_id.encode('utf-8')).hexdigest()[:8], 16) % shards:03d}"
+
+def get_paper_vectorstore(paper_id):
+    """Returns the Chroma wrapper for the shard collection holding a paper's chunks (filter by paper_id)."""
+    name = shard_collection_name(paper_id)
+    with shard_stores_lock:
+        store = shard_stores.get(name)
+        if store is None: store = shard_stores[name] = Chroma(client=chroma_client, collection_name=name, embedding_function=embeddings)
+    return store
+
+def count_paper_chunks():
+    """Returns {paper_id: chunk count} over all current shards (one metadata scan)."""
+    counts = {}
+    prefix = f"papers-{max(1, app.config['CHROMA_SHARDS'])}-"
+    for collection in chroma_client.list_collections():
+        if not collection.name.startswith(prefix): continue
+        for meta in collection.get(include=["metadatas"]).get('metadatas') or []:
+            if isinstance(meta, dict) and isinstance(meta.get('paper_id'), str):
+                counts[meta['paper_id']] = counts.get(meta['paper_id'], 0) + 1
+    return counts
+
+def estimate_paper_storage(paper_id, filename, chunk_count, embedding_dim=1536):
+    """
+    Estimated bytes a paper occupies: PDF + page text store + chunk file, plus its Chroma
+    records (float32 vectors and roughly the chunk file again for documents / metadata).
+    """
+    paths = [page_store_path(paper_id), paper_chunks_path(paper_id)]
+    if filename: paths.append(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    sizes = {path: os.path.getsize(path) for path in paths if os.path.isfile(path)}
+    return sum(sizes.values()) + sizes.get(paper_chunks_path(paper_id), 0) + (chunk_count or 0) * embedding_dim * 4
+
+def delete_paper(paper_id):
+    """
+    Deletes one paper: its chunks in Chroma, PDF, page text store, lexical chunks and catalog entry.
+    Returns a list of error messages (empty on success). Caller holds chroma_data_lock for reading.
+    """
+    errors = []; entry = paper_catalog.get(paper_id)
+    with lexical_indexes_lock: lexical_indexes.pop(paper_id, None)
+    try: get_paper_vectorstore(paper_id).delete(where={"paper_id": paper_id})
+    except Exception as e: msg = f"Error deleting chunks for {paper_id}: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+    page_store_pool.discard(paper_id) # Close pooled handles before their files are deleted
+    paths = [page_store_path(paper_id), paper_chunks_path(paper_id)]
+    if entry and entry.get('filename'):
+        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], entry['filename']); pdf_doc_pool.discard(pdf_path); paths.append(pdf_path)
+    for path in paths:
+        try:
+            if os.path.isfile(path): os.unlink(path)
+        except Exception as e: msg = f"Error deleting {path}: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+    try: paper_catalog.delete(paper_id)
+    except Exception as e: msg = f"Error deleting catalog entry for {paper_id}: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+    logging.info(f"Deleted paper {paper_id}{' with errors' if errors else ''}.")
+    return errors
+
+storage_quota_lock = threading.Lock()
+
+def enforce_storage_quota(keep=()):
+    """
+    Deletes least-recently-read papers until the estimated storage of ingested papers fits STORAGE_QUOTA_MB.
+    Papers in `keep` and papers still being ingested are never evicted. Returns the evicted paper ids.
+    """
+    quota = int(app.config['STORAGE_QUOTA_MB'] * 1024 * 1024)
+    if quota <= 0: return []
+    with storage_quota_lock:
+        papers = paper_catalog.eviction_candidates()
+        for paper in papers:
+            if paper['storage_bytes'] is None: # Papers cataloged before the quota existed
+                paper['storage_bytes'] = estimate_paper_storage(paper['paper_id'], paper['filename'], paper['chunk_count'])
+                paper_catalog.update(paper['paper_id'], storage_bytes=paper['storage_bytes'])
+        total = sum(p['storage_bytes'] for p in papers)
+        evicted = []
+        with chroma_data_lock.read():
+            for paper in papers:
+                if total <= quota: break
+                if paper['paper_id'] in keep: continue
+                logging.info(f"Storage quota exceeded ({total} > {quota} bytes), evicting {paper['paper_id']}.")
+                if not delete_paper(paper['paper_id']): total -= paper['storage_bytes']; evicted.append(paper['paper_id'])
+        return evicted
+
+def migrate_collections():
+    """
+    Moves chunks from collections outside the current layout - the legacy shared collection, or shards
+    of a different CHROMA_SHARDS setting - into their current shards, copying the stored embeddings
+    (no API calls), then drops the old collections. Chunks are upserted by id, so an interrupted
+    migration is simply re-run on the next start. Returns the number of chunks moved.
+    """
+    current_prefix = f"papers-{max(1, app.config['CHROMA_SHARDS'])}-"
+    old_names = [c.name for c in chroma_client.list_collections()
+                 if c.name == LEGACY_COLLECTION_NAME or (c.name.startswith('papers-') and not c.name.startswith(current_prefix))]
+    batch_size = max(1, app.config['MIGRATION_BATCH_SIZE']); moved = 0; skipped = 0
+    for name in old_names:
+        old = chroma_client.get_collection(name); total = old.count()
+        logging.info(f"Migrating {total} chunks from collection '{name}' to {current_prefix}* shards...")
+        for offset in range(0, total, batch_size):
+            results = old.get(limit=batch_size, offset=offset, include=["documents", "metadatas", "embeddings"])
+            grouped = {}
+            for chunk_id, text, metadata, vector in zip(results['ids'], results['documents'], results['metadatas'], results['embeddings']):
+                paper_id = (metadata or {}).get('paper_id')
+                if not isinstance(paper_id, str): skipped += 1; continue
+                group = grouped.setdefault(shard_collection_name(paper_id), ([], [], [], []))
+                group[0].append(chunk_id); group[1].append(text); group[2].append(metadata); group[3].append(vector)
+            for shard_name, (ids, texts, metadatas, vectors) in grouped.items():
+                collection = chroma_client.get_or_create_collection(name=shard_name, embedding_function=None)
+                collection.upsert(ids=ids, documents=texts, metadatas=metadatas, embeddings=vectors); moved += len(ids)
+            logging.info(f"Migrated {min(offset + batch_size, total)}/{total} chunks from '{name}'.")
+        chroma_client.delete_collection(name)
+    if old_names: logging.info(f"Collection migration done: {moved} chunks moved, {skipped} without paper_id dropped.")
+    return moved
+
+# --- Hybrid Retrieval ---
+lexical_indexes: OrderedDict = OrderedDict() # paper_id -> retrieval.LexicalIndex (LRU)
+lexical_indexes_lock = threading.Lock()
+
+def paper_chunks_path(paper_id):
+    return os.path.join(app.config['CHUNK_FOLDER'], f"{paper_id}.json")
+
+def _cache_lexical_index(paper_id, index):
+    with lexical_indexes_lock:
+        lexical_indexes[paper_id] = index; lexical_indexes.move_to_end(paper_id)
+        while len(lexical_indexes) > app.config['RETRIEVAL_INDEX_CACHE_SIZE']: lexical_indexes.popitem(last=False)
+
+def save_paper_chunks(paper_id, chunks):
+    """Persists a paper's chunks [(chunk_id, text, metadata)] and caches its lexical index."""
+    path = paper_chunks_path(paper_id); tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump([{"id": chunk_id, "text": text, "metadata": metadata} for chunk_id, text, metadata in chunks], f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    _cache_lexical_index(paper_id, retrieval.LexicalIndex(chunks))
+
+def get_lexical_index(paper_id):
+    """
+    Returns the BM25 index for a paper: from memory, else the saved chunk file, else
+    (papers ingested before hybrid retrieval) built from Chroma. The rebuilt index is only
+    saved and cached once the paper is 'ready': mid-ingestion, Chroma may hold part of its chunks.
+    Caller holds chroma_data_lock for reading.
+    """
+    with lexical_indexes_lock:
+        index = lexical_indexes.get(paper_id)
+        if index is not None: lexical_indexes.move_to_end(paper_id); return index
+    path = paper_chunks_path(paper_id)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f: chunks = [(c["id"], c["text"], c.get("metadata") or {}) for c in json.load(f)]
+        index = retrieval.LexicalIndex(chunks); _cache_lexical_index(paper_id, index)
+    else:
+        logging.info(f"Building lexical index for {paper_id} from Chroma...")
+        results = get_paper_vectorstore(paper_id).get(where={"paper_id": paper_id}, include=["documents", "metadatas"])
+        if not results.get('ids'): logging.warning(f"No chunks in Chroma for {paper_id}."); return retrieval.LexicalIndex([])
+        chunks = list(zip(results.get('ids') or [], results.get('documents') or [], results.get('metadatas') or []))
+        entry = paper_catalog.get(paper_id)
+        if not entry or entry['status'] != 'ready':
+            logging.info(f"Paper {paper_id} is not ready; lexical index built from {len(chunks)} Chroma chunks is not saved.")
+            return retrieval.LexicalIndex(chunks)
+        save_paper_chunks(paper_id, chunks)
+        with lexical_indexes_lock: index = lexical_indexes[paper_id]
+    logging.info(f"Lexical index for {paper_id} loaded ({len(index)} chunks).")
+    return index
+
+def retrieve_chunks(paper_id, query):
+    """
+    Retrieves the most relevant chunks of one paper. Returns (documents, mode) where mode is:
+      'lexical' - the query names identifier-like terms (datasets, metrics, equations) that BM25 pins down,
+                  answered without a query embedding call;
+      'hybrid'  - BM25 and vector rankings fused with RRF, then MMR drops near-duplicate overlapping chunks;
+      'vector'  - RETRIEVAL_MODE=vector (the plain filtered similarity search).
+    Vector searches only scan the paper's shard collection. If the embeddings upstream is saturated,
+    hybrid and vector queries fall back to the BM25 ranking alone ('lexical').
+    """
+    # chroma_data_lock only covers Chroma reads: a query embedding can wait on the upstream for minutes, and a
+    # /clear_data writer queued behind it would block every new reader.
+    k = app.config['RETRIEVAL_K']; fetch_k = max(k, app.config['RETRIEVAL_FETCH_K']); use_vectors = True
+    if app.config['RETRIEVAL_MODE'] == 'vector':
+        try:
+            with span('query_embed'): query_vector = embeddings.embed_query(query)
+        except UpstreamBusy: logging.warning(f"Embeddings upstream busy; answering {paper_id} query from the lexical index only."); use_vectors = False
+        else:
+            with chroma_data_lock.read(), span('vector_search'):
+                return get_paper_vectorstore(paper_id).similarity_search_by_vector(query_vector, k=k, filter={'paper_id': paper_id}), 'vector'
+    with span('lexical_search'):
+        with chroma_data_lock.read(): index = get_lexical_index(paper_id) # May build the index from Chroma
+        lexical_ranking = [chunk_id for chunk_id, _ in index.search(query, k=fetch_k)]
+    rankings = [lexical_ranking]; mode = 'lexical'
+    if use_vectors and len(index) and not (lexical_ranking and index.exact_terms(query)):
+        try:
+            with span('query_embed'): query_vector = embeddings.embed_query(query)
+        except UpstreamBusy: logging.warning(f"Embeddings upstream busy; answering {paper_id} query from the lexical index only.")
+        else:
+            with chroma_data_lock.read(), span('vector_search'):
+                vector_docs = get_paper_vectorstore(paper_id).similarity_search_by_vector(query_vector, k=fetch_k, filter={'paper_id': paper_id})
+            rankings.append([doc.id for doc in vector_docs if doc.id in index.texts]); mode = 'hybrid'
+    fused = retrieval.reciprocal_rank_fusion([r for r in rankings if r])
+    selected = retrieval.mmr_select(fused, index.term_sets, k, lambda_mult=app.config['RETRIEVAL_MMR_LAMBDA'],
+                                    duplicate_threshold=app.config['RETRIEVAL_DUPLICATE_THRESHOLD'])
+    return [Document(page_content=index.texts[chunk_id], metadata=index.metadata[chunk_id], id=chunk_id) for chunk_id in selected], mode
+
+# --- PDF Page Extraction (process pool) ---
+_pdf_process_pool: ProcessPoolExecutor | None = None
+_pdf_process_pool_lock = threading.Lock()
+
+def get_pdf_process_pool():
+    """Returns the shared process pool for page extraction, or None if disabled."""
+    global _pdf_process_pool
+    processes = app.config['PDF_PARSE_PROCESSES']
+    if processes <= 1: return None
+    with _pdf_process_pool_lock:
+        if _pdf_process_pool is None:
+            # 'spawn' avoids forking a multi-threaded server; workers only import pdf_utils (see the __main__ note at the top).
+            _pdf_process_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+            logging.info(f"PDF parse process pool started ({processes} processes).")
+        return _pdf_process_pool
+
+def extract_pdf_documents(pdf_path):
+    """
+    Extracts one Document per PDF page, with PyMuPDFLoader's metadata (source, file_path, page,
+    total_pages and the document info). Large PDFs are split into page ranges and parsed across the process pool.
+    """
+    page_count = pdf_utils.get_page_count(pdf_path)
+    if page_count == 0: return []
+    document_metadata = pdf_utils.get_document_metadata(pdf_path)
+    pool = get_pdf_process_pool() if page_count >= app.config['PDF_PARSE_MIN_PAGES'] else None
+    if pool:
+        ranges = pdf_utils.split_page_ranges(page_count, app.config['PDF_PARSE_PROCESSES'])
+        logging.info(f"Extracting {page_count} pages in {len(ranges)} ranges across processes.")
+        futures = [pool.submit(pdf_utils.extract_page_range, pdf_path, start, end) for start, end in ranges]
+        pages = [page for future in futures for page in future.result()]
+    else:
+        pages = pdf_utils.extract_page_range(pdf_path, 0, page_count)
+    return [Document(page_content=text, metadata={"source": pdf_path, "file_path": pdf_path, "page": page_index, "total_pages": page_count, **document_metadata})
+            for page_index, text in pages]
+
+CHUNK_SIZE = 1000 # Characters per chunk (also used by bulk_ingest.py); changes only affect newly ingested papers
+CHUNK_OVERLAP = 200
+
+def process_pdf_for_rag(pdf_path, paper_id, progress=None):
+    """
+    Processes PDF for RAG and persists data.
+    `progress(stage, done, total)` is called as each stage (extract / split / embed / persist) advances.
+    """
     if not ensure_ai_components(): # Check components are ready
         logging.error("Cannot process RAG: AI components not initialized.")
         return False
+    report = progress or (lambda stage, done, total: None)
 
     logging.info(f"Starting RAG: {pdf_path}, ID: {paper_id}")
     try:
-        loader = PyMuPDFLoader(pdf_path); docs = loader.load()
+        report('extract', 0, 1)
+        with span('pdf_load'): docs = extract_pdf_documents(pdf_path)
         if not docs: logging.warning(f"No docs: {pdf_path}"); return False
-        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        texts = splitter.split_documents(docs)
+        report('extract', len(docs), len(docs))
+        try:
+            with span('page_store'): pdf_utils.write_page_store(page_store_path(paper_id), [doc.page_content for doc in docs])
+            page_store_pool.discard(paper_id)
+        except Exception as store_e: logging.error(f"Error writing page text store for {paper_id}: {store_e}", exc_info=True) # Page chat falls back to fitz
+        report('split', 0, len(docs))
+        splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        with span('split'): texts = splitter.split_documents(docs)
         if not texts: logging.warning(f"No chunks: {pdf_path}"); return False
         logging.info(f"Split into {len(texts)} chunks.")
-        for text in texts: text.metadata = text.metadata or {}; text.metadata["paper_id"] = paper_id
+        for index, text in enumerate(texts): text.metadata = text.metadata or {}; text.metadata["paper_id"] = paper_id; text.metadata["chunk_index"] = index
+        chunk_ids = [f"{paper_id}:{index}" for index in range(len(texts))] # Stable ids shared by the vector and lexical indexes
+        report('split', len(docs), len(docs))
 
-        vectorstore.add_documents(documents=texts, embedding_function=embeddings) # Use global embeddings
-        logging.info(f"Added {len(texts)} chunks for {paper_id} to Chroma.")
-        try:
-            logging.info("Persisting ChromaDB data...")
-            vectorstore.persist() # Explicitly persist
-            logging.info("ChromaDB data persisted.")
-        except Exception as persist_e:
-            logging.error(f"Error persisting ChromaDB data: {persist_e}", exc_info=True)
+        # Embed up front (cache hits are free, misses go out in concurrent batches);
+        # add_documents below then resolves every chunk from the cache.
+        report('embed', 0, len(texts))
+        with span('embed'): vectors = embeddings.embed_documents([text.page_content for text in texts], progress=lambda done, total: report('embed', done, total))
+        report('embed', len(texts), len(texts))
+        report('persist', 0, len(texts))
+        with chroma_data_lock.read(), span('persist'): # /clear_data waits for (and can't interleave with) the writes below
+            entry = paper_catalog.get(paper_id)
+            if not entry: logging.warning(f"Paper {paper_id} was deleted during ingestion, not persisting."); return False
+            vectorstore = get_paper_vectorstore(paper_id) # The paper's shard collection
+            batch_size = max(1, app.config['EMBED_BATCH_SIZE'])
+            for start in range(0, len(texts), batch_size):
+                batch = texts[start:start + batch_size]
+                vectorstore.add_documents(documents=batch, ids=chunk_ids[start:start + batch_size], embedding_function=embeddings) # Use global embeddings
+                report('persist', start + len(batch), len(texts))
+            logging.info(f"Added {len(texts)} chunks for {paper_id} to Chroma.")
+            try: save_paper_chunks(paper_id, list(zip(chunk_ids, (t.page_content for t in texts), (t.metadata for t in texts))))
+            except Exception as chunk_e: logging.error(f"Error saving lexical chunks for {paper_id}: {chunk_e}", exc_info=True) # Rebuilt from Chroma on demand
+            try:
+                if hasattr(vectorstore, 'persist'): # Newer langchain_chroma persists automatically
+                    logging.info("Persisting ChromaDB data...")
+                    vectorstore.persist() # Explicitly persist
+                    logging.info("ChromaDB data persisted.")
+            except Exception as persist_e:
+                logging.error(f"Error persisting ChromaDB data: {persist_e}", exc_info=True)
+            report('persist', len(texts), len(texts))
+            storage_bytes = estimate_paper_storage(paper_id, entry.get('filename') or os.path.basename(pdf_path), len(texts), len(vectors[0]) if vectors else 1536)
+            paper_catalog.update(paper_id, status='ready', error=None, page_count=len(docs), chunk_count=len(texts), ingested_at=time.time(), storage_bytes=storage_bytes)
+        ingested_pages_total.inc(len(docs)); ingested_chunks_total.inc(len(texts))
         return True
     except Exception as e: logging.error(f"RAG error: {e}", exc_info=True); return False
 
+# --- Background Ingestion Queue ---
+INGEST_STAGES = ('extract', 'split', 'embed', 'persist')
+ingest_executor = ThreadPoolExecutor(max_workers=max(1, app.config['INGEST_WORKERS']), thread_name_prefix='ingest')
+ingest_jobs: dict[str, dict] = {}
+ingest_jobs_lock = threading.Lock()
+
+def _new_ingest_job(paper_id, filename, filepath):
+    now = time.time()
+    return {"job_id": str(uuid.uuid4()), "paper_id": paper_id, "filename": filename, "filepath": filepath,
+            "status": "queued", "stage": None, "error": None, "created_at": now, "updated_at": now,
+            "stages": {stage: {"status": "pending", "done": 0, "total": 0} for stage in INGEST_STAGES}}
+
+def _update_ingest_job(job_id, **fields):
+    with ingest_jobs_lock:
+        job = ingest_jobs.get(job_id)
+        if job: job.update(fields); job["updated_at"] = time.time()
+
+def _prune_ingest_jobs():
+    """Drops the oldest finished jobs beyond INGEST_JOB_RETENTION. Caller holds ingest_jobs_lock."""
+    finished = sorted((j for j in ingest_jobs.values() if j["status"] in ('done', 'failed')), key=lambda j: j["updated_at"])
+    for job in finished[:max(0, len(finished) - app.config['INGEST_JOB_RETENTION'])]: ingest_jobs.pop(job["job_id"], None)
+
+def _run_ingest_job(job_id):
+    with ingest_jobs_lock: job = dict(ingest_jobs[job_id])
+    def progress(stage, done, total):
+        with ingest_jobs_lock:
+            j = ingest_jobs.get(job_id)
+            if not j: return
+            for name in INGEST_STAGES[:INGEST_STAGES.index(stage)]:
+                if j["stages"][name]["status"] != "done": j["stages"][name]["status"] = "done"
+            j["stage"] = stage; j["updated_at"] = time.time()
+            j["stages"][stage] = {"status": "done" if total and done >= total else "running", "done": done, "total": total}
+    trace = metrics.start_trace(job_id) # Ingestion log lines and spans carry the job id
+    try:
+        _update_ingest_job(job_id, status="running"); paper_catalog.update(job["paper_id"], status='processing')
+        logging.info(f"Ingest job {job_id} started for {job['paper_id']}.")
+        try: rag_success = process_pdf_for_rag(job["filepath"], job["paper_id"], progress=progress)
+        except Exception as e: logging.error(f"Ingest job {job_id} crashed: {e}", exc_info=True); rag_success = False
+        if rag_success:
+            _update_ingest_job(job_id, status="done", stage=None)
+            try: enforce_storage_quota(keep={job["paper_id"]})
+            except Exception as e: logging.error(f"Storage quota enforcement failed: {e}", exc_info=True)
+        else: _update_ingest_job(job_id, status="failed", error="RAG 處理失敗。"); paper_catalog.update(job["paper_id"], status='failed', error="RAG 處理失敗。")
+        logging.info(f"Ingest job {job_id} finished: {'done' if rag_success else 'failed'} ({trace.server_timing()}).")
+    finally: metrics.end_trace()
+
+def submit_ingest_job(paper_id, filename, filepath):
+    """Queues a PDF for background RAG processing. Returns the job dict, or None if the queue is full."""
+    job = _new_ingest_job(paper_id, filename, filepath)
+    with ingest_jobs_lock:
+        active = sum(1 for j in ingest_jobs.values() if j["status"] in ('queued', 'running'))
+        if active >= app.config['INGEST_QUEUE_SIZE']: return None
+        _prune_ingest_jobs()
+        ingest_jobs[job["job_id"]] = job
+    ingest_executor.submit(_run_ingest_job, job["job_id"])
+    return dict(job)
+
+def get_ingest_job(job_id):
+    """Returns a snapshot of an ingestion job, or None."""
+    with ingest_jobs_lock:
+        job = ingest_jobs.get(job_id)
+        if not job: return None
+        return {**job, "stages": {name: dict(stage) for name, stage in job["stages"].items()}}
+
+def safe_upload_name(name):
+    """Reduces an uploaded file name to [A-Za-z0-9._-] characters (the original-name part of '<paper_id>_<name>.pdf')."""
+    return "".join(c for c in os.path.basename(name) if c.isalnum() or c in ['.', '_', '-']).rstrip() or "paper.pdf"
+
+def split_upload_filename(filename):
+    """Splits '<paper_id>_<original name>.pdf' into (paper_id, original name); returns None if it doesn't match."""
+    if '_' not in filename or not filename.lower().endswith('.pdf'): return None
+    paper_id, original_name = filename.split('_', 1)
+    try: uuid.UUID(paper_id)
+    except ValueError: return None
+    return paper_id, original_name
+
 def find_pdf_path(paper_id):
-    """Finds PDF file path based on paper_id."""
+    """Finds PDF file path based on paper_id (catalog lookup)."""
     if not paper_id or not isinstance(paper_id, str): return None
     try: uuid.UUID(paper_id)
     except ValueError: logging.warning(f"Invalid paper_id format: {paper_id}"); return None
-    uploads_folder = app.config['UPLOAD_FOLDER']
     try:
-        for filename in os.listdir(uploads_folder):
-            if filename.startswith(paper_id + "_") and filename.lower().endswith('.pdf'):
-                full_path = os.path.join(uploads_folder, filename)
-                if os.path.isfile(full_path): return full_path
-        logging.warning(f"No PDF file found for ID: {paper_id} in {uploads_folder}")
+        entry = paper_catalog.get(paper_id)
+        if entry and entry.get('filename'):
+            full_path = os.path.join(app.config['UPLOAD_FOLDER'], entry['filename'])
+            if os.path.isfile(full_path): return full_path
+        logging.warning(f"No PDF file found for ID: {paper_id} in catalog")
     except Exception as e: logging.error(f"Error finding PDF for {paper_id}: {e}")
     return None
 
-def get_page_text(pdf_path, page_number):
-    """Extracts text from a specific page number (1-based)."""
-    if not pdf_path or not os.path.exists(pdf_path) or page_number < 1: return None
-    doc = None
+def rebuild_paper_catalog():
+    """
+    Rebuilds the paper catalog from uploads/ and the Chroma metadata (one scan of the shards).
+    Papers with chunks are 'ready'; uploaded files without chunks are 'failed'. Rows are upserted:
+    queued / processing papers are left to their ingestion job, last_read_at is kept, and only
+    finished entries with neither a file nor chunks are removed.
+    Returns the number of catalog entries written.
+    """
+    if not ensure_ai_components() or not chroma_client:
+        logging.error("Cannot rebuild catalog: Chroma client not available."); return 0
+    logging.info("Rebuilding paper catalog...")
+    with chroma_data_lock.read(): chunk_counts = count_paper_chunks()
+    files = {}
+    uploads_folder = app.config['UPLOAD_FOLDER']
+    for filename in sorted(os.listdir(uploads_folder)):
+        parts = split_upload_filename(filename)
+        if parts and parts[0] not in files and os.path.isfile(os.path.join(uploads_folder, filename)): files[parts[0]] = (filename, parts[1])
+    existing = {entry['paper_id']: entry for entry in paper_catalog.list(status=None)}
+    in_flight = {paper_id for paper_id, entry in existing.items() if entry['status'] in ('queued', 'processing')}
+    for paper_id in set(existing) - set(chunk_counts) - set(files) - in_flight: paper_catalog.delete(paper_id)
+    written = 0
+    for paper_id in set(chunk_counts) | set(files):
+        if paper_id in in_flight: continue
+        filename, display_name = files.get(paper_id, (None, f"Paper_{paper_id[:8]}"))
+        page_count = None; content_sha256 = None
+        if filename:
+            try: page_count = pdf_utils.get_page_count(os.path.join(uploads_folder, filename)); content_sha256 = pdf_utils.file_sha256(os.path.join(uploads_folder, filename))
+            except Exception as e: logging.warning(f"Cannot read page count for {filename}: {e}")
+        chunk_count = chunk_counts.get(paper_id, 0); previous = existing.get(paper_id) or {}
+        paper_catalog.upsert(paper_id, filename, display_name, status='ready' if chunk_count else 'failed', error=None if chunk_count else previous.get('error'),
+                             page_count=page_count, chunk_count=chunk_count, ingested_at=(previous.get('ingested_at') or time.time()) if chunk_count else None,
+                             storage_bytes=estimate_paper_storage(paper_id, filename, chunk_count), content_sha256=content_sha256)
+        written += 1
+    logging.info(f"Paper catalog rebuilt: {len(chunk_counts)} indexed papers, {len(files)} files, {len(in_flight)} in-flight entries kept.")
+    return written
+
+# Chunks in the legacy shared collection (or shards of another CHROMA_SHARDS) are moved on startup, before the catalog rebuild reads them.
+if chroma_client:
+    try: migrate_collections()
+    except Exception as e: logging.error(f"Legacy collection migration failed (retried on next start): {e}", exc_info=True)
+
+# Existing installs (uploads made before the catalog existed) are indexed once on startup.
+if paper_catalog.count() == 0 and any(split_upload_filename(f) for f in os.listdir(app.config['UPLOAD_FOLDER'])):
+    try: rebuild_paper_catalog()
+    except Exception as e: logging.error(f"Initial catalog rebuild failed: {e}", exc_info=True)
+
+def get_page_text(pdf_path, page_number, paper_id=None):
+    """
+    Extracts text from a specific page number (1-based).
+    Reads the pre-extracted page text store when available; otherwise uses a pooled open fitz document.
+    """
+    if page_number < 1: return None
+    if paper_id and os.path.exists(page_store_path(paper_id)):
+        try:
+            with page_store_pool.acquire(paper_id) as store:
+                if page_number > store.page_count: logging.warning(f"Page {page_number} out of bounds."); return None
+                text = store.get(page_number - 1)
+            logging.debug(f"Read stored text (len: {len(text)}) for page {page_number}.")
+            return text.strip()
+        except Exception as e: logging.error(f"Error reading page store for {paper_id}: {e}", exc_info=True) # Fall back to the PDF
+    if not pdf_path or not os.path.exists(pdf_path): return None
     try:
-        doc = fitz.open(pdf_path)
-        if page_number > doc.page_count: logging.warning(f"Page {page_number} out of bounds."); return None
-        page = doc.load_page(page_number - 1)
-        text = page.get_text("text")
-        logging.info(f"Extracted text (len: {len(text or '')}) from page {page_number}.")
+        with pdf_doc_pool.acquire(pdf_path) as doc:
+            if page_number > doc.page_count: logging.warning(f"Page {page_number} out of bounds."); return None
+            text = doc.load_page(page_number - 1).get_text("text")
+        logging.debug(f"Extracted text (len: {len(text or '')}) from page {page_number}.")
         return text.strip() if text else ""
     except Exception as e: logging.error(f"Error extracting text page {page_number}: {e}", exc_info=True); return None
-    finally:
-        if doc: doc.close()
 
 # --- Flask Routes ---
 
+@app.before_request
+def start_request_trace():
+    # Replaces the previous request's trace on this thread; not cleared on teardown, which runs before a streamed body is sent
+    g.trace = metrics.start_trace(request.headers.get('X-Request-ID')); g.request_started = time.perf_counter()
+
+@app.after_request
+def finish_request_trace(response):
+    """Records request metrics, adds X-Trace-Id / Server-Timing headers and logs one summary line per request."""
+    trace = g.get('trace')
+    if trace is None: return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_seconds.observe(elapsed, endpoint=endpoint, method=request.method)
+    requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if app.config['TRACE_HEADERS']:
+        response.headers['X-Trace-Id'] = trace.trace_id
+        if trace.spans: response.headers['Server-Timing'] = trace.server_timing()
+    if endpoint not in QUIET_ENDPOINTS:
+        logging.info(f"{request.method} {request.path} {response.status_code} in {elapsed * 1000:.1f} ms" + (f" ({trace.server_timing()})" if trace.spans else ""))
+    return response
+
+@metrics_registry.collector
+def collect_runtime_metrics():
+    """Cache, upstream limiter and ingest queue state, read at scrape time from the objects that already track it."""
+    lookups = []; coalesced = []
+    for name, cache in (('translation', translation_cache), ('analysis', analysis_cache)):
+        c = dict(cache.counters)
+        lookups += [({"cache": name, "result": "hit"}, c["memory_hits"] + c["disk_hits"]), ({"cache": name, "result": "miss"}, c["misses"])]
+        coalesced.append(({"cache": name}, c["coalesced"]))
+    tts = tts_cache.stats(); lookups += [({"cache": "tts", "result": "hit"}, tts["hits"]), ({"cache": "tts", "result": "miss"}, tts["misses"])]
+    if embedding_cache: lookups += [({"cache": "embeddings", "result": "hit"}, embedding_cache.hits), ({"cache": "embeddings", "result": "miss"}, embedding_cache.misses)]
+    if embeddings: lookups += [({"cache": "query_embeddings", "result": "hit"}, embeddings.query_hits), ({"cache": "query_embeddings", "result": "miss"}, embeddings.query_misses)]
+    limiters = {name: limiter.stats() for name, limiter in upstream_limiters.items()}
+    with ingest_jobs_lock: statuses = [job["status"] for job in ingest_jobs.values()]
+    return [
+        ('cache_lookups_total', 'counter', "Cache lookups by cache and result.", lookups),
+        ('cache_coalesced_total', 'counter', "Cache misses that shared an identical in-flight upstream call.", coalesced),
+        ('upstream_in_flight', 'gauge', "Upstream API calls holding a slot.", [({"upstream": n}, st["in_flight"]) for n, st in limiters.items()]),
+        ('upstream_waiting', 'gauge', "Calls waiting for an upstream slot.", [({"upstream": n}, st["waiting"]) for n, st in limiters.items()]),
+        ('upstream_rejected_total', 'counter', "Calls rejected (503) because an upstream stayed saturated.", [({"upstream": n}, st["rejected"]) for n, st in limiters.items()]),
+        ('ingest_jobs', 'gauge', "Ingestion jobs by status.", [({"status": status}, statuses.count(status)) for status in ('queued', 'running')]),
+    ]
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint: stage latencies, request counts, chunk / token / cache counters, upstream queues."""
+    return Response(metrics_registry.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/')
 def index():
     """Renders the main application page."""
@@ -172,25 +1317,28 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload_pdf():
-    """Handles PDF uploads and triggers RAG."""
+    """Handles PDF uploads and queues RAG processing in the background."""
     if 'pdf_file' not in request.files: return jsonify({"error": "請求中缺少檔案部分"}), 400
     file = request.files['pdf_file']
     if not file or not file.filename: return jsonify({"error": "未選擇檔案或檔名為空"}), 400
     if not allowed_file(file.filename): return jsonify({"error": "不允許的檔案類型"}), 400
 
     paper_id = str(uuid.uuid4())
-    original_filename = "".join(c for c in os.path.basename(file.filename) if c.isalnum() or c in ['.', '_', '-']).rstrip() or "paper.pdf"
+    original_filename = safe_upload_name(file.filename)
     filename = f"{paper_id}_{original_filename}"; filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     logging.info(f"Saving to: {filepath}")
     try:
-        file.save(filepath); logging.info("File saved.")
-        # Ensure components ready before processing
+        # Ensure components ready before accepting work
         if not ensure_ai_components(): return jsonify({"error": "AI 服務初始化失敗，無法處理檔案。"}), 503
-        rag_success = process_pdf_for_rag(filepath, paper_id)
-        status_code = 200 if rag_success else 500
-        message = "檔案上傳並處理完成！" if rag_success else "檔案已上傳，但 RAG 處理失敗。"
-        error_msg = None if rag_success else "RAG 處理失敗。"
-        return jsonify({"message": message, "error": error_msg, "filename": filename, "paper_id": paper_id, "filepath": f"/pdf/{filename}" }), status_code
+        file.save(filepath); logging.info("File saved.")
+        paper_catalog.add(paper_id, filename, original_filename, content_sha256=pdf_utils.file_sha256(filepath))
+        job = submit_ingest_job(paper_id, filename, filepath)
+        if not job:
+            logging.warning("Ingest queue full, rejecting upload.")
+            os.remove(filepath); paper_catalog.delete(paper_id)
+            return busy_response(None, "目前處理中的檔案過多，請稍後再試。")
+        return jsonify({"message": "檔案已上傳，正在背景處理。", "job_id": job["job_id"], "status": job["status"], "status_url": f"/upload_status/{job['job_id']}",
+                        "filename": filename, "paper_id": paper_id, "filepath": f"/pdf/{filename}" }), 202
     except Exception as e:
         logging.error(f"Upload/Processing error: {e}", exc_info=True)
         if os.path.exists(filepath): 
@@ -198,12 +1346,22 @@ def upload_pdf():
             except OSError as re: logging.error(f"Cleanup error: {re}")
         return jsonify({"error": "上傳過程中發生伺服器錯誤。"}), 500
 
+@app.route('/upload_status/<job_id>')
+def upload_status(job_id):
+    """Reports background ingestion progress per stage (extract / split / embed / persist)."""
+    job = get_ingest_job(job_id)
+    if not job: return jsonify({"error": "找不到此處理工作。"}), 404
+    job.pop("filepath", None)
+    return jsonify(job)
+
 
 @app.route('/pdf/<filename>')
 def serve_pdf(filename):
     """Serves the uploaded PDF file."""
     if '..' in filename or filename.startswith('/'): return "無效的檔名", 400
-    logging.info(f"Serving PDF: {filename}")
+    logging.debug(f"Serving PDF: {filename}")
+    parts = split_upload_filename(filename)
+    if parts: paper_catalog.touch(parts[0])
     try: return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=False)
     except FileNotFoundError: logging.warning(f"PDF not found: {filename}"); return "找不到檔案", 404
     except Exception as e: logging.error(f"Error serving PDF {filename}: {e}"); return "伺服器錯誤", 500
@@ -211,103 +1369,277 @@ def serve_pdf(filename):
 
 @app.route('/papers')
 def get_papers():
-    """Gets the list of processed papers."""
-    logging.info("Request received for paper list.")
-    # Ensure vectorstore is ready before querying
-    if not ensure_ai_components() or not vectorstore:
-        logging.error("Cannot get papers: Vectorstore not available.")
-        return jsonify([]), 503 # Return empty list and indicate service unavailable
-
-    papers = []; processed_paper_ids = set()
+    """Gets the list of processed papers from the catalog."""
     try:
-        logging.info("Querying ChromaDB metadata...")
-        results = vectorstore.get(include=["metadatas"])
-        if results and results.get('metadatas'):
-            all_metadata = results['metadatas']; logging.info(f"Retrieved {len(all_metadata)} metadata entries.")
-            for meta in all_metadata:
-                if isinstance(meta, dict) and 'paper_id' in meta and isinstance(meta['paper_id'], str):
-                    processed_paper_ids.add(meta['paper_id'])
-            logging.info(f"Found distinct paper IDs: {processed_paper_ids}")
-        else: logging.info("No metadata found in ChromaDB.")
-
-        if processed_paper_ids:
-            paper_id_to_filename = {}; uploads_folder = app.config['UPLOAD_FOLDER']
-            logging.info(f"Scanning uploads folder: {uploads_folder}")
-            try:
-                all_files = os.listdir(uploads_folder); logging.info(f"Files found: {all_files[:20]}...") # Log first few
-                for f in all_files:
-                     if '_' in f and f.lower().endswith('.pdf'):
-                        try: paper_id_part = f.split('_')[0]; uuid.UUID(paper_id_part)
-                        except (ValueError, IndexError): continue
-                        if paper_id_part in processed_paper_ids and paper_id_part not in paper_id_to_filename:
-                             original_name = f.split('_', 1)[1] if len(f.split('_', 1)) > 1 else f
-                             paper_id_to_filename[paper_id_part] = original_name
-            except Exception as list_err: logging.error(f"Error scanning uploads: {list_err}")
-
-            for paper_id in processed_paper_ids:
-                 display_name = paper_id_to_filename.get(paper_id, f"Paper_{paper_id[:8]}")
-                 papers.append({ "paper_id": paper_id, "display_name": display_name })
-                 if paper_id not in paper_id_to_filename: logging.warning(f"No filename match for ID: {paper_id}")
-            papers.sort(key=lambda x: x['display_name']); logging.info(f"Constructed paper list: {len(papers)} items.")
-        else: logging.info("No processed paper IDs found from metadata.")
-    except Exception as e: logging.error(f"Error retrieving paper list: {e}", exc_info=True);
-    return jsonify(papers) # Return potentially empty list
+        papers = [{"paper_id": p["paper_id"], "display_name": p["display_name"], "page_count": p["page_count"], "chunk_count": p["chunk_count"]}
+                  for p in paper_catalog.list(status='ready')]
+        logging.debug(f"Paper list: {len(papers)} items.")
+        return jsonify(papers)
+    except Exception as e:
+        logging.error(f"Error retrieving paper list: {e}", exc_info=True)
+        return jsonify([]), 500
+
+@app.route('/papers/rebuild', methods=['POST'])
+def rebuild_papers():
+    """Rebuilds the paper catalog from uploads/ and the Chroma data."""
+    try: count = rebuild_paper_catalog()
+    except Exception as e: logging.error(f"Catalog rebuild error: {e}", exc_info=True); return jsonify({"error": "重建論文目錄時發生錯誤。"}), 500
+    return jsonify({"message": f"論文目錄已重建（{count} 筆）。", "count": count})
+
+@app.route('/papers/<paper_id>', methods=['DELETE'])
+def delete_paper_route(paper_id):
+    """Deletes one paper (Chroma chunks, PDF, page text store, lexical chunks, catalog entry)."""
+    try: uuid.UUID(paper_id)
+    except ValueError: return jsonify({"error": "無效的論文 ID。"}), 400
+    if not ensure_ai_components() or not chroma_client: return jsonify({"error": "向量庫服務未就緒。"}), 503
+    entry = paper_catalog.get(paper_id)
+    if entry and entry['status'] in ('queued', 'processing'): return jsonify({"error": "論文仍在處理中，請稍後再刪除。"}), 409
+    with chroma_data_lock.read():
+        if not entry and not get_paper_vectorstore(paper_id).get(where={"paper_id": paper_id}, limit=1, include=[]).get('ids'):
+            return jsonify({"error": "找不到此論文。"}), 404
+        errors = delete_paper(paper_id)
+    if errors: return jsonify({"error": "刪除論文時發生錯誤。", "details": errors}), 500
+    return jsonify({"message": "論文已刪除。", "paper_id": paper_id})
+
+
+# --- Chat Context Packing ---
+token_counter = context_packer.TokenCounter(app.config['CONTEXT_TOKEN_ENCODING'])
+RAG_CONTEXT_HEADER = "**相關文件片段 (供參考):**\n"
+
+def format_page_context(page_num, page_text):
+    return f"目前頁面 (頁 {page_num}) 內容:\n\"\"\"\n{page_text or '(無法提取內容)'}\n\"\"\""
 
+def format_rag_context(texts):
+    if not texts: return "(文件中未找到相關片段)"
+    return RAG_CONTEXT_HEADER + "\n\n".join(f"--- 文件片段 {i+1} ---\n{text}" for i, text in enumerate(texts))
+
+def build_chat_prompt(context_mode, paper_id, page_num, page_context, rag_context, user_message):
+    """Fills the page-priority or document-priority chat prompt."""
+    if context_mode == 'page':
+        return f"""用戶正在閱讀論文（ID: {paper_id}）的第 {page_num or '?'} 頁。請根據以下資訊回答用戶的問題。請"優先"參考「目前頁面內容」，如果頁面內容不足或問題較廣泛，則參考「相關文件片段」以獲得更完整的上下文來回答。\n\n{page_context if page_context else '(無當前頁面內容)'}\n\n{rag_context}\n\n---\n用戶問題: {user_message}\n---\n\n回答 (請使用繁體中文，並適當使用 Markdown):"""
+    return f"""用戶正在閱讀論文（ID: {paper_id}）。請"主要"根據以下從整篇論文中檢索到的相關片段來回答用戶的問題。除非問題明確指涉特定頁碼但片段未提及，否則應基於這些片段回答。\n\n{rag_context}\n\n---\n用戶問題: {user_message}\n---\n\n回答 (請使用繁體中文，並適當使用 Markdown):"""
+
+def fit_page_context(page_context, page_text, page_num, budget):
+    """Cuts the page text if the page context alone exceeds budget tokens. Returns (page_context, page_text)."""
+    if page_text and token_counter.count(page_context) > budget:
+        page_text = token_counter.truncate(page_text, max(0, budget - token_counter.count(format_page_context(page_num, " …")))) + " …"
+        page_context = format_page_context(page_num, page_text)
+    return page_context, page_text
+
+def pack_chat_context(chunks, page_context, page_text, page_num):
+    """
+    Fits the page text and retrieved chunks [(text, metadata)] into CONTEXT_TOKEN_BUDGET. The page text
+    goes first (cut if it alone exceeds the budget); chunks it already contains are dropped, adjacent
+    chunks are merged into spans, and spans fill the rest of the budget in relevance order.
+    Returns (page_context, rag_context, spans, stats).
+    """
+    budget = app.config['CONTEXT_TOKEN_BUDGET']
+    page_context, page_text = fit_page_context(page_context, page_text, page_num, budget)
+    remaining = budget - token_counter.count(page_context) - token_counter.count(RAG_CONTEXT_HEADER)
+    packed = context_packer.pack_context(chunks, token_counter, remaining, page_text=page_text,
+                                         span_overhead_tokens=token_counter.count(f"--- 文件片段 {len(chunks)} ---\n\n\n"))
+    spans = packed["spans"]
+    if spans: rag_context = format_rag_context([span.text for span in spans])
+    elif packed["over_budget"]: rag_context = "(已達上下文長度上限，未加入其他文件片段)"
+    elif packed["covered"]: rag_context = "(相關文件片段皆已包含在目前頁面內容中)"
+    else: rag_context = format_rag_context([])
+    stats = {"context_budget": budget, "covered_chunks": packed["covered"], "merged_chunks": packed["merged"], "over_budget_spans": packed["over_budget"]}
+    return page_context, rag_context, spans, stats
+
+def prepare_chat(data):
+    """
+    Validates a chat request and builds the LLM prompt (page context + RAG).
+    Returns a dict with either 'error' (message, status), 'reply' (a canned answer, sent without
+    an LLM call) or 'prompt' plus 'sources' (retrieved span metadata) and 'timings'; replies and
+    prompts both carry 'prompt_tokens' (prompt size before / after context packing).
+    """
+    user_message = data.get('message'); paper_id = data.get('paper_id'); current_page_num_str = data.get('currentPageNum')
+    context_mode = data.get('context_mode', 'page');
+    if context_mode not in ['page', 'document']: context_mode = 'page'
+    if not user_message: return {"error": ("沒有訊息內容", 400)}
+    logging.debug(f"Chat req. Paper: {paper_id}, Page: {current_page_num_str}, Mode: {context_mode}, Msg: '{user_message[:50]}...'")
+    if not paper_id: # --- General Chat ---
+        tokens = token_counter.count(user_message)
+        prompt_tokens_total.inc(tokens, stage='before_packing'); prompt_tokens_total.inc(tokens, stage='after_packing')
+        return {"prompt": user_message, "sources": [], "timings": {}, "prompt_tokens": {"before": tokens, "after": tokens, "exact": token_counter.exact}}
+    # --- Paper-Specific Chat ---
+    pdf_path = find_pdf_path(paper_id)
+    if not pdf_path:
+        logging.warning(f"PDF not found: {paper_id}")
+        return {"reply": f"錯誤：找不到論文 ID '{paper_id}' 的文件。", "prompt_tokens": {"before": 0, "after": 0, "exact": token_counter.exact}}
+    paper_catalog.touch(paper_id) # Storage quota evicts least-recently-read papers first
+    timings = {}; sources = []; retrieval_mode = None
+    page_context = ""; page_text = None; rag_context = ""; raw_rag_context = ""; current_page_num = None; packing = {}
+    # Get Page Context ONLY if mode is 'page'
+    with span('page_text') as page_span:
+        if context_mode == 'page':
+            if current_page_num_str is not None:
+                try: current_page_num = int(current_page_num_str);
+                except (ValueError, TypeError): logging.warning(f"Invalid page num: {current_page_num_str}"); page_context = "(頁碼無效)"
+                else:
+                     if current_page_num < 1: logging.warning(f"Page num < 1: {current_page_num}"); page_context = "(頁碼無效)"; current_page_num = None
+            if current_page_num: page_text = get_page_text(pdf_path, current_page_num, paper_id=paper_id); page_context = format_page_context(current_page_num, page_text)
+            elif current_page_num is None and current_page_num_str is not None: pass
+            else: page_context = "(未提供當前頁碼資訊)"
+    timings["page_text_ms"] = page_span.ms; unpacked_page_context = page_context
+    # Get RAG Context
+    packing_span = None
+    try:
+        with span('retrieval') as retrieval_span: relevant_docs, retrieval_mode = retrieve_chunks(paper_id, user_message)
+        logging.debug(f"RAG got {len(relevant_docs)} docs ({retrieval_mode}).")
+        retrievals_total.inc(mode=retrieval_mode); retrieved_chunks_total.inc(len(relevant_docs))
+        with span('context_packing') as packing_span:
+            chunks = [(doc.page_content, doc.metadata or {}) for doc in relevant_docs]
+            raw_rag_context = format_rag_context([text for text, _ in chunks]) # As retrieved, for the before-packing token count
+            if app.config['CONTEXT_PACKING']:
+                page_context, rag_context, spans, packing = pack_chat_context(chunks, page_context, page_text if context_mode == 'page' else None, current_page_num)
+                sources = [{"index": i + 1, "page": packed.pages[0] + 1 if packed.pages else None, "pages": [p + 1 for p in packed.pages], "chunks": len(packed.chunk_indices) or 1,
+                            "tokens": packed.tokens, "preview": packed.text[:120]} for i, packed in enumerate(spans)]
+            else:
+                rag_context = raw_rag_context
+                sources = [{"index": i + 1, "page": meta.get('page') + 1 if isinstance(meta.get('page'), int) else None, "preview": text[:120]}
+                           for i, (text, meta) in enumerate(chunks)]
+    except UpstreamBusy: raise # 503 + Retry-After rather than an answer without document context
+    except Exception as rag_e: logging.error(f"RAG error: {rag_e}", exc_info=True); rag_context = "(檢索文件片段時出錯)"
+    timings["retrieval_ms"] = retrieval_span.ms
+    if packing_span: timings["context_packing_ms"] = packing_span.ms
+    if not packing and context_mode == 'page': # Packing is off or retrieval failed: the page text alone still has to fit the budget
+        page_context, _ = fit_page_context(page_context, page_text, current_page_num, app.config['CONTEXT_TOKEN_BUDGET'])
+        packing = {"context_budget": app.config['CONTEXT_TOKEN_BUDGET']}
+    # Construct Prompt based on context_mode
+    with span('prompt_build') as prompt_span:
+        prompt = build_chat_prompt(context_mode, paper_id, current_page_num, page_context, rag_context, user_message)
+        prompt_tokens = {"before": token_counter.count(build_chat_prompt(context_mode, paper_id, current_page_num, unpacked_page_context, raw_rag_context or rag_context, user_message)),
+                         "after": token_counter.count(prompt), "exact": token_counter.exact, **packing}
+    timings["prompt_build_ms"] = prompt_span.ms
+    prompt_tokens_total.inc(prompt_tokens["before"], stage='before_packing'); prompt_tokens_total.inc(prompt_tokens["after"], stage='after_packing')
+    logging.debug(f"Prompt tokens: {prompt_tokens}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG): logging.debug(f"Final Prompt for LLM:\n{prompt}")
+    return {"prompt": prompt, "sources": sources, "timings": timings, "context_mode": context_mode, "page": current_page_num, "retrieval_mode": retrieval_mode,
+            "prompt_tokens": prompt_tokens}
 
 @app.route('/chat', methods=['POST'])
 def handle_chat():
     """Handles chat requests, incorporating context mode, page context, and RAG."""
     # Ensure components are ready
-    if not ensure_ai_components() or not llm or not vectorstore:
+    if not ensure_ai_components() or not llm or not chroma_client:
          return jsonify({"error":"AI服務暫時無法處理您的請求。"}), 503
 
     data = request.get_json(); 
     if not data: return jsonify({"error": "無效的請求"}), 400
-    user_message = data.get('message'); paper_id = data.get('paper_id'); current_page_num_str = data.get('currentPageNum')
-    context_mode = data.get('context_mode', 'page');
-    if context_mode not in ['page', 'document']: context_mode = 'page'
-    if not user_message: return jsonify({"error": "沒有訊息內容"}), 400
-    logging.info(f"Chat req. Paper: {paper_id}, Page: {current_page_num_str}, Mode: {context_mode}, Msg: '{user_message[:50]}...'")
     try:
-        if paper_id: # --- Paper-Specific Chat ---
-            pdf_path = find_pdf_path(paper_id)
-            if not pdf_path: logging.warning(f"PDF not found: {paper_id}"); return jsonify({"reply": f"錯誤：找不到論文 ID '{paper_id}' 的文件。"})
-            page_context = ""; rag_context = ""; current_page_num = None
-            # Get Page Context ONLY if mode is 'page'
-            if context_mode == 'page':
-                logging.info("Context Mode: page - getting page text.")
-                if current_page_num_str is not None:
-                    try: current_page_num = int(current_page_num_str);
-                    except (ValueError, TypeError): logging.warning(f"Invalid page num: {current_page_num_str}"); page_context = "(頁碼無效)"
-                    else:
-                         if current_page_num < 1: logging.warning(f"Page num < 1: {current_page_num}"); page_context = "(頁碼無效)"; current_page_num = None
-                if current_page_num: page_text = get_page_text(pdf_path, current_page_num); page_context = f"目前頁面 (頁 {current_page_num}) 內容:\n\"\"\"\n{page_text or '(無法提取內容)'}\n\"\"\""
-                elif current_page_num is None and current_page_num_str is not None: pass
-                else: page_context = "(未提供當前頁碼資訊)"
-            else: logging.info("Context Mode: document - skipping page text extraction.")
-            # Get RAG Context
-            try:
-                logging.info(f"RAG query for {paper_id}..."); retriever = vectorstore.as_retriever(search_kwargs={'filter': {'paper_id': paper_id}, 'k': 10}) # Using k=6 as per user's change
-                relevant_docs = retriever.invoke(user_message); logging.info(f"RAG got {len(relevant_docs)} docs.")
-                if relevant_docs: rag_context_list = [f"--- 文件片段 {i+1} ---\n{doc.page_content}" for i, doc in enumerate(relevant_docs)]; rag_context = "**相關文件片段 (供參考):**\n" + "\n\n".join(rag_context_list)
-                else: rag_context = "(文件中未找到相關片段)"
-            except Exception as rag_e: logging.error(f"RAG error: {rag_e}", exc_info=True); rag_context = "(檢索文件片段時出錯)"
-            # Construct Prompt based on context_mode
-            if context_mode == 'page':
-                logging.info("Constructing prompt with PAGE context priority.")
-                prompt = f"""用戶正在閱讀論文（ID: {paper_id}）的第 {current_page_num or '?'} 頁。請根據以下資訊回答用戶的問題。請"優先"參考「目前頁面內容」，如果頁面內容不足或問題較廣泛，則參考「相關文件片段」以獲得更完整的上下文來回答。\n\n{page_context if page_context else '(無當前頁面內容)'}\n\n{rag_context}\n\n---\n用戶問題: {user_message}\n---\n\n回答 (請使用繁體中文，並適當使用 Markdown):"""
-            else: # context_mode == 'document'
-                logging.info("Constructing prompt with DOCUMENT context priority.")
-                prompt = f"""用戶正在閱讀論文（ID: {paper_id}）。請"主要"根據以下從整篇論文中檢索到的相關片段來回答用戶的問題。除非問題明確指涉特定頁碼但片段未提及，否則應基於這些片段回答。\n\n{rag_context}\n\n---\n用戶問題: {user_message}\n---\n\n回答 (請使用繁體中文，並適當使用 Markdown):"""
-            logging.debug(f"Final Prompt for LLM:\n{prompt}")
-            response = llm.invoke(prompt); response_message = response.content if hasattr(response, 'content') else str(response)
-        else: # --- General Chat ---
-            logging.info(f"General chat."); response = llm.invoke(user_message)
-            response_message = response.content if hasattr(response, 'content') else str(response)
-        return jsonify({"reply": response_message})
+        chat = prepare_chat(data)
+        if "error" in chat: return jsonify({"error": chat["error"][0]}), chat["error"][1]
+        if "reply" in chat: return jsonify({"reply": chat["reply"], "prompt_tokens": chat.get("prompt_tokens")})
+        response_message = invoke_llm(chat["prompt"])
+        return jsonify({"reply": response_message, "prompt_tokens": chat.get("prompt_tokens")})
+    except UpstreamBusy as e: return busy_response(e)
     except APIError as e: logging.error(f"Chat API Error: {e}", exc_info=True); status = e.status_code if hasattr(e, 'status_code') else 500; return jsonify({"error": f"AI請求失敗:{e.code}"}), status
     except Exception as e: logging.error(f"Chat error: {e}", exc_info=True); return jsonify({"error": "處理訊息時發生伺服器錯誤。"}), 500
 
+def sse_event(event, payload):
+    """Formats one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def handle_chat_stream():
+    """
+    Streaming variant of /chat over Server-Sent Events.
+    Events: 'retrieval' (chunks used, prompt tokens before / after packing), 'token' (answer text deltas), 'done' (timings, trace id) or 'error'.
+    """
+    if not ensure_ai_components() or not llm or not chroma_client:
+         return jsonify({"error":"AI服務暫時無法處理您的請求。"}), 503
+    data = request.get_json(); 
+    if not data: return jsonify({"error": "無效的請求"}), 400
+    request_started = time.perf_counter(); trace = metrics.current_trace()
+    try: chat = prepare_chat(data)
+    except UpstreamBusy as e: return busy_response(e)
+    except Exception as e: logging.error(f"Chat error: {e}", exc_info=True); return jsonify({"error": "處理訊息時發生伺服器錯誤。"}), 500
+    if "error" in chat: return jsonify({"error": chat["error"][0]}), chat["error"][1]
+    chat_limiter = upstream_limiters['chat'] if "reply" not in chat else None
+    if chat_limiter: # Held for the whole stream, released when the response is closed
+        try: chat_limiter.acquire()
+        except UpstreamBusy as e: return busy_response(e)
+
+    def generate():
+        timings = dict(chat.get("timings", {}))
+        yield sse_event("retrieval", {"sources": chat.get("sources", []), "context_mode": chat.get("context_mode"), "page": chat.get("page"),
+                                      "retrieval_mode": chat.get("retrieval_mode"), "prompt_tokens": chat.get("prompt_tokens"), "timings": dict(timings)})
+        if "reply" in chat:
+            yield sse_event("token", {"text": chat["reply"]})
+        else:
+            first_token = None
+            with span('llm') as llm_span:
+                try:
+                    for piece in llm.stream(chat["prompt"]):
+                        text = piece.content if hasattr(piece, 'content') else str(piece)
+                        if not text: continue
+                        if first_token is None:
+                            first_token = time.perf_counter(); stage_seconds.observe(first_token - llm_span.started, stage='llm_first_token')
+                            timings["llm_first_token_ms"] = round((first_token - llm_span.started) * 1000, 1)
+                            timings["time_to_first_token_ms"] = round((first_token - request_started) * 1000, 1)
+                        yield sse_event("token", {"text": text})
+                except APIError as e:
+                    logging.error(f"Chat stream API Error: {e}", exc_info=True); yield sse_event("error", {"error": f"AI請求失敗:{e.code}"}); return
+                except Exception as e:
+                    logging.error(f"Chat stream error: {e}", exc_info=True); yield sse_event("error", {"error": "處理訊息時發生伺服器錯誤。"}); return
+            timings["llm_ms"] = llm_span.ms
+        timings["total_ms"] = round((time.perf_counter() - request_started) * 1000, 1)
+        logging.info(f"Chat stream finished: {timings}")
+        yield sse_event("done", {"timings": timings, "trace_id": trace.trace_id if trace else None})
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}) # Disable proxy buffering
+    if chat_limiter: response.call_on_close(chat_limiter.release)
+    return response
+
+TRANSLATION_PROMPT_VERSION = 1 # Bump when the translation prompts change to invalidate cached results
+
+def translation_cache_key(text, target_language):
+    return TextResultCache.make_key('translate', TRANSLATION_PROMPT_VERSION, LLM_MODEL_NAME, target_language, normalize_chunk_text(text))
+
+def clean_translation(text):
+    return text.strip().strip('"').strip("'").strip()
+
+def translate_uncached(text, target_language):
+    """Translates one text with the LLM (no cache)."""
+    prompt = f"請將以下文字翻譯成{target_language}。僅輸出翻譯後的文字，不要添加任何額外的引號或說明。\n\n原文:\n'''\n{text}\n'''\n\n翻譯:"
+    return clean_translation(invoke_llm(prompt))
+
+def translate_batch_uncached(texts, target_language):
+    """Translates several short texts in one LLM call; falls back to one call per text if the reply can't be parsed."""
+    if len(texts) == 1: return [translate_uncached(texts[0], target_language)]
+    prompt = (f"請將以下 JSON 陣列中的每一段文字分別翻譯成{target_language}。僅輸出一個長度相同、順序相同的 JSON 字串陣列，不要添加任何說明。\n\n"
+              f"原文:\n{json.dumps(texts, ensure_ascii=False)}\n\n翻譯:")
+    content = invoke_llm(prompt)
+    try:
+        content = content.strip()
+        if content.startswith("```"): content = content.strip('`').split('\n', 1)[1] if '\n' in content else content.strip('`')
+        translations = json.loads(content)
+        if isinstance(translations, list) and len(translations) == len(texts) and all(isinstance(t, str) for t in translations):
+            return [clean_translation(t) for t in translations]
+    except ValueError: pass
+    logging.warning(f"Batch translation reply unparseable, translating {len(texts)} texts individually.")
+    return [translate_uncached(text, target_language) for text in texts]
+
+def translate_miss(key, text, target_language):
+    """Translates a cache miss and caches it; concurrent identical misses share one LLM call. Returns (translation, shared)."""
+    def compute():
+        result = translate_uncached(text, target_language); translation_cache.put(key, result); return result
+    translation, shared = translation_flights.do(key, compute)
+    if shared: translation_cache.record("coalesced")
+    return translation, shared
+
+def translate_cached(text, target_language):
+    """Translates with the two-tier cache; concurrent identical requests share one LLM call. Returns (translation, cache_tier)."""
+    started = time.perf_counter()
+    key = translation_cache_key(text, target_language)
+    translation, tier = translation_cache.get(key)
+    if tier: translation_cache.record("hit_seconds", time.perf_counter() - started); return translation, tier
+    translation, shared = translate_miss(key, text, target_language)
+    translation_cache.record("miss_seconds", time.perf_counter() - started)
+    return translation, 'inflight' if shared else None
+
 @app.route('/translate', methods=['POST'])
 def translate_text():
     if not ensure_ai_components() or not llm: return jsonify({"error":"AI服務暫時無法處理翻譯。"}), 503
@@ -315,84 +1647,310 @@ def translate_text():
     if not data or 'text' not in data: return jsonify({"error": "未提供需翻譯的文本。"}), 400
     text_to_translate = data['text']; 
     if not text_to_translate.strip(): return jsonify({"error": "翻譯文本不能為空。"}), 400
-    target_language = "繁體中文"; logging.info(f"Translate req: '{text_to_translate[:50]}...' to {target_language}")
-    try: prompt = f"請將以下文字翻譯成{target_language}。僅輸出翻譯後的文字，不要添加任何額外的引號或說明。\n\n原文:\n'''\n{text_to_translate}\n'''\n\n翻譯:"; response = llm.invoke(prompt); translation = response.content if hasattr(response, 'content') else str(response); translation = translation.strip().strip('"').strip("'").strip(); logging.info("Translate successful."); return jsonify({"translation": translation})
+    target_language = "繁體中文"; logging.debug(f"Translate req: '{text_to_translate[:50]}...' to {target_language}")
+    try: translation, cache_tier = translate_cached(text_to_translate, target_language); logging.debug(f"Translate successful (cache: {cache_tier})."); return jsonify({"translation": translation, "cache": cache_tier})
+    except UpstreamBusy as e: return busy_response(e)
+    except APIError as e: logging.error(f"Translate API Error: {e}", exc_info=True); status = e.status_code if hasattr(e, 'status_code') else 500; return jsonify({"error": f"翻譯失敗：{e.code} - API 錯誤。"}), status
+    except Exception as e: logging.error(f"Translate error: {e}", exc_info=True); return jsonify({"error": "翻譯時發生伺服器錯誤。"}), 500
+
+@app.route('/translate/batch', methods=['POST'])
+def translate_batch():
+    """
+    Translates a list of selections; short cache misses are combined into one LLM call. Misses go through
+    translation_flights like /translate, so a text already being translated elsewhere is waited for, not re-sent.
+    """
+    if not ensure_ai_components() or not llm: return jsonify({"error":"AI服務暫時無法處理翻譯。"}), 503
+    data = request.get_json()
+    texts = data.get('texts') if data else None
+    if not isinstance(texts, list) or not texts or not all(isinstance(t, str) and t.strip() for t in texts): return jsonify({"error": "未提供需翻譯的文本。"}), 400
+    if len(texts) > app.config['TRANSLATION_BATCH_MAX_ITEMS']: return jsonify({"error": f"一次最多翻譯 {app.config['TRANSLATION_BATCH_MAX_ITEMS']} 段文字。"}), 400
+    target_language = "繁體中文"; logging.debug(f"Batch translate req: {len(texts)} texts to {target_language}")
+    try:
+        started = time.perf_counter()
+        results = [None] * len(texts); tiers = [None] * len(texts); short_misses = {}; long_misses = {} # key -> (text, [indexes])
+        for i, text in enumerate(texts):
+            key = translation_cache_key(text, target_language)
+            translation, tier = translation_cache.get(key)
+            if tier: results[i] = translation; tiers[i] = tier
+            else: (short_misses if len(text) <= app.config['TRANSLATION_BATCH_MAX_CHARS'] else long_misses).setdefault(key, (text, []))[1].append(i)
+        translations = {}; shared = set()
+        for key, (text, _) in long_misses.items():
+            translations[key], key_shared = translate_miss(key, text, target_language)
+            if key_shared: shared.add(key)
+        if short_misses:
+            def compute(keys):
+                batch = translate_batch_uncached([short_misses[k][0] for k in keys], target_language)
+                for key, translation in zip(keys, batch): translation_cache.put(key, translation)
+                return dict(zip(keys, batch))
+            short_translations, short_shared = translation_flights.do_many(list(short_misses), compute)
+            translations.update(short_translations); shared |= short_shared
+            if short_shared: translation_cache.record("coalesced", len(short_shared))
+        missed = [(key, i) for misses in (short_misses, long_misses) for key, (_, indexes) in misses.items() for i in indexes]
+        for key, i in missed: results[i] = translations[key]; tiers[i] = 'inflight' if key in shared else None
+        if missed: translation_cache.record("miss_seconds", (time.perf_counter() - started) * len(missed)) # Each missed lookup waited this long
+        logging.debug(f"Batch translate done: {len(short_misses)} short misses in one LLM call, {len(long_misses)} long misses.")
+        return jsonify({"translations": results, "cache": tiers})
+    except UpstreamBusy as e: return busy_response(e)
     except APIError as e: logging.error(f"Translate API Error: {e}", exc_info=True); status = e.status_code if hasattr(e, 'status_code') else 500; return jsonify({"error": f"翻譯失敗：{e.code} - API 錯誤。"}), status
     except Exception as e: logging.error(f"Translate error: {e}", exc_info=True); return jsonify({"error": "翻譯時發生伺服器錯誤。"}), 500
 
+@app.route('/translate/stats')
+def translate_stats():
+    """Reports translation cache hit rate, latency and size."""
+    return jsonify(translation_cache.stats())
+
+ANALYSIS_PROMPT_VERSION = 1 # Bump when the analysis prompt changes to invalidate cached analyses
+
+def render_page_data_url(pdf_path, page_number):
+    """Renders a page (1-based) to a JPEG data URL at the configured DPI / quality; None if out of range."""
+    with span('page_render'), pdf_doc_pool.acquire(pdf_path) as doc:
+        if page_number > doc.page_count: return None
+        image = pdf_utils.render_page_jpeg(doc, page_number - 1, app.config['ANALYZE_PAGE_DPI'], app.config['ANALYZE_PAGE_JPEG_QUALITY'])
+    logging.debug(f"Rendered page {page_number} at {app.config['ANALYZE_PAGE_DPI']} DPI ({len(image)} bytes).")
+    return "data:image/jpeg;base64," + base64.b64encode(image).decode('ascii')
+
+def run_page_analysis(image_data_url, page_num):
+    """Sends a page image to the vision model. Returns the analysis text, or None if the reply has no content."""
+    prompt = f"分析此圖片（來自研究論文第 {page_num} 頁）中的學術內容（文字、表格、圖表、排版）。提供本頁關鍵資訊的簡潔摘要與解釋。請用繁體中文回答，並使用 Markdown 格式化回答以提高可讀性（例如使用列表、粗體）。"
+    logging.debug(f"Sending request to OpenAI Multimodal API ({VISION_MODEL_NAME})...")
+    with upstream_limiters['vision'].slot(), span('vision'): response = openai_client.chat.completions.create( model=VISION_MODEL_NAME, messages=[ { "role": "user", "content": [ {"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_data_url, "detail": app.config['ANALYZE_IMAGE_DETAIL']}}, ], } ], max_tokens=3000 )
+    if response.choices and response.choices[0].message and response.choices[0].message.content: logging.debug("Analysis received."); return response.choices[0].message.content
+    logging.error("API response missing content."); return None
+
+def analyze_paper_page(paper_id, pdf_path, page_num):
+    """Renders and analyzes a stored paper page, cached per (paper, page, model, prompt version, render settings). Returns (analysis, cache_tier)."""
+    key = TextResultCache.make_key('analyze', ANALYSIS_PROMPT_VERSION, VISION_MODEL_NAME, paper_id, page_num,
+                                   app.config['ANALYZE_PAGE_DPI'], app.config['ANALYZE_PAGE_JPEG_QUALITY'], app.config['ANALYZE_IMAGE_DETAIL'])
+    paper_catalog.touch(paper_id)
+    started = time.perf_counter()
+    analysis, tier = analysis_cache.get(key)
+    if tier: analysis_cache.record("hit_seconds", time.perf_counter() - started); return analysis, tier
+    def compute():
+        image_data_url = render_page_data_url(pdf_path, page_num)
+        if not image_data_url: return None
+        result = run_page_analysis(image_data_url, page_num)
+        if result: analysis_cache.put(key, result)
+        return result
+    analysis, shared = analysis_flights.do(key, compute)
+    if shared: analysis_cache.record("coalesced")
+    analysis_cache.record("miss_seconds", time.perf_counter() - started)
+    return analysis, 'inflight' if shared else None
+
 @app.route('/analyze_page', methods=['POST'])
 def analyze_page():
+    """
+    Analyzes a PDF page with the vision model.
+    Preferred: {paper_id, page_num} - the server renders the page itself and caches the result.
+    Legacy: {image_data, page_num} - a client-captured data URL (size-checked, not cached).
+    """
     if not ensure_ai_components() or not openai_client: return jsonify({"error":"AI服務暫時無法處理頁面分析。"}), 503
     data = request.get_json(); 
     if not data: return jsonify({"error": "無效的請求負載"}), 400
-    image_data_url = data.get('image_data'); page_num = data.get('page_num', '未知')
-    if not image_data_url or not image_data_url.startswith('data:image'): return jsonify({"error": "無效的圖像數據格式"}), 400
-    logging.info(f"Analyze page {page_num}. Image length: {len(image_data_url)}")
-    prompt = f"分析此圖片（來自研究論文第 {page_num} 頁）中的學術內容（文字、表格、圖表、排版）。提供本頁關鍵資訊的簡潔摘要與解釋。請用繁體中文回答，並使用 Markdown 格式化回答以提高可讀性（例如使用列表、粗體）。"
-    try: logging.info(f"Sending request to OpenAI Multimodal API ({VISION_MODEL_NAME})..."); response = openai_client.chat.completions.create( model=VISION_MODEL_NAME, messages=[ { "role": "user", "content": [ {"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_data_url, "detail": "auto"}}, ], } ], max_tokens=3000 )
+    paper_id = data.get('paper_id'); page_num = data.get('page_num', '未知')
+    try:
+        if paper_id:
+            try: page_num = int(page_num)
+            except (ValueError, TypeError): return jsonify({"error": "無效的頁碼"}), 400
+            if page_num < 1: return jsonify({"error": "無效的頁碼"}), 400
+            pdf_path = find_pdf_path(paper_id)
+            if not pdf_path: return jsonify({"error": f"找不到論文 ID '{paper_id}' 的文件。"}), 404
+            page_count = (paper_catalog.get(paper_id) or {}).get('page_count')
+            if page_count and page_num > page_count: return jsonify({"error": "頁碼超出範圍"}), 400
+            logging.debug(f"Analyze page {page_num} of {paper_id} (server-rendered).")
+            analysis_text, cache_tier = analyze_paper_page(paper_id, pdf_path, page_num)
+        else:
+            image_data_url = data.get('image_data')
+            if not image_data_url or not image_data_url.startswith('data:image'): return jsonify({"error": "無效的圖像數據格式"}), 400
+            if len(image_data_url) > app.config['ANALYZE_MAX_IMAGE_BYTES']: return jsonify({"error": "圖像過大，請改用伺服器端頁面渲染。"}), 413
+            logging.debug(f"Analyze page {page_num}. Image length: {len(image_data_url)}")
+            analysis_text = run_page_analysis(image_data_url, page_num); cache_tier = None
+    except UpstreamBusy as e: return busy_response(e)
     except APIError as e: logging.error(f"Analyze API Error: {e}", exc_info=True); status = e.status_code if hasattr(e, 'status_code') else 500; return jsonify({"error": f"AI 分析失敗：{e.code} - API 錯誤。"}), status
     except Exception as e: logging.error(f"Vision API error: {e}", exc_info=True); return jsonify({"error": "使用 AI 分析頁面時發生伺服器錯誤。"}), 500
-    if response.choices and response.choices[0].message and response.choices[0].message.content: analysis_text = response.choices[0].message.content; logging.info("Analysis received."); return jsonify({"analysis": analysis_text})
-    else: logging.error("API response missing content."); return jsonify({"error": "AI 分析回覆內容無效。"}), 500
+    if analysis_text: return jsonify({"analysis": analysis_text, "cache": cache_tier})
+    else: return jsonify({"error": "AI 分析回覆內容無效。"}), 500
+
+def trim_silence(audio_bytes, extension):
+    """
+    Drops leading, trailing and long internal silences from a recording (voice-activity trimming).
+    Returns (audio_bytes, extension); the input is returned unchanged if pydub/ffmpeg is unavailable,
+    nothing is voiced, or trimming doesn't make the upload smaller.
+    """
+    try:
+        from pydub import AudioSegment
+        from pydub.silence import detect_nonsilent
+    except ImportError:
+        logging.warning("TRANSCRIBE_TRIM_SILENCE is on but pydub is not installed; sending audio untrimmed."); return audio_bytes, extension
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=extension)
+        pad = app.config['TRANSCRIBE_SILENCE_PAD_MS']
+        voiced = detect_nonsilent(audio, min_silence_len=app.config['TRANSCRIBE_SILENCE_MIN_MS'], silence_thresh=audio.dBFS + app.config['TRANSCRIBE_SILENCE_THRESH_DB'])
+        if not voiced: logging.info("No voiced audio detected; sending untrimmed."); return audio_bytes, extension
+        trimmed = sum((audio[max(0, start - pad):min(len(audio), end + pad)] for start, end in voiced), AudioSegment.empty())
+        out = io.BytesIO()
+        if extension == 'wav': trimmed.export(out, format='wav'); trimmed_extension = 'wav' # Pure Python, no ffmpeg needed
+        else: trimmed.export(out, format='ogg', codec='libopus', bitrate='32k'); trimmed_extension = 'ogg'
+        data = out.getvalue()
+        logging.info(f"Silence trimming: {len(audio)} ms -> {len(trimmed)} ms, {len(audio_bytes)} -> {len(data)} bytes.")
+        return (data, trimmed_extension) if len(data) < len(audio_bytes) else (audio_bytes, extension)
+    except Exception as e:
+        logging.warning(f"Silence trimming failed, sending audio untrimmed: {e}"); return audio_bytes, extension
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe_audio():
+    """Transcribes an uploaded recording with Whisper; the audio stays in memory (no temp files)."""
     if not ensure_ai_components() or not openai_client: return jsonify({"error":"AI服務暫時無法處理語音辨識。"}), 503
+    max_bytes = app.config['TRANSCRIBE_MAX_BYTES']
+    request.max_content_length = max_bytes + 64 * 1024 # 64 KiB for form overhead; also bounds bodies sent without Content-Length
+    if (request.content_length or 0) > request.max_content_length: return jsonify({"error": "音訊檔案過大。"}), 413 # Rejected before the multipart body is parsed
     if 'audio_blob' not in request.files: return jsonify({"error": "請求中缺少音訊檔案"}), 400
     audio_file = request.files['audio_blob']; 
     if not audio_file or not audio_file.filename: return jsonify({"error": "未選擇音訊檔案或檔名無效"}), 400
-    safe_filename = "".join(c for c in os.path.basename(audio_file.filename) if c.isalnum() or c in ['.', '_', '-']).rstrip() or "upload.tmp"; temp_filename = os.path.join(app.config['TEMP_FOLDER'], f"{uuid.uuid4()}_{safe_filename}")
-    try: audio_file.save(temp_filename); logging.info(f"Temp audio saved: {temp_filename}");
-    except Exception as save_e: logging.error(f"Failed save temp audio: {save_e}"); return jsonify({"error": "無法儲存音訊檔案。"}), 500
+    safe_filename = "".join(c for c in os.path.basename(audio_file.filename) if c.isalnum() or c in ['.', '_', '-']).rstrip() or "upload.webm"
+    audio_bytes = audio_file.read(max_bytes + 1) # One byte past the limit is enough to tell it is too large
+    if not audio_bytes: return jsonify({"error": "音訊檔案為空。"}), 400
+    if len(audio_bytes) > max_bytes: return jsonify({"error": "音訊檔案過大。"}), 413
+    extension = safe_filename.rsplit('.', 1)[1].lower() if '.' in safe_filename else 'webm'
+    whisper_limiter = upstream_limiters['whisper']
+    try: whisper_limiter.acquire()
+    except UpstreamBusy as e: return busy_response(e, "語音辨識忙碌中，請稍後再試。")
     try:
-        with open(temp_filename, "rb") as audio_data: logging.info("Sending to Whisper API with 'zh' hint..."); transcription = openai_client.audio.transcriptions.create( model="whisper-1", file=audio_data, language="zh" )
-        logging.info("Transcription received."); transcribed_text = transcription.text if hasattr(transcription, 'text') else ''; logging.info(f"Whisper result: '{transcribed_text}'")
+        if app.config['TRANSCRIBE_TRIM_SILENCE']:
+            with span('silence_trim'): audio_bytes, extension = trim_silence(audio_bytes, extension)
+        upload_name = f"{safe_filename.rsplit('.', 1)[0]}.{extension}"
+        logging.debug(f"Sending {len(audio_bytes)} bytes to Whisper API with 'zh' hint...")
+        with span('whisper'): transcription = openai_client.audio.transcriptions.create( model="whisper-1", file=(upload_name, audio_bytes), language="zh" )
+        transcribed_text = transcription.text if hasattr(transcription, 'text') else ''; logging.debug(f"Whisper result: '{transcribed_text}'")
         return jsonify({"text": transcribed_text})
     except APIError as e: logging.error(f"Whisper API Error: {e}", exc_info=True); status = e.status_code if hasattr(e, 'status_code') else 500; return jsonify({"error": f"語音辨識失敗：{e.code} - API 錯誤。"}), status
     except Exception as e: logging.error(f"Transcription error: {e}", exc_info=True); return jsonify({"error": "語音辨識時發生伺服器錯誤。"}), 500
-    finally: 
-        if os.path.exists(temp_filename): 
-            try: os.remove(temp_filename); logging.info(f"Temp audio removed: {temp_filename}") 
-            except OSError as re: logging.error(f"Error removing temp audio: {re}")
+    finally: whisper_limiter.release()
+
+_SENTENCE_END = re.compile(r'(?<=[。！？!?；;\n])|(?<=[.])\s+')
+
+def split_tts_text(text, max_chars, first_max_chars=None):
+    """
+    Splits text into speech segments at sentence boundaries, packing sentences up to max_chars
+    (first_max_chars for the first segment, so playback can start sooner). Overlong sentences are hard-split.
+    """
+    segments = []; current = ""
+    for sentence in (part.strip() for part in _SENTENCE_END.split(text)):
+        if not sentence: continue
+        limit = first_max_chars if first_max_chars and not segments else max_chars
+        if current and len(current) + 1 + len(sentence) > limit: segments.append(current); current = ""
+        limit = first_max_chars if first_max_chars and not segments else max_chars
+        while len(sentence) > limit: segments.append(sentence[:limit]); sentence = sentence[limit:]; limit = max_chars
+        current = (current + ("" if current[-1] in "。！？；" else " ") + sentence) if current else sentence
+    if current: segments.append(current)
+    return segments
+
+def tts_cache_key(text):
+    return TextResultCache.make_key('tts', app.config['TTS_MODEL'], app.config['TTS_VOICE'], 'mp3', text)
+
+def synthesize_segment(text, wait=False, reserved=False):
+    """
+    Returns MP3 bytes for one segment, from the audio cache or the TTS API (identical in-flight requests share one call).
+    API calls take a 'tts' upstream slot; wait=True waits for one instead of raising UpstreamBusy.
+    reserved=True means the caller already holds a slot, which is used for the call and released on return.
+    """
+    try:
+        key = tts_cache_key(text)
+        audio = tts_cache.get(key)
+        if audio is not None: return audio
+        def compute():
+            with (nullcontext() if reserved else upstream_limiters['tts'].slot(wait=wait)), span('tts'):
+                response = openai_client.audio.speech.create( model=app.config['TTS_MODEL'], voice=app.config['TTS_VOICE'], input=text, response_format="mp3" )
+            data = response.content; tts_cache.put(key, data); return data
+        return tts_flights.do(key, compute)[0]
+    finally:
+        if reserved: upstream_limiters['tts'].release()
 
 @app.route('/synthesize', methods=['POST'])
 def synthesize_speech():
+    """Synthesizes speech segment by segment in parallel and streams the MP3 segments back in order."""
     if not ensure_ai_components() or not openai_client: return jsonify({"error":"AI服務暫時無法處理語音合成。"}), 503
     data = request.get_json(); 
     if not data or 'text' not in data: return jsonify({"error": "未提供用於合成的文本。"}), 400
     text_to_speak = data['text']; 
     if not text_to_speak.strip(): return jsonify({"error": "合成文本不能為空。"}), 400
-    logging.info(f"TTS request: '{text_to_speak[:50]}...'"); 
+    segments = split_tts_text(text_to_speak, app.config['TTS_SEGMENT_MAX_CHARS'], app.config['TTS_FIRST_SEGMENT_MAX_CHARS'])
+    logging.debug(f"TTS request: '{text_to_speak[:50]}...' ({len(segments)} segments)")
+    # The first segment's slot is taken before the rest are queued, so they cannot get ahead of it; fails fast (503) when saturated.
+    first_cached = tts_cache.get(tts_cache_key(segments[0])) is not None
+    if not first_cached:
+        try: upstream_limiters['tts'].acquire()
+        except UpstreamBusy as e: return busy_response(e)
+    futures = [None] + [tts_executor.submit(synthesize_segment, segment, True) for segment in segments[1:]]
     try:
-        response = openai_client.audio.speech.create( model="tts-1", voice="alloy", input=text_to_speak, response_format="mp3" ); logging.info("TTS audio generated.")
-        def generate_audio(): yield from response.iter_bytes(chunk_size=4096); logging.info("Finished streaming TTS.")
-        return Response(generate_audio(), mimetype="audio/mpeg")
-    except APIError as e: logging.error(f"TTS API Error: {e}", exc_info=True); status = e.status_code if hasattr(e, 'status_code') else 500; return jsonify({"error": f"語音合成失敗：{e.code} - API 錯誤。"}), status
-    except Exception as e: logging.error(f"TTS error: {e}", exc_info=True); return jsonify({"error": "語音合成時發生伺服器錯誤。"}), 500
+        first_audio = synthesize_segment(segments[0], reserved=not first_cached); logging.debug("First TTS segment ready.") # Surface API errors before the stream starts
+    except UpstreamBusy as e:
+        for future in futures[1:]: future.cancel()
+        return busy_response(e)
+    except APIError as e:
+        for future in futures[1:]: future.cancel()
+        logging.error(f"TTS API Error: {e}", exc_info=True); status = e.status_code if hasattr(e, 'status_code') else 500; return jsonify({"error": f"語音合成失敗：{e.code} - API 錯誤。"}), status
+    except Exception as e:
+        for future in futures[1:]: future.cancel()
+        logging.error(f"TTS error: {e}", exc_info=True); return jsonify({"error": "語音合成時發生伺服器錯誤。"}), 500
+    def generate_audio():
+        yield first_audio
+        for index, future in enumerate(futures[1:], start=2):
+            try: yield future.result()
+            except Exception as e:
+                logging.error(f"TTS segment {index}/{len(futures)} failed: {e}", exc_info=True)
+                for pending in futures[index:]: pending.cancel()
+                return
+        logging.debug("Finished streaming TTS.")
+    return Response(generate_audio(), mimetype="audio/mpeg")
 
 @app.route('/clear_data', methods=['POST'])
 def clear_all_data():
-    """Deletes uploads, temp audio, and resets ChromaDB."""
-    logging.warning("Received request to clear all data."); uploads_path = app.config['UPLOAD_FOLDER']; chroma_path = app.config['CHROMA_DB_FOLDER']; temp_audio_path = app.config['TEMP_FOLDER']; errors = []; global vectorstore
-    # Reset ChromaDB
-    try:
-        logging.info(f"Attempting reset ChromaDB: {chroma_path}")
-        if os.path.exists(chroma_path): from chromadb.config import Settings; chroma_client_for_reset = chromadb.PersistentClient(path=chroma_path, settings=Settings(allow_reset=True)); chroma_client_for_reset.reset(); logging.info(f"ChromaDB reset successfully.")
-        else: logging.info(f"ChromaDB dir not found."); os.makedirs(chroma_path, exist_ok=True)
-        # Re-initialize global vectorstore
-        if embeddings: vectorstore = Chroma(persist_directory=chroma_path, embedding_function=embeddings); logging.info("Re-initialized global vectorstore.")
-        else: logging.error("Embeddings missing, cannot re-init vectorstore."); errors.append("無法重新初始化向量庫。")
-    except Exception as e: msg = f"Error resetting ChromaDB: {e}"; logging.error(msg, exc_info=True); errors.append(msg); os.makedirs(chroma_path, exist_ok=True)
-    # Delete Uploads
-    try:
-        if os.path.exists(uploads_path): count=0; logging.info(f"Clearing uploads: {uploads_path}"); [ (os.unlink(fp), count := count + 1) for fn in os.listdir(uploads_path) if os.path.isfile(fp := os.path.join(uploads_path, fn)) or os.path.islink(fp) ]; logging.info(f"Deleted {count} files from uploads.")
-        else: logging.info(f"Uploads dir not found."); os.makedirs(uploads_path, exist_ok=True)
-    except Exception as e: msg = f"Error cleaning uploads: {e}"; logging.error(msg, exc_info=True); errors.append(msg); os.makedirs(uploads_path, exist_ok=True)
-    # Delete Temp Audio
-    try:
-        if os.path.exists(temp_audio_path): count=0; logging.info(f"Clearing temp audio: {temp_audio_path}"); [ (os.unlink(fp), count := count + 1) for fn in os.listdir(temp_audio_path) if os.path.isfile(fp := os.path.join(temp_audio_path, fn)) or os.path.islink(fp) ]; logging.info(f"Deleted {count} files from temp audio.")
-        else: logging.info(f"Temp audio dir not found."); os.makedirs(temp_audio_path, exist_ok=True)
-    except Exception as e: msg = f"Error cleaning temp audio: {e}"; logging.error(msg, exc_info=True); errors.append(msg); os.makedirs(temp_audio_path, exist_ok=True)
+    """Deletes uploads, temp audio, the paper catalog, and every Chroma collection."""
+    logging.warning("Received request to clear all data."); uploads_path = app.config['UPLOAD_FOLDER']; temp_audio_path = app.config['TEMP_FOLDER']; errors = []
+    with chroma_data_lock.write(): # Waits for in-flight retrievals / ingestion writes; new ones wait for the clear
+        # Drop all Chroma collections (shards and legacy); the client itself stays open
+        with shard_stores_lock: shard_stores.clear()
+        try:
+            if not ensure_ai_components() or not chroma_client: raise RuntimeError("Chroma client not available")
+            collections = chroma_client.list_collections()
+            for collection in collections: chroma_client.delete_collection(collection.name)
+            logging.info(f"Deleted {len(collections)} Chroma collections.")
+        except Exception as e: msg = f"Error clearing ChromaDB: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+        # Close pooled page stores / PDFs before their files are deleted
+        page_store_pool.clear(); pdf_doc_pool.clear()
+        # Delete Page Text Stores
+        try:
+            page_text_path = app.config['PAGE_TEXT_FOLDER']; count = 0
+            for fn in os.listdir(page_text_path):
+                fp = os.path.join(page_text_path, fn)
+                if os.path.isfile(fp): os.unlink(fp); count += 1
+            logging.info(f"Deleted {count} page text stores.")
+        except Exception as e: msg = f"Error cleaning page text stores: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+        # Cached page analyses belong to the deleted papers
+        try: analysis_cache.clear(); logging.info("Page analysis cache cleared.")
+        except Exception as e: msg = f"Error clearing analysis cache: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+        # Delete Lexical Chunk Files
+        with lexical_indexes_lock: lexical_indexes.clear()
+        try:
+            chunk_path = app.config['CHUNK_FOLDER']; count = 0
+            for fn in os.listdir(chunk_path):
+                fp = os.path.join(chunk_path, fn)
+                if os.path.isfile(fp): os.unlink(fp); count += 1
+            logging.info(f"Deleted {count} lexical chunk files.")
+        except Exception as e: msg = f"Error cleaning lexical chunk files: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+        # Clear Paper Catalog
+        try: paper_catalog.clear(); logging.info("Paper catalog cleared.")
+        except Exception as e: msg = f"Error clearing paper catalog: {e}"; logging.error(msg, exc_info=True); errors.append(msg)
+        # Delete Uploads
+        try:
+            if os.path.exists(uploads_path): count=0; logging.info(f"Clearing uploads: {uploads_path}"); [ (os.unlink(fp), count := count + 1) for fn in os.listdir(uploads_path) if os.path.isfile(fp := os.path.join(uploads_path, fn)) or os.path.islink(fp) ]; logging.info(f"Deleted {count} files from uploads.")
+            else: logging.info(f"Uploads dir not found."); os.makedirs(uploads_path, exist_ok=True)
+        except Exception as e: msg = f"Error cleaning uploads: {e}"; logging.error(msg, exc_info=True); errors.append(msg); os.makedirs(uploads_path, exist_ok=True)
+        # Delete Temp Audio
+        try:
+            if os.path.exists(temp_audio_path): count=0; logging.info(f"Clearing temp audio: {temp_audio_path}"); [ (os.unlink(fp), count := count + 1) for fn in os.listdir(temp_audio_path) if os.path.isfile(fp := os.path.join(temp_audio_path, fn)) or os.path.islink(fp) ]; logging.info(f"Deleted {count} files from temp audio.")
+            else: logging.info(f"Temp audio dir not found."); os.makedirs(temp_audio_path, exist_ok=True)
+        except Exception as e: msg = f"Error cleaning temp audio: {e}"; logging.error(msg, exc_info=True); errors.append(msg); os.makedirs(temp_audio_path, exist_ok=True)
     # Return Response
     if not errors: logging.info("Data clear OK."); return jsonify({"message": "所有資料已成功清除。"}), 200
     else: logging.error(f"Data clear ERR: {errors}"); return jsonify({"error": "清除部分資料時發生錯誤。", "details": errors}), 500
@@ -401,7 +1959,7 @@ def clear_all_data():
 if __name__ == '__main__':
     logging.info("Starting Flask development server...")
     # Initial AI component initialization is done globally now
-    if not vectorstore or not embeddings or not llm or not openai_client:
+    if not ai_components_ready():
          logging.warning("Initial AI component loading might have failed. Check logs.")
          # Optionally exit if critical components failed: exit(1)
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,257 @@
+"""
+End-to-end HTTP benchmark of the app against a local fake OpenAI server (benchmarks/fake_openai.py):
+deterministic embeddings, configurable LLM latency; runs offline with no API key (EMBED_TOKENIZE=false,
+and prompt token counts fall back to the character estimate when tiktoken's encoding is not cached).
+
+Serves app.py from a temporary data directory and measures, over real HTTP:
+
+    ingestion   /upload -> /upload_status done, for synthetic PDFs of several sizes (pages/s, chunks/s),
+                plus re-uploading the largest PDF (embedding cache hits)
+    chat        /chat p50 / p99 and throughput at several concurrent-user levels,
+                with the mean per-stage breakdown from the Server-Timing header
+    translate   /translate cache miss vs. memory-tier hit vs. disk-tier hit latency
+    papers      /papers latency as the catalog grows (synthetic ready entries)
+
+    python benchmarks/bench_app.py --output app.json
+    python benchmarks/bench_app.py --quick --baseline app.json      # compare against an earlier run
+
+Results are keyed by scenario and size so two runs of the same settings diff cleanly (--baseline).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_retrieval import summarize
+import fake_openai
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SERVER_TIMING_RE = re.compile(r"([\w.-]+);dur=([\d.]+)")
+
+
+def make_pdf(path, pages, rng, vocabulary, datasets):
+    """Writes a synthetic paper: a section heading and five ~90-word paragraphs per page."""
+    import fitz  # PyMuPDF
+    doc = fitz.open()
+    for page_num in range(pages):
+        paragraphs = [f"{page_num + 1}. {' '.join(rng.sample(vocabulary, 3)).title()}"]
+        for _ in range(5):
+            words = rng.sample(vocabulary, 90)
+            if rng.random() < 0.4: words.insert(rng.randrange(len(words)), f"{rng.choice(datasets)} ({rng.uniform(50, 99):.1f}%)")
+            paragraphs.append(" ".join(words) + ".")
+        doc.new_page().insert_textbox(fitz.Rect(50, 50, 545, 800), "\n\n".join(paragraphs), fontsize=9)
+    doc.save(path); doc.close()
+
+
+class Client:
+    """Minimal urllib client. Every call returns (status, headers, body bytes, seconds)."""
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, path, body=None, headers=None):
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=300) as resp: status, resp_headers, data = resp.status, resp.headers, resp.read()
+        except urllib.error.HTTPError as e: status, resp_headers, data = e.code, e.headers, e.read()
+        return status, resp_headers, data, time.perf_counter() - started
+
+    def get(self, path):
+        return self.request("GET", path)
+
+    def post_json(self, path, payload):
+        return self.request("POST", path, json.dumps(payload).encode("utf-8"), {"Content-Type": "application/json"})
+
+    def upload(self, path, filename, content):
+        boundary = uuid.uuid4().hex
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"pdf_file\"; filename=\"{filename}\"\r\n"
+                f"Content-Type: application/pdf\r\n\r\n").encode("utf-8") + content + f"\r\n--{boundary}--\r\n".encode("utf-8")
+        return self.request("POST", path, body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+
+def ingest(client, app, path):
+    """Uploads one PDF and polls until its job finishes. Returns the timing record."""
+    with open(path, "rb") as f: content = f.read()
+    started = time.perf_counter()
+    status, _, data, upload_seconds = client.upload("/upload", os.path.basename(path), content)
+    if status != 202: raise RuntimeError(f"upload failed ({status}): {data[:200]!r}")
+    job = json.loads(data)
+    while True:
+        _, _, data, _ = client.get(job["status_url"]); state = json.loads(data)
+        if state["status"] in ("done", "failed"): break
+        time.sleep(0.02)
+    seconds = time.perf_counter() - started
+    if state["status"] != "done": raise RuntimeError(f"ingestion failed: {state.get('error')}")
+    paper = app.paper_catalog.get(job["paper_id"])
+    return {"paper_id": job["paper_id"], "bytes": len(content), "pages": paper["page_count"], "chunks": paper["chunk_count"],
+            "upload_ms": round(upload_seconds * 1000, 3), "total_seconds": round(seconds, 3),
+            "pages_per_s": round(paper["page_count"] / seconds, 2), "chunks_per_s": round(paper["chunk_count"] / seconds, 2)}
+
+
+def run_chat(client, paper, users, requests_per_user, rng, vocabulary, datasets):
+    """users threads each send requests_per_user /chat requests back to back."""
+    jobs = []
+    for _ in range(users * requests_per_user):
+        if rng.random() < 0.3: message = f"How does the method perform on {rng.choice(datasets)}?"
+        else: message = f"What does the paper say about {' '.join(rng.sample(vocabulary, 3))}?"
+        jobs.append({"message": message, "paper_id": paper["paper_id"], "currentPageNum": rng.randint(1, paper["pages"]),
+                     "context_mode": "page" if rng.random() < 0.7 else "document"})
+    latencies, statuses, stages = [], {}, {}; lock = threading.Lock()
+    def send(payload):
+        status, headers, _, seconds = client.post_json("/chat", payload)
+        with lock:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status != 200: return
+            latencies.append(seconds)
+            for stage, ms in _SERVER_TIMING_RE.findall(headers.get("Server-Timing", "")): stages.setdefault(stage, []).append(float(ms))
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool: list(pool.map(send, jobs))
+    wall = time.perf_counter() - started
+    result = {"users": users, "requests": len(jobs), "statuses": statuses, "throughput_rps": round(len(latencies) / wall, 2)}
+    if latencies: result.update(summarize(latencies))
+    result["stage_mean_ms"] = {stage: round(sum(values) / len(values), 3) for stage, values in stages.items()}
+    return result
+
+
+def run_translate(client, app, texts):
+    """Times the same texts as cache misses, then memory-tier hits, then disk-tier hits (memory tier emptied)."""
+    def timed_pass(expected_tier):
+        samples = []
+        for text in texts:
+            status, _, data, seconds = client.post_json("/translate", {"text": text})
+            if status != 200 or json.loads(data).get("cache") != expected_tier: raise RuntimeError(f"unexpected /translate result ({status}): {data[:200]!r}")
+            samples.append(seconds)
+        return summarize(samples)
+    results = {"miss": timed_pass(None), "memory_hit": timed_pass("memory")}
+    with app.translation_cache._lock: app.translation_cache._memory.clear()
+    results["disk_hit"] = timed_pass("disk")
+    return results
+
+
+def run_papers(client, app, corpus_sizes, requests):
+    """Grows the catalog with synthetic ready entries and times /papers at each size."""
+    results = {}
+    for size in corpus_sizes:
+        for _ in range(max(0, size - len(app.paper_catalog.list(status='ready')))):
+            paper_id = str(uuid.uuid4())
+            app.paper_catalog.add(paper_id, f"{paper_id}_synthetic.pdf", f"synthetic-{paper_id[:8]}.pdf", status='ready', page_count=10, chunk_count=30)
+        samples, size_bytes = [], 0
+        for _ in range(requests):
+            status, _, data, seconds = client.get("/papers")
+            if status != 200: raise RuntimeError(f"/papers failed ({status})")
+            samples.append(seconds); size_bytes = len(data)
+        results[f"papers_{size}"] = {"papers": size, "response_bytes": size_bytes, **summarize(samples)}
+    return results
+
+
+def flatten(results, prefix=""):
+    items = {}
+    for key, value in results.items():
+        if isinstance(value, dict): items.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and (key.endswith("_ms") or key.endswith("_per_s") or key.endswith("_rps")): items[prefix + key] = value
+    return items
+
+
+def compare(baseline, current):
+    """Prints latency / throughput metrics present in both runs with their relative change."""
+    before, after = flatten(baseline), flatten(current)
+    print(f"\n{'metric':<55} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key in sorted(before.keys() & after.keys()):
+        change = f"{(after[key] - before[key]) / before[key] * 100:+.1f}%" if before[key] else "n/a"
+        print(f"{key:<55} {before[key]:>12} {after[key]:>12} {change:>9}")
+
+
+def git_commit():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pdf-pages', default="5,20,80", help="comma-separated synthetic PDF sizes to ingest")
+    parser.add_argument('--chat-users', default="1,4,16", help="comma-separated concurrent-user levels")
+    parser.add_argument('--chat-requests', type=int, default=20, help="requests per user at each level")
+    parser.add_argument('--translate-texts', type=int, default=100)
+    parser.add_argument('--corpus-sizes', default="10,100,1000,10000", help="comma-separated catalog sizes for /papers")
+    parser.add_argument('--papers-requests', type=int, default=50)
+    parser.add_argument('--chat-latency', type=float, default=0.3, help="fake LLM seconds per call")
+    parser.add_argument('--embed-latency', type=float, default=0.02, help="fake embeddings seconds per request")
+    parser.add_argument('--embed-dim', type=int, default=1536)
+    parser.add_argument('--quick', action='store_true', help="small sizes for a fast smoke run")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help="write JSON results to this file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+    if args.quick:
+        args.pdf_pages, args.chat_users, args.chat_requests = "3,12", "1,4", 5
+        args.translate_texts, args.corpus_sizes, args.papers_requests = 20, "10,100", 20
+    sizes = lambda value: [int(v) for v in value.split(",") if v.strip()]
+    output = os.path.join(REPO_ROOT, args.output) if args.output and not os.path.isabs(args.output) else args.output
+    baseline = os.path.join(REPO_ROOT, args.baseline) if args.baseline and not os.path.isabs(args.baseline) else args.baseline
+
+    fake = fake_openai.start_server(embed_dim=args.embed_dim, chat_latency=args.chat_latency, embed_latency=args.embed_latency)
+    workdir = tempfile.mkdtemp(prefix='bench_app_')
+    os.chdir(workdir)  # app.py creates its data folders relative to the working directory
+    os.environ['OPENAI_API_KEY'] = 'sk-benchmark'; os.environ['OPENAI_BASE_URL'] = fake.base_url # Set (not defaulted) so a .env cannot point at the real API
+    os.environ['EMBED_TOKENIZE'] = 'false' # Raw text to the fake server instead of tiktoken ids (whose encoding would be downloaded)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, REPO_ROOT)
+    import app
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.getLogger().level) # Otherwise one INFO line per request
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+    client = Client(f"http://127.0.0.1:{server.server_port}")
+    print(f"Serving app from {workdir} on port {server.server_port}, fake OpenAI at {fake.base_url}", flush=True)
+
+    rng = random.Random(args.seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    datasets = [f"Dataset{i}K" for i in range(200)]
+    results = {"benchmark": "app", "git_commit": git_commit(), "python": platform.python_version(),
+               "settings": {"chat_latency_s": args.chat_latency, "embed_latency_s": args.embed_latency, "embed_dim": args.embed_dim,
+                            **{key.lower(): app.app.config[key] for key in ('INGEST_WORKERS', 'CHAT_MAX_CONCURRENCY', 'CHROMA_SHARDS', 'CONTEXT_PACKING')}}}
+
+    print("Ingestion ...", flush=True)
+    ingestion, papers = {}, []
+    for pages in sizes(args.pdf_pages):
+        path = os.path.join(workdir, f"synthetic_{pages}p.pdf"); make_pdf(path, pages, rng, vocabulary, datasets)
+        record = ingest(client, app, path); papers.append(record)
+        ingestion[f"pages_{pages}"] = {k: v for k, v in record.items() if k != "paper_id"}
+    largest = max(papers, key=lambda p: p["pages"])
+    record = ingest(client, app, os.path.join(workdir, f"synthetic_{largest['pages']}p.pdf"))
+    ingestion[f"pages_{largest['pages']}_reupload"] = {k: v for k, v in record.items() if k != "paper_id"}
+    results["ingestion"] = ingestion
+
+    print("Chat ...", flush=True)
+    results["chat"] = {f"users_{users}": run_chat(client, largest, users, args.chat_requests, rng, vocabulary, datasets) for users in sizes(args.chat_users)}
+
+    print("Translate ...", flush=True)
+    texts = [" ".join(rng.sample(vocabulary, 12)) + "." for _ in range(args.translate_texts)]
+    results["translate"] = run_translate(client, app, texts)
+
+    print("Papers ...", flush=True)
+    results["papers"] = run_papers(client, app, sizes(args.corpus_sizes), args.papers_requests)
+
+    results["upstream_calls"] = fake.stats()
+    server.shutdown(); fake.shutdown()
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, 'w') as f: json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline) as f: compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
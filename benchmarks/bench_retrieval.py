@@ -0,0 +1,124 @@
+"""
+Retrieval latency benchmark: the original /chat path (similarity search over one shared Chroma
+collection filtered by paper_id) vs. the current retriever (CHROMA_SHARDS shard collections,
+BM25 + vector, RRF + MMR).
+
+Builds a synthetic corpus in a temporary directory with deterministic local embeddings,
+so no OpenAI calls are made and the numbers measure local retrieval cost only.
+
+    python benchmarks/bench_retrieval.py --papers 10000 --chunks 10 --queries 300 --output retrieval.json
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples):
+    ms = [s * 1000 for s in samples]
+    return {"n": len(ms), "mean_ms": round(statistics.mean(ms), 3), "p50_ms": round(percentile(ms, 50), 3),
+            "p99_ms": round(percentile(ms, 99), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--papers', type=int, default=10000)
+    parser.add_argument('--chunks', type=int, default=10, help="chunks per paper")
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--dim', type=int, default=64, help="embedding dimension")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help="write JSON results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_retrieval_')
+    os.chdir(workdir)  # Throwaway chroma_db/ and paper_chunks/, away from the checkout's own data
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+    sys.path.insert(0, REPO_ROOT)
+    import logging
+    import app
+    from langchain_chroma import Chroma
+    from langchain_core.embeddings import Embeddings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    class HashEmbeddings(Embeddings):
+        """Deterministic bag-of-words random projection: similar texts get similar vectors."""
+        model = 'hash-embeddings'
+        def _embed(self, text):
+            vector = [0.0] * args.dim
+            for token in text.lower().split():
+                digest = hashlib.md5(token.encode()).digest()
+                for i in range(4): vector[digest[i] % args.dim] += 1.0 if digest[4 + i] % 2 else -1.0
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            return [v / norm for v in vector]
+        def embed_documents(self, texts): return [self._embed(t) for t in texts]
+        def embed_query(self, text): return self._embed(text)
+
+    app.embeddings = app.CachedEmbeddings(HashEmbeddings(), app.embedding_cache, query_cache_size=0)
+    shared_store = Chroma(client=app.chroma_client, collection_name='bench-shared', embedding_function=app.embeddings)
+
+    rng = random.Random(args.seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    datasets = [f"Dataset{i}K" for i in range(200)]
+    paper_ids = [f"{rng.getrandbits(128):032x}" for _ in range(args.papers)]
+    paper_ids = [f"{p[:8]}-{p[8:12]}-{p[12:16]}-{p[16:20]}-{p[20:]}" for p in paper_ids]
+
+    print(f"Building corpus (shared + {app.app.config['CHROMA_SHARDS']} shard collections): {args.papers} papers x {args.chunks} chunks in {workdir} ...", flush=True)
+    started = time.perf_counter(); batch_texts, batch_meta, batch_ids = [], [], []
+    for paper_id in paper_ids:
+        chunks = []
+        for index in range(args.chunks):
+            words = rng.sample(vocabulary, 60) + ([rng.choice(datasets)] if rng.random() < 0.3 else [])
+            text = " ".join(words); chunk_id = f"{paper_id}:{index}"; metadata = {"paper_id": paper_id, "chunk_index": index, "page": index}
+            chunks.append((chunk_id, text, metadata)); batch_texts.append(text); batch_meta.append(metadata); batch_ids.append(chunk_id)
+        app.save_paper_chunks(paper_id, chunks)
+        app.get_paper_vectorstore(paper_id).add_texts([c[1] for c in chunks], metadatas=[c[2] for c in chunks], ids=[c[0] for c in chunks])
+        if len(batch_texts) >= 5000:
+            shared_store.add_texts(batch_texts, metadatas=batch_meta, ids=batch_ids); batch_texts, batch_meta, batch_ids = [], [], []
+    if batch_texts: shared_store.add_texts(batch_texts, metadatas=batch_meta, ids=batch_ids)
+    build_seconds = time.perf_counter() - started
+    print(f"Corpus built in {build_seconds:.1f}s", flush=True)
+
+    queries = []
+    for _ in range(args.queries):
+        paper_id = rng.choice(paper_ids)
+        if rng.random() < 0.3: query = f"How does the method perform on {rng.choice(datasets)}?"
+        else: query = " ".join(rng.sample(vocabulary, 4))
+        queries.append((paper_id, query))
+
+    app.lexical_indexes.clear()
+    vector_path, hybrid_cold, hybrid_warm, modes = [], [], [], {}
+    for paper_id, query in queries:
+        t = time.perf_counter()
+        shared_store.as_retriever(search_kwargs={'filter': {'paper_id': paper_id}, 'k': 10}).invoke(query)
+        vector_path.append(time.perf_counter() - t)
+        with app.lexical_indexes_lock: app.lexical_indexes.pop(paper_id, None)
+        t = time.perf_counter(); _, mode = app.retrieve_chunks(paper_id, query); hybrid_cold.append(time.perf_counter() - t)
+        t = time.perf_counter(); app.retrieve_chunks(paper_id, query); hybrid_warm.append(time.perf_counter() - t)
+        modes[mode] = modes.get(mode, 0) + 1
+
+    results = {"benchmark": "retrieval", "papers": args.papers, "chunks_per_paper": args.chunks, "queries": args.queries,
+               "corpus_build_seconds": round(build_seconds, 2),
+               "shared_collection_filtered_search": summarize(vector_path),
+               "chroma_shards": app.app.config['CHROMA_SHARDS'],
+               "sharded_hybrid_cold_index": summarize(hybrid_cold), "sharded_hybrid_warm_index": summarize(hybrid_warm),
+               "hybrid_modes": modes}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(os.path.join(REPO_ROOT, args.output) if not os.path.isabs(args.output) else args.output, 'w') as f: json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Local stand-in for the OpenAI endpoints the app calls, for offline benchmarks and load tests.
+
+    /v1/embeddings            deterministic bag-of-words projections (similar texts -> similar vectors)
+    /v1/chat/completions      canned reply after a configurable latency; streaming supported
+    /v1/audio/speech          fake MP3 bytes
+    /v1/audio/transcriptions  fixed text
+    GET /stats                call counts per endpoint
+
+Run standalone and point the app at it:
+
+    python benchmarks/fake_openai.py --port 8765 --chat-latency 0.5
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=sk-fake python app.py
+"""
+import argparse
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_TOKEN_RE = re.compile(r"\w+")
+REPLY_TEXT = "根據論文內容，這個方法在實驗中優於基準模型。" * 4
+
+
+def embed(item, dim):
+    """Deterministic unit vector for a text (or a list of token ids): a signed random projection of its tokens."""
+    tokens = _TOKEN_RE.findall(item.lower()) if isinstance(item, str) else [str(t) for t in item]
+    vector = [0.0] * dim
+    for token in tokens or [""]:
+        digest = hashlib.md5(token.encode("utf-8")).digest()
+        for i in range(4): vector[int.from_bytes(digest[i * 2:i * 2 + 2], "little") % dim] += 1.0 if digest[8 + i] % 2 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeOpenAIServer"
+
+    def log_message(self, *args): pass
+
+    def _send(self, body, content_type="application/json", status=200):
+        self.send_response(status); self.send_header("Content-Type", content_type); self.send_header("Content-Length", str(len(body)))
+        self.end_headers(); self.wfile.write(body)
+
+    def _json(self, obj, status=200):
+        self._send(json.dumps(obj).encode("utf-8"), status=status)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats": return self._json(self.server.stats())
+        self._json({"error": {"message": "not found"}}, 404)
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?", 1)[0]; self.server.count(path)
+        if path.endswith("/embeddings"): return self._embeddings(json.loads(raw))
+        if path.endswith("/chat/completions"): return self._chat(json.loads(raw))
+        if path.endswith("/audio/speech"):
+            time.sleep(self.server.tts_latency)
+            return self._send(b"ID3" + hashlib.sha256(raw).digest() * 64, "audio/mpeg")
+        if path.endswith("/audio/transcriptions"): return self._json({"text": "測試語音"})
+        self._json({"error": {"message": "not found"}}, 404)
+
+    def _embeddings(self, body):
+        items = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        if items and isinstance(items[0], int): items = [items] # A single pre-tokenized input
+        time.sleep(self.server.embed_latency)
+        self._json({"object": "list", "model": body.get("model"), "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                    "data": [{"object": "embedding", "index": i, "embedding": embed(item, self.server.embed_dim)} for i, item in enumerate(items)]})
+
+    def _chat(self, body):
+        time.sleep(self.server.chat_latency) # Time to first token
+        usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) // 4 for m in body.get("messages", [])), "completion_tokens": len(REPLY_TEXT), "total_tokens": 0}
+        if not body.get("stream"):
+            return self._json({"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"), "usage": usage,
+                               "choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY_TEXT}, "finish_reason": "stop"}]})
+        self.send_response(200); self.send_header("Content-Type", "text/event-stream"); self.send_header("Transfer-Encoding", "chunked"); self.end_headers()
+        def send_chunk(delta, finish_reason=None):
+            event = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            data = f"data: {json.dumps(event)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n"); self.wfile.flush()
+        pieces = [REPLY_TEXT[i:i + 4] for i in range(0, len(REPLY_TEXT), 4)]
+        for piece in pieces:
+            send_chunk({"content": piece})
+            if self.server.stream_interval: time.sleep(self.server.stream_interval)
+        send_chunk({}, "stop")
+        done = b"data: [DONE]\n\n"
+        self.wfile.write(f"{len(done):x}\r\n".encode("ascii") + done + b"\r\n0\r\n\r\n"); self.wfile.flush()
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, embed_dim=1536, chat_latency=0.3, embed_latency=0.02, tts_latency=0.1, stream_interval=0.0):
+        super().__init__(address, FakeOpenAIHandler)
+        self.embed_dim = embed_dim; self.chat_latency = chat_latency; self.embed_latency = embed_latency
+        self.tts_latency = tts_latency; self.stream_interval = stream_interval
+        self._counts = {}; self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def count(self, path):
+        with self._lock: self._counts[path] = self._counts.get(path, 0) + 1
+
+    def stats(self):
+        with self._lock: return dict(self._counts)
+
+
+def start_server(host="127.0.0.1", port=0, **options):
+    """Starts the fake server on a background thread (port 0 = any free port). Returns the server; see .base_url."""
+    server = FakeOpenAIServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--embed-dim", type=int, default=1536)
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--stream-interval", type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="seconds per embeddings request")
+    parser.add_argument("--tts-latency", type=float, default=0.1)
+    args = parser.parse_args()
+    server = FakeOpenAIServer((args.host, args.port), embed_dim=args.embed_dim, chat_latency=args.chat_latency,
+                              embed_latency=args.embed_latency, tts_latency=args.tts_latency, stream_interval=args.stream_interval)
+    print(f"Fake OpenAI API listening on {server.base_url}", flush=True)
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Bulk ingestion of a PDF archive into the same uploads/ + chroma_db/ layout the web app reads.
+
+    python bulk_ingest.py /path/to/archive                 # every *.pdf below the directory
+    python bulk_ingest.py manifest.txt --processes 8       # one PDF path per line ('#' starts a comment)
+
+PDFs are de-duplicated by content hash (against each other and against papers already in the
+catalog), parsed and chunked in a process pool, embedded in large cross-paper batches (through the
+persistent embedding cache) and upserted into the Chroma shards one shard at a time. Each paper is
+cataloged before it is parsed and marked 'ready' only once its chunks are stored, so re-running the
+same command after a crash skips finished papers and redoes the rest (their vectors then come from
+the embedding cache). Run it while the web app is stopped: Chroma's on-disk client is not safe to
+share between processes.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+import pdf_utils  # app is imported in main() only: spawned workers re-import this module
+
+
+def parse_pdf(pdf_path, page_store_path, chunk_size, chunk_overlap):
+    """
+    Worker: extracts page texts, writes the paper's page text store and splits the pages the way
+    process_pdf_for_rag does. Returns (page_count, document metadata, [(chunk text, page index)]).
+    """
+    pages = pdf_utils.extract_page_range(pdf_path, 0, pdf_utils.get_page_count(pdf_path))
+    if not pages: return 0, {}, []
+    pdf_utils.write_page_store(page_store_path, [text for _, text in pages])
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return len(pages), pdf_utils.get_document_metadata(pdf_path), [(chunk, page_index) for page_index, text in pages for chunk in splitter.split_text(text)]
+
+
+def collect_pdfs(sources):
+    """Expands directories (recursively, *.pdf) and manifest files (one path per line, relative to the manifest) into absolute paths."""
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                paths += [os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.pdf')]
+        else:
+            base = os.path.dirname(os.path.abspath(source))
+            with open(source, encoding='utf-8') as f:
+                paths += [os.path.join(base, line.strip()) for line in f if line.strip() and not line.lstrip().startswith('#')]
+    return [os.path.abspath(path) for path in paths]
+
+
+def hash_file(path):
+    try: return pdf_utils.file_sha256(path)
+    except OSError as e: logging.error(f"Cannot read {path}: {e}"); return None
+
+
+class BulkIngest:
+    def __init__(self, app, batch_chunks):
+        self.app = app; self.batch_chunks = max(1, batch_chunks)
+        self.stats = {"pdfs": 0, "unreadable": 0, "duplicates": 0, "already_ingested": 0, "ingested": 0, "failed": 0, "pages": 0, "chunks": 0,
+                      "embed_seconds": 0.0, "store_seconds": 0.0}
+        self.started = time.perf_counter()
+
+    def register(self, path, content_sha256, entry):
+        """Catalogs a PDF (or takes over an unfinished entry with the same content) and copies it into uploads/. Returns the paper dict."""
+        app = self.app
+        if entry and entry.get('filename'): paper_id, filename, resumed = entry['paper_id'], entry['filename'], True
+        else:
+            paper_id = str(uuid.uuid4()); display_name = app.safe_upload_name(path); filename = f"{paper_id}_{display_name}"; resumed = False
+            app.paper_catalog.add(paper_id, filename, display_name, status='processing', content_sha256=content_sha256)
+        upload_path = os.path.join(app.app.config['UPLOAD_FOLDER'], filename)
+        if not os.path.isfile(upload_path):
+            tmp_path = f"{upload_path}.tmp"; shutil.copyfile(path, tmp_path); os.replace(tmp_path, upload_path)
+        if resumed: app.paper_catalog.update(paper_id, status='processing', error=None)
+        return {"paper_id": paper_id, "filename": filename, "upload_path": upload_path, "source": path, "resumed": resumed}
+
+    def fail(self, paper, reason):
+        logging.error(f"Ingestion failed for {paper['source']}: {reason}")
+        self.app.paper_catalog.update(paper['paper_id'], status='failed', error="RAG 處理失敗。"); self.stats["failed"] += 1
+
+    def store(self, batch):
+        """Embeds a batch of parsed papers in one call, upserts their chunks shard by shard and marks them ready."""
+        app = self.app; records = [] # (paper_id, chunk_id, text, metadata)
+        for paper, page_count, document_metadata, chunks in batch:
+            paper_id = paper['paper_id']
+            source = os.path.join(app.app.config['UPLOAD_FOLDER'], paper['filename']) # Same metadata as extract_pdf_documents + process_pdf_for_rag
+            for index, (text, page_index) in enumerate(chunks):
+                metadata = {"source": source, "file_path": source, "page": page_index, "total_pages": page_count, **document_metadata,
+                            "paper_id": paper_id, "chunk_index": index}
+                records.append((paper_id, f"{paper_id}:{index}", text, metadata))
+        started = time.perf_counter()
+        vectors = app.embeddings.embed_documents([text for _, _, text, _ in records])
+        self.stats["embed_seconds"] += time.perf_counter() - started; started = time.perf_counter()
+        shards = {}
+        for record, vector in zip(records, vectors): shards.setdefault(app.shard_collection_name(record[0]), []).append((*record, vector))
+        max_batch = app.chroma_client.get_max_batch_size()
+        with app.chroma_data_lock.read():
+            for shard_name, rows in shards.items():
+                collection = app.chroma_client.get_or_create_collection(name=shard_name, embedding_function=None)
+                for paper_id in {row[0] for row in rows} & {paper['paper_id'] for paper, *_ in batch if paper['resumed']}:
+                    collection.delete(where={"paper_id": paper_id}) # Chunks left by an interrupted run
+                for start in range(0, len(rows), max_batch):
+                    part = rows[start:start + max_batch]
+                    collection.upsert(ids=[r[1] for r in part], documents=[r[2] for r in part], metadatas=[r[3] for r in part], embeddings=[r[4] for r in part])
+            offset = 0
+            for paper, page_count, _, chunks in batch:
+                paper_id = paper['paper_id']; paper_records = records[offset:offset + len(chunks)]; offset += len(chunks)
+                try: app.save_paper_chunks(paper_id, [(chunk_id, text, metadata) for _, chunk_id, text, metadata in paper_records])
+                except Exception as e: logging.error(f"Error saving lexical chunks for {paper_id}: {e}", exc_info=True) # Rebuilt from Chroma on demand
+                storage_bytes = app.estimate_paper_storage(paper_id, paper['filename'], len(chunks), len(vectors[0]) if vectors else 1536)
+                app.paper_catalog.update(paper_id, status='ready', error=None, page_count=page_count, chunk_count=len(chunks), ingested_at=time.time(), storage_bytes=storage_bytes)
+                self.stats["ingested"] += 1; self.stats["pages"] += page_count; self.stats["chunks"] += len(chunks)
+        self.stats["store_seconds"] += time.perf_counter() - started
+        self.report()
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.started; s = self.stats
+        print(f"{'Done' if final else 'Progress'}: {s['ingested']} papers ingested, {s['failed']} failed, {s['pages']} pages, {s['chunks']} chunks in {elapsed:.1f}s "
+              f"({s['pages'] / elapsed:.1f} pages/s, {s['chunks'] / elapsed:.1f} chunks/s)", flush=True)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {**self.stats, "embed_seconds": round(self.stats["embed_seconds"], 2), "store_seconds": round(self.stats["store_seconds"], 2),
+                "seconds": round(elapsed, 2), "pages_per_s": round(self.stats["pages"] / elapsed, 2), "chunks_per_s": round(self.stats["chunks"] / elapsed, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='+', help="directories to scan and/or manifest files listing PDF paths")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="parse / chunk worker processes")
+    parser.add_argument('--batch-chunks', type=int, default=4096, help="chunks embedded and stored per batch (across papers)")
+    parser.add_argument('--hash-threads', type=int, default=8)
+    parser.add_argument('--report', help="write the final counts and throughput as JSON to this file")
+    args = parser.parse_args()
+
+    import app
+    if not app.ensure_ai_components(): logging.critical("AI components failed to initialize."); return 1
+    ingest = BulkIngest(app, args.batch_chunks)
+    paths = collect_pdfs(args.sources); ingest.stats["pdfs"] = len(paths)
+    print(f"Found {len(paths)} PDFs; hashing...", flush=True)
+    with ThreadPoolExecutor(max_workers=max(1, args.hash_threads)) as pool: hashes = list(pool.map(hash_file, paths))
+
+    papers = []; seen = set()
+    for path, content_sha256 in zip(paths, hashes):
+        if content_sha256 is None: ingest.stats["unreadable"] += 1; continue
+        if content_sha256 in seen: ingest.stats["duplicates"] += 1; continue
+        seen.add(content_sha256)
+        entry = app.paper_catalog.find_by_content_hash(content_sha256)
+        if entry and entry['status'] == 'ready': ingest.stats["already_ingested"] += 1; continue
+        papers.append(ingest.register(path, content_sha256, entry))
+    print(f"{len(papers)} to ingest ({sum(p['resumed'] for p in papers)} resumed), {ingest.stats['duplicates']} duplicates, "
+          f"{ingest.stats['already_ingested']} already ingested, {ingest.stats['unreadable']} unreadable.", flush=True)
+
+    # Workers parse ahead (bounded) while the main process embeds and stores the previous batch.
+    processes = max(1, args.processes); queued = iter(papers); pending = {}; batch = []; batch_chunks = 0
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        while True:
+            for paper in queued:
+                pending[pool.submit(parse_pdf, paper['upload_path'], app.page_store_path(paper['paper_id']), app.CHUNK_SIZE, app.CHUNK_OVERLAP)] = paper
+                if len(pending) >= processes * 2: break
+            if not pending: break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                paper = pending.pop(future)
+                try: page_count, document_metadata, chunks = future.result()
+                except Exception as e: ingest.fail(paper, e); continue
+                if not chunks: ingest.fail(paper, "no text extracted"); continue
+                app.page_store_pool.discard(paper['paper_id'])
+                batch.append((paper, page_count, document_metadata, chunks)); batch_chunks += len(chunks)
+            if batch_chunks >= ingest.batch_chunks: ingest.store(batch); batch = []; batch_chunks = 0
+        if batch: ingest.store(batch)
+
+    if ingest.stats["ingested"]:
+        try: app.enforce_storage_quota()
+        except Exception as e: logging.error(f"Storage quota enforcement failed: {e}", exc_info=True)
+    ingest.report(final=True)
+    summary = ingest.summary(); print(json.dumps(summary, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f: json.dump(summary, f, indent=2)
+    return 1 if ingest.stats["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""Token counting and budgeted packing of retrieved chunks into the chat prompt."""
+import logging
+import math
+import re
+import threading
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# CJK ideographs, kana, hangul and full-width punctuation: roughly one token per character
+_WIDE_CHAR_RE = re.compile(r"[\u3000-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def normalize_whitespace(text):
+    return _WHITESPACE_RE.sub(" ", text or "").strip()
+
+
+class TokenCounter:
+    """Counts tokens with tiktoken when the encoding can be loaded, otherwise with a character-based estimate."""
+    def __init__(self, encoding_name='o200k_base'):
+        self.encoding_name = encoding_name
+        self._encoding = None; self._loaded = False; self._lock = threading.Lock()
+
+    def _get_encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        import tiktoken
+                        self._encoding = tiktoken.get_encoding(self.encoding_name)
+                    except Exception as e:
+                        logging.warning(f"Tokenizer '{self.encoding_name}' unavailable ({e}); estimating token counts from characters.")
+                    self._loaded = True
+        return self._encoding
+
+    @property
+    def exact(self):
+        """True when counts come from tiktoken rather than the estimate."""
+        return self._get_encoding() is not None
+
+    @staticmethod
+    def estimate(text):
+        wide = len(_WIDE_CHAR_RE.findall(text))
+        return wide + math.ceil((len(text) - wide) / 4)
+
+    def count(self, text):
+        if not text: return 0
+        encoding = self._get_encoding()
+        return len(encoding.encode(text, disallowed_special=())) if encoding else self.estimate(text)
+
+    def truncate(self, text, max_tokens):
+        """Cuts text to at most max_tokens tokens."""
+        if max_tokens <= 0: return ""
+        encoding = self._get_encoding()
+        if encoding:
+            tokens = encoding.encode(text, disallowed_special=())
+            return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+        if self.estimate(text) <= max_tokens: return text
+        low, high = 0, len(text) # Longest prefix whose estimate fits
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.estimate(text[:mid]) <= max_tokens: low = mid
+            else: high = mid - 1
+        return text[:low]
+
+
+class Span:
+    """A contiguous run of one or more retrieved chunks."""
+    __slots__ = ('text', 'pages', 'chunk_indices', 'rank', 'tokens')
+
+    def __init__(self, text, page, chunk_index, rank):
+        self.text = text; self.rank = rank; self.tokens = 0
+        self.pages = [page] if isinstance(page, int) else []
+        self.chunk_indices = [chunk_index] if isinstance(chunk_index, int) else []
+
+
+def join_overlapping(a, b, max_overlap=400, min_overlap=20):
+    """
+    Joins two consecutive chunks, removing the longest suffix of `a` that is a prefix of `b`
+    (the text splitter's chunk overlap). Falls back to a newline join when they don't overlap.
+    """
+    if b in a: return a
+    for size in range(min(len(a), len(b), max_overlap), min_overlap - 1, -1):
+        if a.endswith(b[:size]): return a + b[size:]
+    return f"{a}\n{b}"
+
+
+def merge_spans(chunks):
+    """
+    chunks: [(text, metadata)] in relevance order. Chunks with consecutive `chunk_index`
+    metadata are merged into one span (ranked by its best chunk); others stay single.
+    Returns (spans in relevance order, number of chunks merged away).
+    """
+    indexed = sorted(((meta.get('chunk_index'), rank, text, meta) for rank, (text, meta) in enumerate(chunks)
+                      if isinstance(meta.get('chunk_index'), int)), key=lambda item: item[0])
+    spans = [Span(text, meta.get('page'), None, rank) for rank, (text, meta) in enumerate(chunks)
+             if not isinstance(meta.get('chunk_index'), int)]
+    merged = 0; current = None
+    for chunk_index, rank, text, meta in indexed:
+        if current is not None and current.chunk_indices[-1] == chunk_index: merged += 1; continue # Same chunk retrieved twice
+        if current is not None and current.chunk_indices[-1] + 1 == chunk_index:
+            current.text = join_overlapping(current.text, text); current.chunk_indices.append(chunk_index)
+            current.rank = min(current.rank, rank); merged += 1
+            if isinstance(meta.get('page'), int) and meta['page'] not in current.pages: current.pages.append(meta['page'])
+            continue
+        current = Span(text, meta.get('page'), chunk_index, rank); spans.append(current)
+    spans.sort(key=lambda span: span.rank)
+    return spans, merged
+
+
+def pack_context(chunks, counter, budget_tokens, page_text=None, span_overhead_tokens=0):
+    """
+    Packs retrieved chunks [(text, metadata)] (relevance order) into at most budget_tokens tokens.
+    Chunks whose text already appears in page_text are dropped, adjacent chunks are merged, and
+    spans are added best-first; spans that don't fit are skipped so smaller later ones can still fill
+    the budget. Each span costs its own tokens plus span_overhead_tokens (its header in the prompt).
+    Returns a dict with 'spans' (relevance order) and counts of covered / merged / over-budget chunks.
+    """
+    covered = 0; kept = []; seen = set()
+    normalized_page = normalize_whitespace(page_text) if page_text else ""
+    for text, meta in chunks:
+        normalized = normalize_whitespace(text)
+        if not normalized or normalized in seen: covered += 1; continue
+        if normalized_page and normalized in normalized_page: covered += 1; continue
+        seen.add(normalized); kept.append((text, meta or {}))
+    spans, merged = merge_spans(kept)
+    packed = []; used = 0; over_budget = 0
+    for span in spans:
+        span.tokens = counter.count(span.text)
+        if used + span.tokens + span_overhead_tokens > budget_tokens: over_budget += 1; continue
+        packed.append(span); used += span.tokens + span_overhead_tokens
+    return {"spans": packed, "covered": covered, "merged": merged, "over_budget": over_budget, "tokens": used}
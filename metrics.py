@@ -0,0 +1,153 @@
+"""Prometheus text-format counters and histograms, plus per-request trace spans."""
+import contextvars
+import math
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+_TRACE_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf: return "+Inf"
+    return f"{value:.6g}" if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name; self.documentation = documentation; self.labelnames = tuple(labelnames)
+        self._values = {}; self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock: values = sorted(self._values.items())
+        lines += [f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_value(value)}" for key, value in values]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name; self.documentation = documentation; self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)); self._series = {}; self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None: series = self._series[key] = [[0] * len(self.buckets), 0.0, 0] # bucket counts, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: series[0][i] += 1; break
+            series[1] += value; series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock: snapshot = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for key, (counts, total, count) in snapshot:
+            pairs = list(zip(self.labelnames, key)); cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', _format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Holds metrics and collectors. A collector is a callable returning
+    [(name, type, documentation, [(labels dict, value), ...])] - read when /metrics is scraped.
+    """
+    def __init__(self, prefix=""):
+        self.prefix = prefix; self._metrics = []; self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(self.prefix + name, documentation, labelnames); self._metrics.append(metric); return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self.prefix + name, documentation, labelnames, buckets); self._metrics.append(metric); return metric
+
+    def collector(self, fn):
+        self._collectors.append(fn); return fn
+
+    def render(self):
+        lines = []
+        for metric in self._metrics: lines += metric.render()
+        for collect in self._collectors:
+            for name, kind, documentation, samples in collect():
+                name = self.prefix + name
+                lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+                lines += [f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}" for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """Spans recorded while handling one request (or background job)."""
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id; self.spans = [] # [(stage, seconds)] in completion order
+
+    def totals(self):
+        """Returns {stage: total seconds} in first-seen order."""
+        totals = {}
+        for stage, seconds in self.spans: totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+    def server_timing(self):
+        """Formats the spans as a Server-Timing header value (durations in ms)."""
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.totals().items())
+
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(trace_id=None):
+    """Starts a trace in the current context (replacing any previous one); an unusable client-supplied id is replaced."""
+    if not trace_id or not _TRACE_ID_RE.match(trace_id): trace_id = uuid.uuid4().hex
+    trace = Trace(trace_id); _current_trace.set(trace)
+    return trace
+
+
+def end_trace():
+    _current_trace.set(None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class SpanTimer:
+    __slots__ = ("started", "seconds")
+
+    @property
+    def ms(self):
+        return round(self.seconds * 1000, 1)
+
+
+@contextmanager
+def span(histogram, stage):
+    """Times a block into histogram{stage=...} and the current trace; yields a timer whose .seconds / .ms are set on exit."""
+    timer = SpanTimer(); timer.started = time.perf_counter(); timer.seconds = 0.0
+    try: yield timer
+    finally:
+        timer.seconds = time.perf_counter() - timer.started
+        histogram.observe(timer.seconds, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None: trace.spans.append((stage, timer.seconds))
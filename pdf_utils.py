@@ -0,0 +1,105 @@
+"""
+Lightweight PDF helpers that are safe to run in worker processes.
+
+This module must stay free of Flask / LangChain / OpenAI imports so that
+process-pool workers (spawned for parallel page extraction) start quickly
+and do not initialize the web app's AI components.
+"""
+import hashlib
+import mmap
+import os
+import struct
+
+import fitz  # PyMuPDF
+
+# Page text store layout (little-endian):
+#   magic (8 bytes) | page_count (uint32) | (page_count + 1) uint64 offsets into data | UTF-8 page texts
+PAGE_STORE_MAGIC = b'PGTXT001'
+_HEADER_SIZE = len(PAGE_STORE_MAGIC) + 4
+
+
+def file_sha256(path, block_size=1 << 20):
+    """Returns the hex SHA-256 of a file's contents (used to recognize the same PDF under another name)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''): digest.update(block)
+    return digest.hexdigest()
+
+
+def get_page_count(pdf_path):
+    """Returns the number of pages in a PDF."""
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+
+def get_document_metadata(pdf_path):
+    """
+    Returns the PDF's document info as PyMuPDFLoader adds it to every page: the str / int values
+    of fitz's metadata (format, title, author, subject, keywords, creator, producer, creationDate, modDate, trapped).
+    """
+    with fitz.open(pdf_path) as doc:
+        return {key: value for key, value in (doc.metadata or {}).items() if isinstance(value, (str, int))}
+
+
+def extract_page_range(pdf_path, start, end):
+    """
+    Extracts plain text for pages [start, end) (0-based).
+    Returns a list of (page_index, text) tuples.
+    """
+    pages = []
+    with fitz.open(pdf_path) as doc:
+        end = min(end, doc.page_count)
+        for page_index in range(start, end):
+            pages.append((page_index, doc.load_page(page_index).get_text("text") or ""))
+    return pages
+
+
+def split_page_ranges(page_count, parts):
+    """Splits page_count pages into at most `parts` contiguous (start, end) ranges."""
+    parts = max(1, min(parts, page_count))
+    size, extra = divmod(page_count, parts)
+    ranges = []; start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        if end > start: ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def write_page_store(path, page_texts):
+    """Writes page texts (in page order) to a page text store file, atomically."""
+    encoded = [(text or "").encode('utf-8') for text in page_texts]
+    offsets = [0]
+    for data in encoded: offsets.append(offsets[-1] + len(data))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(PAGE_STORE_MAGIC); f.write(struct.pack('<I', len(encoded)))
+        f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+        for data in encoded: f.write(data)
+    os.replace(tmp_path, path)
+
+
+class PageStore:
+    """Memory-mapped reader for a page text store; page lookups are two offset reads and a slice."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(PAGE_STORE_MAGIC)] != PAGE_STORE_MAGIC:
+            self._mm.close(); raise ValueError(f"Not a page text store: {path}")
+        self.page_count = struct.unpack_from('<I', self._mm, len(PAGE_STORE_MAGIC))[0]
+        self._data_start = _HEADER_SIZE + 8 * (self.page_count + 1)
+
+    def get(self, page_index):
+        """Returns the text of a page (0-based)."""
+        if not 0 <= page_index < self.page_count: raise IndexError(page_index)
+        start, end = struct.unpack_from('<QQ', self._mm, _HEADER_SIZE + 8 * page_index)
+        return self._mm[self._data_start + start:self._data_start + end].decode('utf-8')
+
+    def close(self):
+        self._mm.close()
+
+
+def render_page_jpeg(doc, page_index, dpi, quality):
+    """Renders one page (0-based) of an open document to JPEG bytes at a fixed DPI."""
+    pixmap = doc.load_page(page_index).get_pixmap(dpi=dpi, alpha=False)
+    return pixmap.tobytes(output='jpeg', jpg_quality=quality)
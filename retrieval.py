@@ -0,0 +1,117 @@
+"""BM25 index, reciprocal rank fusion and MMR de-duplication for hybrid search within one paper."""
+import math
+import re
+from collections import Counter
+
+# ASCII words / identifiers (keeps "bert-base", "v2.1", "f1_score" together) and single CJK characters
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*|[\u3400-\u9fff\uf900-\ufaff]")
+_CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+# Identifier-like terms users ask about verbatim: acronyms, CamelCase, anything with digits
+_EXACT_TERM_RE = re.compile(r"\b(?:[A-Z]{2,}[A-Za-z0-9\-]*|[A-Za-z]+[0-9][A-Za-z0-9.\-]*|[A-Z][a-z]+[A-Z][A-Za-z0-9]*)\b")
+
+
+def tokenize(text):
+    """Lowercased ASCII terms plus CJK character bigrams (unigrams for isolated characters)."""
+    tokens = []; cjk_run = []
+    for match in _TOKEN_RE.finditer((text or "").lower()):
+        token = match.group()
+        if _CJK_RE.fullmatch(token):
+            cjk_run.append(token); continue
+        tokens.extend(_cjk_terms(cjk_run)); cjk_run = []
+        tokens.append(token)
+    tokens.extend(_cjk_terms(cjk_run))
+    return tokens
+
+
+def _cjk_terms(chars):
+    if len(chars) == 1: return chars
+    return [chars[i] + chars[i + 1] for i in range(len(chars) - 1)]
+
+
+class LexicalIndex:
+    """In-memory BM25 index over one paper's chunks."""
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        """chunks: list of (chunk_id, text, metadata) tuples."""
+        self.k1 = k1; self.b = b
+        self.ids = []; self.texts = {}; self.metadata = {}; self.term_sets = {}
+        self._postings = {}  # term -> list of (chunk position, term frequency)
+        lengths = []
+        for position, (chunk_id, text, metadata) in enumerate(chunks):
+            counts = Counter(tokenize(text))
+            self.ids.append(chunk_id); self.texts[chunk_id] = text; self.metadata[chunk_id] = metadata or {}
+            self.term_sets[chunk_id] = frozenset(counts)
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items(): self._postings.setdefault(term, []).append((position, tf))
+        self._lengths = lengths
+        self._avg_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def document_frequency(self, term):
+        return len(self._postings.get(term, ()))
+
+    def idf(self, term):
+        n = len(self.ids); df = self.document_frequency(term)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query, k=10):
+        """Returns [(chunk_id, score)] for the top-k BM25 matches (score > 0), best first."""
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings: continue
+            idf = self.idf(term)
+            for position, tf in postings:
+                norm = tf + self.k1 * (1 - self.b + self.b * self._lengths[position] / (self._avg_length or 1))
+                scores[position] = scores.get(position, 0.0) + idf * tf * (self.k1 + 1) / norm
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.ids[position], score) for position, score in ranked]
+
+    def exact_terms(self, query, max_df_ratio=0.2):
+        """
+        Identifier-like query terms (acronyms, CamelCase, names with digits) that occur in this paper
+        in at most max_df_ratio of its chunks - i.e. terms a lexical match answers precisely.
+        """
+        terms = []
+        for match in _EXACT_TERM_RE.finditer(query or ""):
+            for term in tokenize(match.group()):
+                df = self.document_frequency(term)
+                if df and df <= max(1, max_df_ratio * len(self.ids)): terms.append(term)
+        return terms
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuses several best-first lists of ids into one [(id, score)] list using RRF."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def jaccard(a, b):
+    if not a or not b: return 0.0
+    return len(a & b) / len(a | b)
+
+
+def mmr_select(candidates, term_sets, k, lambda_mult=0.7, duplicate_threshold=0.8):
+    """
+    Maximal-marginal-relevance selection over fused candidates [(id, score)], using token-set
+    Jaccard similarity as the redundancy measure. Candidates that near-duplicate an already
+    selected chunk (similarity >= duplicate_threshold, e.g. overlapping split windows) are dropped.
+    """
+    if not candidates: return []
+    top = candidates[0][1] or 1.0
+    remaining = [(item_id, score / top) for item_id, score in candidates]
+    selected = []
+    while remaining and len(selected) < k:
+        best_index = None; best_value = None
+        for index, (item_id, relevance) in enumerate(remaining):
+            redundancy = max((jaccard(term_sets.get(item_id), term_sets.get(chosen)) for chosen in selected), default=0.0)
+            if redundancy >= duplicate_threshold: continue
+            value = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+            if best_value is None or value > best_value: best_index, best_value = index, value
+        if best_index is None: break
+        selected.append(remaining.pop(best_index)[0])
+    return selected
@@ -18,8 +18,10 @@ document.addEventListener('DOMContentLoaded', () => {
         const globalAddChatMessage = window.addChatMessage;
 
         if (analyzePageBtn.disabled) { console.log("Analyze button is disabled."); return; }
+        // Prefer server-side rendering when the displayed PDF is a stored paper; otherwise capture the canvas
+        const paperId = typeof currentPaperId !== 'undefined' ? currentPaperId : null;
         const pdfCanvas = document.getElementById('pdf-canvas'); // Get canvas dynamically
-        if (!pdfCanvas || pdfCanvas.width === 0 || pdfCanvas.height === 0) {
+        if (!paperId && (!pdfCanvas || pdfCanvas.width === 0 || pdfCanvas.height === 0)) {
             console.error("PDF Canvas not found or is empty for analysis.");
             if (globalAddChatMessage) { globalAddChatMessage('system', "錯誤：無法獲取 PDF 頁面圖像以進行分析。", 'error'); }
             else { alert("錯誤：無法獲取 PDF 頁面圖像以進行分析。"); }
@@ -42,15 +44,22 @@ document.addEventListener('DOMContentLoaded', () => {
         analyzePageBtn.innerHTML = `<svg class="animate-spin h-4 w-4 inline mr-1" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24"><circle class="opacity-25" cx="12" cy="12" r="10" stroke="currentColor" stroke-width="4"></circle><path class="opacity-75" fill="currentColor" d="M4 12a8 8 0 018-8V0C5.373 0 0 5.373 0 12h4zm2 5.291A7.962 7.962 0 014 12H0c0 3.042 1.135 5.824 3 7.938l3-2.647z"></path></svg>分析中...`;
 
         try {
-            // 1. Capture Canvas as Image
-            const imageDataUrl = pdfCanvas.toDataURL('image/png');
-            console.log(`Captured image data URL (length: ${imageDataUrl.length})`);
-            if (!imageDataUrl || imageDataUrl === 'data:,') throw new Error("無法從畫布獲取圖像數據。");
+            // 1. Build request: page reference (server renders at a fixed DPI) or captured canvas image
+            let payload;
+            if (paperId) {
+                payload = { paper_id: paperId, page_num: currentPageNum };
+                console.log(`Requesting server-side analysis for paper ${paperId}, page ${currentPageNum}`);
+            } else {
+                const imageDataUrl = pdfCanvas.toDataURL('image/jpeg', 0.8);
+                console.log(`Captured image data URL (length: ${imageDataUrl.length})`);
+                if (!imageDataUrl || imageDataUrl === 'data:,') throw new Error("無法從畫布獲取圖像數據。");
+                payload = { image_data: imageDataUrl, page_num: currentPageNum };
+            }
 
             // 2. Send data to backend
             const response = await fetch('/analyze_page', {
                 method: 'POST', headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ image_data: imageDataUrl, page_num: currentPageNum })
+                body: JSON.stringify(payload)
             });
 
             // 3. Handle response
@@ -1,6 +1,7 @@
 // --- Global Variables ---
 let currentPdfDoc = null;
 let currentPageNum = 1;
+let currentPaperId = null; // paper_id of the PDF shown in the viewer (server-side page rendering)
 let pageRendering = false;
 let currentPdfScale = 1.5;
 let selectedText = ''; // Stores text for manual translate button
@@ -115,9 +116,22 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- Utility Functions ---
     function showLoader(show, message = '') { if (!pdfLoader) return; pdfLoader.classList.toggle('hidden', !show); if (show && message) { setUploadStatus(message, "loading"); } }
     function setUploadStatus(message, type = "info") { if (!uploadStatus) return; uploadStatus.textContent = message; uploadStatus.className = 'mt-2 text-xs min-h-[1.2em]'; switch (type) { case "success": uploadStatus.classList.add('text-green-600', 'dark:text-green-400'); break; case "error": uploadStatus.classList.add('text-red-600', 'dark:text-red-400'); break; case "loading": uploadStatus.classList.add('text-yellow-600', 'dark:text-yellow-400'); break; default: uploadStatus.classList.add('text-gray-600', 'dark:text-gray-400'); } }
-    function clearPdfDisplay() { if (pdfCanvas && pdfCtx) { pdfCtx.clearRect(0, 0, pdfCanvas.width, pdfCanvas.height); pdfCanvas.width = 0; pdfCanvas.height = 0; pdfCanvas.style.width = '0px'; pdfCanvas.style.height = '0px'; } if (textLayerDiv) { while (textLayerDiv.firstChild) { textLayerDiv.removeChild(textLayerDiv.firstChild); } textLayerDiv.style.width = '0px'; textLayerDiv.style.height = '0px'; } if(pageCountSpan) pageCountSpan.textContent = 0; if(pageNumInput) { pageNumInput.value = 0; pageNumInput.max = 1; } currentPdfDoc = null; currentPageNum = 1; updatePaginationControls(); if(analyzePageBtn) analyzePageBtn.disabled = true; console.log("PDF display cleared."); }
+    function clearPdfDisplay() { if (pdfCanvas && pdfCtx) { pdfCtx.clearRect(0, 0, pdfCanvas.width, pdfCanvas.height); pdfCanvas.width = 0; pdfCanvas.height = 0; pdfCanvas.style.width = '0px'; pdfCanvas.style.height = '0px'; } if (textLayerDiv) { while (textLayerDiv.firstChild) { textLayerDiv.removeChild(textLayerDiv.firstChild); } textLayerDiv.style.width = '0px'; textLayerDiv.style.height = '0px'; } if(pageCountSpan) pageCountSpan.textContent = 0; if(pageNumInput) { pageNumInput.value = 0; pageNumInput.max = 1; } currentPdfDoc = null; currentPaperId = null; currentPageNum = 1; updatePaginationControls(); if(analyzePageBtn) analyzePageBtn.disabled = true; console.log("PDF display cleared."); }
     function updatePaginationControls() { const enabled = !!currentPdfDoc; const numPages = currentPdfDoc?.numPages ?? 0; if(prevPageBtn) prevPageBtn.disabled = !enabled || currentPageNum <= 1; if(nextPageBtn) nextPageBtn.disabled = !enabled || currentPageNum >= numPages; if(pageNumInput) pageNumInput.disabled = !enabled; if(enabled && pageNumInput) { pageNumInput.value = currentPageNum; pageNumInput.max = numPages;} else if (pageNumInput) { pageNumInput.value = 0; pageNumInput.max = 1; } }
     function goToPage(num) { if (!currentPdfDoc || isNaN(num) || num < 1 || num > currentPdfDoc.numPages) { if(pageNumInput) pageNumInput.value = currentPageNum; console.warn(`Invalid page: ${num}`); return; } if (num === currentPageNum || pageRendering) { if(pageNumInput) pageNumInput.value = currentPageNum; return; } currentPageNum = num; /* UPDATE GLOBAL */ renderPage(currentPageNum); updatePaginationControls(); }
+    /** Polls a background ingestion job until it finishes, showing per-stage progress. */
+    async function waitForIngestJob(statusUrl, intervalMs = 1000) {
+        const stageLabels = { extract: '擷取頁面', split: '切分段落', embed: '建立向量', persist: '儲存索引' };
+        while (true) {
+            const response = await fetch(statusUrl); const job = await response.json();
+            if (!response.ok) throw new Error(job.error || `HTTP error! status: ${response.status}`);
+            if (job.status === 'done' || job.status === 'failed') return job;
+            const stage = job.stage ? job.stages[job.stage] : null;
+            const detail = stage && stage.total ? ` (${stage.done}/${stage.total})` : '';
+            setUploadStatus(job.status === 'queued' ? "排隊等待處理中..." : `背景處理中: ${stageLabels[job.stage] || '準備中'}${detail}`, "loading");
+            await new Promise(resolve => setTimeout(resolve, intervalMs));
+        }
+    }
     async function loadPaperList() { if (!paperSelect) { console.error("Paper select dropdown not found."); return; } console.log("Loading paper list..."); try { const response = await fetch('/papers'); if (!response.ok) { console.error('Failed list fetch:', response.status); return; } const papers = await response.json(); console.log("Papers received for dropdown:", papers); /* Log fetched data */ const currentSelectedValue = paperSelect.value; paperSelect.options.length = 1; if (papers && Array.isArray(papers) && papers.length > 0) { papers.forEach(paper => { const option = document.createElement('option'); option.value = paper.paper_id; const displayName = paper.display_name || `Paper ${paper.paper_id.substring(0, 8)}`; option.textContent = displayName.length > 50 ? displayName.substring(0, 47) + '...' : displayName; option.title = displayName; paperSelect.appendChild(option); }); console.log("Paper list populated."); const exists = papers.some(p => p.paper_id === currentSelectedValue); if (exists) { paperSelect.value = currentSelectedValue; } else { paperSelect.value = ""; } } else { console.log("No papers found."); paperSelect.value = ""; } } catch (error) { console.error('Error loading paper list:', error); } }
 
     /** Adds a message to the chat display area, rendering Markdown. */
@@ -141,10 +155,28 @@ document.addEventListener('DOMContentLoaded', () => {
         if (requiresMarkdown && typeof marked !== 'undefined' && typeof DOMPurify !== 'undefined') { try { messageElement.innerHTML = DOMPurify.sanitize(marked.parse(message)); } catch (e) { console.error("Markdown/Sanitize error:", e); messageElement.textContent = message; } }
         else { if (requiresMarkdown) console.warn("Markdown/Sanitizer missing for sender:", sender); messageElement.textContent = message; }
         chatMessages.appendChild(messageElement); chatMessages.scrollTop = chatMessages.scrollHeight;
+        return messageElement;
     }
     // Expose addChatMessage globally AFTER it's defined
     window.addChatMessage = addChatMessage;
 
+    /** Reads a Server-Sent Events response body, calling onEvent(eventName, parsedData) per event. */
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader(); const decoder = new TextDecoder(); let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary); buffer = buffer.slice(boundary + 2);
+                let eventName = 'message'; const dataLines = [];
+                rawEvent.split('\n').forEach(line => { if (line.startsWith('event:')) eventName = line.slice(6).trim(); else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart()); });
+                if (dataLines.length) onEvent(eventName, JSON.parse(dataLines.join('\n')));
+            }
+        }
+    }
+
     /** Sends chat message, handles response & potential TTS call */
     async function sendChatMessage() {
         if (!chatInput || !sendChatBtn) return; const message = chatInput.value.trim(); if (!message) return;
@@ -156,12 +188,19 @@ document.addEventListener('DOMContentLoaded', () => {
         sendChatBtn.innerHTML = `<svg class="animate-spin h-5 w-5 text-white inline-block" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24"><circle class="opacity-25" cx="12" cy="12" r="10" stroke="currentColor" stroke-width="4"></circle><path class="opacity-75" fill="currentColor" d="M4 12a8 8 0 018-8V0C5.373 0 0 5.373 0 12h4zm2 5.291A7.962 7.962 0 014 12H0c0 3.042 1.135 5.824 3 7.938l3-2.647z"></path></svg>`;
         try {
             // *** Log the exact payload being sent ***
-            console.log("Sending to /chat with payload:", JSON.stringify(payload, null, 2)); // Pretty print JSON
-            const response = await fetch('/chat', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
+            console.log("Sending to /chat/stream with payload:", JSON.stringify(payload, null, 2)); // Pretty print JSON
+            const response = await fetch('/chat/stream', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
             if (!response.ok) { let e = `HTTP ${response.status}`; try { const d = await response.json(); e = d.error||e; } catch(ig){} throw new Error(e); }
-            const result = await response.json(); const botReply = result.reply || "收到空回覆";
-            // Display text first
-            addChatMessage('bot', botReply);
+            // Render the answer incrementally as tokens arrive
+            let botReply = ''; let botBubble = null; let renderPending = false;
+            const renderReply = () => { renderPending = false; if (!botBubble) return; if (typeof marked !== 'undefined' && typeof DOMPurify !== 'undefined') { try { botBubble.innerHTML = DOMPurify.sanitize(marked.parse(botReply)); } catch (e) { botBubble.textContent = botReply; } } else { botBubble.textContent = botReply; } chatMessages.scrollTop = chatMessages.scrollHeight; };
+            await readEventStream(response, (event, data) => {
+                if (event === 'retrieval') { console.log(`Retrieved ${data.sources ? data.sources.length : 0} chunks:`, data.sources); }
+                else if (event === 'token') { botReply += data.text || ''; if (!botBubble) botBubble = addChatMessage('bot', ''); if (!renderPending) { renderPending = true; requestAnimationFrame(renderReply); } }
+                else if (event === 'done') { console.log("Chat timings:", data.timings); }
+                else if (event === 'error') { throw new Error(data.error || '串流回覆失敗'); }
+            });
+            if (!botReply) { botReply = "收到空回覆"; addChatMessage('bot', botReply); } else { renderReply(); }
             // Then play voice if enabled
             const isVoiceEnabled = voiceToggle ? voiceToggle.checked : false;
             if (isVoiceEnabled && typeof window.playVoiceResponse === 'function') { console.log("Voice mode on, calling playVoiceResponse..."); window.playVoiceResponse(botReply); }
@@ -182,7 +221,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if(prevPageBtn) prevPageBtn.addEventListener('click', () => { if (currentPageNum > 1) goToPage(currentPageNum - 1); });
     if(nextPageBtn) nextPageBtn.addEventListener('click', () => { if (currentPdfDoc && currentPageNum < currentPdfDoc.numPages) goToPage(currentPageNum + 1); });
     if(pageNumInput) { pageNumInput.addEventListener('change', () => { goToPage(parseInt(pageNumInput.value, 10)); }); pageNumInput.addEventListener('keypress', (e) => { if (e.key === 'Enter') pageNumInput.blur(); }); }
-    if(uploadInput) uploadInput.addEventListener('change', async (event) => { const file = event.target.files[0]; if (!file || file.type !== 'application/pdf') { setUploadStatus('請選擇一個有效的 PDF 文件。', "error"); uploadInput.value = ''; return; } clearPdfDisplay(); updatePaginationControls(); if(analyzePageBtn) analyzePageBtn.disabled = true; if(selectedTextDisplay) selectedTextDisplay.textContent = '請在 PDF 中選取文字...'; if(translateBtn) translateBtn.disabled = true; hideTranslationTooltip(); setUploadStatus('', 'info'); showLoader(true, "正在上傳並處理..."); const formData = new FormData(); formData.append('pdf_file', file); try { const response = await fetch('/upload', { method: 'POST', body: formData }); const result = await response.json(); if (!response.ok) throw new Error(result.error || `HTTP error! status: ${response.status}`); console.log("Uploaded File Info:", result); await loadPdf(result.filepath); console.log("Upload successful, refreshing paper list..."); await loadPaperList(); /* Refresh dropdown */ if (result.paper_id && paperSelect) { paperSelect.value = result.paper_id; console.log(`Selected paper automatically: ${result.paper_id}`); const selectedOption = paperSelect.options[paperSelect.selectedIndex]; const selectedName = selectedOption.title || selectedOption.textContent || "新文件"; addChatMessage('system', `已自動選擇: ${selectedName}`); } } catch (error) { console.error('Upload or Processing error:', error); setUploadStatus(`上傳或處理失敗: ${error.message || error}`, "error"); showLoader(false); } finally { uploadInput.value = ''; } });
+    if(uploadInput) uploadInput.addEventListener('change', async (event) => { const file = event.target.files[0]; if (!file || file.type !== 'application/pdf') { setUploadStatus('請選擇一個有效的 PDF 文件。', "error"); uploadInput.value = ''; return; } clearPdfDisplay(); updatePaginationControls(); if(analyzePageBtn) analyzePageBtn.disabled = true; if(selectedTextDisplay) selectedTextDisplay.textContent = '請在 PDF 中選取文字...'; if(translateBtn) translateBtn.disabled = true; hideTranslationTooltip(); setUploadStatus('', 'info'); showLoader(true, "正在上傳並處理..."); const formData = new FormData(); formData.append('pdf_file', file); try { const response = await fetch('/upload', { method: 'POST', body: formData }); const result = await response.json(); if (!response.ok) throw new Error(result.error || `HTTP error! status: ${response.status}`); console.log("Uploaded File Info:", result); await loadPdf(result.filepath); currentPaperId = result.paper_id || null; if (result.status_url) { const job = await waitForIngestJob(result.status_url); if (job.status !== 'done') throw new Error(job.error || "RAG 處理失敗。"); setUploadStatus("檔案上傳並處理完成！", "success"); } console.log("Upload successful, refreshing paper list..."); await loadPaperList(); /* Refresh dropdown */ if (result.paper_id && paperSelect) { paperSelect.value = result.paper_id; console.log(`Selected paper automatically: ${result.paper_id}`); const selectedOption = paperSelect.options[paperSelect.selectedIndex]; const selectedName = selectedOption.title || selectedOption.textContent || "新文件"; addChatMessage('system', `已自動選擇: ${selectedName}`); } } catch (error) { console.error('Upload or Processing error:', error); setUploadStatus(`上傳或處理失敗: ${error.message || error}`, "error"); showLoader(false); } finally { uploadInput.value = ''; } });
     if(paperSelect) paperSelect.addEventListener('change', () => { const selectedOption = paperSelect.options[paperSelect.selectedIndex]; const selectedName = selectedOption.title || selectedOption.textContent || "通用模型"; const selectedId = paperSelect.value; addChatMessage('system', `對話目標已切換至: ${selectedName}`); console.log(`Selected paper ID: ${selectedId || 'None (General Chat)'}`); hideTranslationTooltip(); });
     if(sendChatBtn) sendChatBtn.addEventListener('click', sendChatMessage);
     if(chatInput) chatInput.addEventListener('keypress', (event) => { if (event.key === 'Enter' && !event.shiftKey) { event.preventDefault(); sendChatMessage(); } });
@@ -114,13 +114,36 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!text || !text.trim()) { console.warn("playVoiceResponse called with empty text."); return; }
         console.log("Requesting TTS for playback:", text.substring(0, 50) + "..."); stopAudioPlayback();
         if(micStatus) micStatus.textContent = "正在合成語音...";
-        try { const response = await fetch('/synthesize', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ text: text }) }); if (!response.ok) { let e = `HTTP ${response.status}`; try { const d = await response.json(); e = d.error||e; } catch(ig){} throw new Error(e); } const audioBlob = await response.blob(); if (audioBlob.size === 0) { throw new Error("Empty audio data."); } const audioUrl = URL.createObjectURL(audioBlob); currentAudioPlayer = new Audio(audioUrl); console.log("Playing TTS audio..."); if(micStatus) micStatus.textContent = "正在播放...";
+        try { const response = await fetch('/synthesize', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ text: text }) }); if (!response.ok) { let e = `HTTP ${response.status}`; try { const d = await response.json(); e = d.error||e; } catch(ig){} throw new Error(e); }
+            // Stream segments into a MediaSource so playback starts with the first sentence; fall back to a full blob
+            const canStream = window.MediaSource && MediaSource.isTypeSupported('audio/mpeg') && response.body;
+            let audioUrl;
+            if (canStream) { const mediaSource = new MediaSource(); audioUrl = URL.createObjectURL(mediaSource); currentAudioPlayer = new Audio(audioUrl); feedAudioStream(mediaSource, response.body.getReader(), currentAudioPlayer); }
+            else { const audioBlob = await response.blob(); if (audioBlob.size === 0) { throw new Error("Empty audio data."); } audioUrl = URL.createObjectURL(audioBlob); currentAudioPlayer = new Audio(audioUrl); }
+            console.log(`Playing TTS audio${canStream ? ' (streaming)' : ''}...`); if(micStatus) micStatus.textContent = "正在播放...";
             currentAudioPlayer.onended = () => { console.log("TTS playback finished."); URL.revokeObjectURL(audioUrl); currentAudioPlayer = null; if(micStatus && isVoiceModeEnabled) micStatus.textContent = "播放完畢。點擊按鈕再次錄音。"; };
-            currentAudioPlayer.onerror = (e) => { console.error("Audio playback error:", e); URL.revokeObjectURL(audioUrl); currentAudioPlayer = null; if(micStatus) micStatus.textContent = "播放語音時發生錯誤。"; if (typeof window.addChatMessage === 'function') { window.addChatMessage('system', '播放語音時發生錯誤。', 'error'); } };
-            currentAudioPlayer.play();
+            currentAudioPlayer.onerror = (e) => { if (!currentAudioPlayer) return; console.error("Audio playback error:", e); URL.revokeObjectURL(audioUrl); currentAudioPlayer = null; if(micStatus) micStatus.textContent = "播放語音時發生錯誤。"; if (typeof window.addChatMessage === 'function') { window.addChatMessage('system', '播放語音時發生錯誤。', 'error'); } };
+            currentAudioPlayer.play().catch(e => console.warn("Audio play() rejected:", e));
         } catch (error) { console.error("TTS request failed:", error); if(micStatus) micStatus.textContent = `語音合成失敗: ${error.message || '錯誤'}`; if (typeof window.addChatMessage === 'function') { window.addChatMessage('system', `語音合成失敗: ${error.message || '錯誤'}`, 'error'); } }
     };
 
+    /** Appends streamed MP3 bytes to a MediaSource until the response ends or playback is stopped. */
+    function feedAudioStream(mediaSource, reader, player) {
+        mediaSource.addEventListener('sourceopen', async () => {
+            const sourceBuffer = mediaSource.addSourceBuffer('audio/mpeg');
+            const waitUpdate = () => new Promise(resolve => sourceBuffer.addEventListener('updateend', resolve, { once: true }));
+            try {
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done || currentAudioPlayer !== player) break;
+                    sourceBuffer.appendBuffer(value); await waitUpdate();
+                }
+                if (currentAudioPlayer === player && mediaSource.readyState === 'open') mediaSource.endOfStream();
+                else reader.cancel().catch(() => {});
+            } catch (e) { console.error("Audio stream error:", e); reader.cancel().catch(() => {}); if (mediaSource.readyState === 'open') { try { mediaSource.endOfStream('decode'); } catch (ig) {} } }
+        }, { once: true });
+    }
+
 
     // --- Event Listeners ---
     if (voiceToggle) {
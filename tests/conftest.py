@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    """Imports app.py with its data folders in a temporary directory (no API calls are made at import)."""
+    os.chdir(tempfile.mkdtemp(prefix='paper_assistant_test_'))
+    os.environ['OPENAI_API_KEY'] = 'sk-test'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, REPO_ROOT)
+    import app
+    return app
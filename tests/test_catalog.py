@@ -0,0 +1,25 @@
+import uuid
+
+
+def test_rebuild_keeps_in_flight_rows_and_read_times(app_module, monkeypatch, tmp_path):
+    app = app_module
+    catalog = app.PaperCatalog(str(tmp_path / 'catalog.db'))
+    uploads = tmp_path / 'uploads'; uploads.mkdir()
+    ready_id, processing_id, stale_id = (str(uuid.uuid4()) for _ in range(3))
+    for paper_id in (ready_id, processing_id): (uploads / f"{paper_id}_paper.pdf").write_bytes(b"%PDF-1.4 not a real pdf")
+    catalog.add(ready_id, f"{ready_id}_paper.pdf", "paper.pdf", status='ready', chunk_count=3, ingested_at=100.0)
+    catalog.touch(ready_id); last_read_at = catalog.get(ready_id)['last_read_at']
+    catalog.add(processing_id, f"{processing_id}_paper.pdf", "paper.pdf", status='processing')
+    catalog.add(stale_id, f"{stale_id}_gone.pdf", "gone.pdf", status='ready', chunk_count=2)
+    monkeypatch.setattr(app, 'paper_catalog', catalog)
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setattr(app, 'ensure_ai_components', lambda: True)
+    monkeypatch.setattr(app, 'chroma_client', object())
+    monkeypatch.setattr(app, 'count_paper_chunks', lambda: {ready_id: 5, processing_id: 1}) # Ingestion of processing_id is under way
+
+    assert app.rebuild_paper_catalog() == 1
+
+    ready = catalog.get(ready_id)
+    assert (ready['status'], ready['chunk_count'], ready['last_read_at'], ready['ingested_at']) == ('ready', 5, last_read_at, 100.0)
+    assert catalog.get(processing_id)['status'] == 'processing'
+    assert catalog.get(stale_id) is None
@@ -0,0 +1,41 @@
+import uuid
+
+import pytest
+
+BUDGET = 200
+
+
+@pytest.fixture
+def paper_chat(app_module, monkeypatch):
+    app = app_module
+    paper_id = str(uuid.uuid4())
+    monkeypatch.setattr(app, 'find_pdf_path', lambda pid: f"/papers/{pid}.pdf" if pid == paper_id else None)
+    monkeypatch.setattr(app, 'get_page_text', lambda *args, **kwargs: "The method section describes the encoder in detail. " * 200)
+    monkeypatch.setitem(app.app.config, 'CONTEXT_TOKEN_BUDGET', BUDGET)
+    return app, paper_id
+
+
+@pytest.mark.parametrize('packing', [True, False])
+@pytest.mark.parametrize('retrieval', ['empty', 'error'])
+def test_page_text_fits_budget_without_retrieved_chunks(paper_chat, monkeypatch, packing, retrieval):
+    app, paper_id = paper_chat
+    def retrieve_chunks(paper_id, query):
+        if retrieval == 'error': raise RuntimeError("index unavailable")
+        return [], 'lexical'
+    monkeypatch.setattr(app, 'retrieve_chunks', retrieve_chunks)
+    monkeypatch.setitem(app.app.config, 'CONTEXT_PACKING', packing)
+
+    message = "What does the encoder do?"
+    chat = app.prepare_chat({"message": message, "paper_id": paper_id, "currentPageNum": 3})
+
+    overhead = max(app.token_counter.count(app.build_chat_prompt('page', paper_id, 3, "", rag, message)) for rag in ("(檢索文件片段時出錯)", app.format_rag_context([])))
+    assert chat["prompt_tokens"]["before"] > 1000
+    assert chat["prompt_tokens"]["after"] <= BUDGET + overhead
+    assert chat["prompt_tokens"]["context_budget"] == BUDGET
+
+
+def test_canned_reply_reports_prompt_tokens(paper_chat):
+    app, _ = paper_chat
+    response = app.app.test_client().post('/chat', json={"message": "hi", "paper_id": str(uuid.uuid4())})
+    assert response.status_code == 200
+    assert response.get_json()["prompt_tokens"]["after"] == 0
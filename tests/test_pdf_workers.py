@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+from conftest import REPO_ROOT
+
+# Runs app.py the way `python app.py` does; Flask.run is replaced by a probe of what a parse worker has imported.
+DRIVER = textwrap.dedent("""
+    import runpy, sys, flask
+    def run(self, *args, **kwargs):
+        pool = sys._getframe(1).f_globals['get_pdf_process_pool']() # Called from app.py's __main__ block
+        probe = ("sorted(name for name, module in __import__('sys').modules.items()"
+                 f" if name in ('flask', 'chromadb', 'langchain_openai') or getattr(module, '__file__', None) == {APP_PY!r})")
+        print("WORKER_MODULES", pool.submit(eval, probe).result(timeout=60), flush=True)
+        pool.shutdown()
+    flask.Flask.run = run
+    sys.path.insert(0, sys.argv[1])
+    APP_PY = sys.argv[1] + '/app.py'
+    runpy.run_path(APP_PY, run_name='__main__')
+""")
+
+
+def test_parse_worker_does_not_import_app(tmp_path):
+    env = dict(os.environ, OPENAI_API_KEY='sk-test', LOG_LEVEL='WARNING', PDF_PARSE_PROCESSES='2')
+    result = subprocess.run([sys.executable, '-c', DRIVER, REPO_ROOT], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=240)
+    lines = [line for line in result.stdout.splitlines() if line.startswith("WORKER_MODULES")]
+    assert lines == ["WORKER_MODULES []"], result.stdout + result.stderr[-2000:]
@@ -0,0 +1,91 @@
+import threading
+import uuid
+
+import pytest
+
+
+class BusyStore:
+    """Stands in for both the vector store and the embeddings: every query embedding finds the upstream saturated."""
+    def __init__(self, app):
+        self.app = app
+
+    def _busy(self, *args, **kwargs):
+        raise self.app.UpstreamBusy('embeddings', 2)
+
+    similarity_search = similarity_search_by_vector = embed_query = _busy
+
+
+@pytest.mark.parametrize('mode', ['vector', 'hybrid'])
+def test_saturated_embeddings_fall_back_to_lexical(app_module, monkeypatch, mode):
+    app = app_module
+    paper_id = str(uuid.uuid4())
+    app.save_paper_chunks(paper_id, [(f"{paper_id}:0", "The encoder uses multi-head attention over image patches.", {"page": 0}),
+                                     (f"{paper_id}:1", "Training ran for ninety epochs with cosine learning rate decay.", {"page": 1})])
+    monkeypatch.setattr(app, 'get_paper_vectorstore', lambda _: BusyStore(app))
+    monkeypatch.setattr(app, 'embeddings', BusyStore(app), raising=False)
+    monkeypatch.setitem(app.app.config, 'RETRIEVAL_MODE', mode)
+
+    docs, retrieval_mode = app.retrieve_chunks(paper_id, "how long was training and what schedule was used")
+
+    assert retrieval_mode == 'lexical'
+    assert docs and docs[0].id == f"{paper_id}:1"
+
+
+class ChromaChunks:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def get(self, where, include):
+        return {"ids": [c[0] for c in self.chunks], "documents": [c[1] for c in self.chunks], "metadatas": [c[2] for c in self.chunks]}
+
+
+def test_lexical_index_rebuilt_from_chroma_only_persisted_when_ready(app_module, monkeypatch):
+    app = app_module
+    paper_id = str(uuid.uuid4())
+    chunks = [(f"{paper_id}:0", "Partial ingestion has stored only this chunk so far.", {"page": 0})]
+    monkeypatch.setattr(app, 'get_paper_vectorstore', lambda _: ChromaChunks(chunks))
+    app.paper_catalog.add(paper_id, f"{paper_id}_paper.pdf", "paper.pdf", status='processing')
+
+    assert len(app.get_lexical_index(paper_id)) == 1
+    assert not app.os.path.exists(app.paper_chunks_path(paper_id))
+    assert paper_id not in app.lexical_indexes
+
+    app.paper_catalog.update(paper_id, status='ready')
+    assert len(app.get_lexical_index(paper_id)) == 1
+    assert app.os.path.exists(app.paper_chunks_path(paper_id))
+    assert paper_id in app.lexical_indexes
+
+
+class SlowEmbeddings:
+    def __init__(self):
+        self.started = threading.Event(); self.release = threading.Event()
+
+    def embed_query(self, query):
+        self.started.set(); self.release.wait(10)
+        return [0.0]
+
+
+class EmptyStore:
+    def similarity_search_by_vector(self, vector, k, filter):
+        return []
+
+
+@pytest.mark.parametrize('mode', ['vector', 'hybrid'])
+def test_query_embedding_runs_outside_chroma_lock(app_module, monkeypatch, mode):
+    app = app_module
+    paper_id = str(uuid.uuid4())
+    app.save_paper_chunks(paper_id, [(f"{paper_id}:0", "Results are reported on the validation split.", {"page": 0})])
+    slow = SlowEmbeddings()
+    monkeypatch.setattr(app, 'embeddings', slow, raising=False)
+    monkeypatch.setattr(app, 'get_paper_vectorstore', lambda _: EmptyStore())
+    monkeypatch.setitem(app.app.config, 'RETRIEVAL_MODE', mode)
+    retrieval_thread = threading.Thread(target=app.retrieve_chunks, args=(paper_id, "what was evaluated"))
+    retrieval_thread.start()
+    assert slow.started.wait(5)
+
+    writer_ran = threading.Event()
+    def clear():
+        with app.chroma_data_lock.write(): writer_ran.set()
+    threading.Thread(target=clear).start()
+    try: assert writer_ran.wait(2), "writer blocked behind an in-flight query embedding"
+    finally: slow.release.set(); retrieval_thread.join()
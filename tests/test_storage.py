@@ -0,0 +1,105 @@
+import os
+import uuid
+
+import chromadb
+import pytest
+
+DIM = 8
+
+
+@pytest.fixture
+def store(app_module, monkeypatch, tmp_path):
+    """Points the app at a fresh Chroma directory, catalog and data folders."""
+    app = app_module
+    client = chromadb.PersistentClient(path=str(tmp_path / 'chroma'))
+    monkeypatch.setattr(app, 'chroma_client', client)
+    monkeypatch.setattr(app, 'shard_stores', {})
+    monkeypatch.setattr(app, 'paper_catalog', app.PaperCatalog(str(tmp_path / 'catalog.db')))
+    monkeypatch.setattr(app, 'ensure_ai_components', lambda: True)
+    monkeypatch.setitem(app.app.config, 'CHROMA_SHARDS', 4)
+    for key in ('UPLOAD_FOLDER', 'PAGE_TEXT_FOLDER', 'CHUNK_FOLDER'):
+        folder = tmp_path / key.lower(); folder.mkdir(); monkeypatch.setitem(app.app.config, key, str(folder))
+    return app, client
+
+
+def vector(seed):
+    return [float((seed * 7 + i) % 11) for i in range(DIM)]
+
+
+def shard_contents(app, client):
+    """{chunk id: (paper_id, vector)} over the current shards."""
+    contents = {}
+    for collection in client.list_collections():
+        if not collection.name.startswith('papers-4-'): continue
+        results = client.get_collection(collection.name).get(include=["metadatas", "embeddings"])
+        for chunk_id, metadata, embedding in zip(results['ids'], results['metadatas'], results['embeddings']):
+            contents[chunk_id] = (metadata['paper_id'], [float(v) for v in embedding])
+    return contents
+
+
+def add_paper(app, client, status='ready', chunks=3, last_read_at=None, storage_bytes=1000):
+    """Catalogs a paper with a PDF, page store, chunk file and chunks in its shard. Returns (paper_id, file paths)."""
+    paper_id = str(uuid.uuid4()); filename = f"{paper_id}_paper.pdf"
+    paths = [os.path.join(app.app.config['UPLOAD_FOLDER'], filename), app.page_store_path(paper_id), app.paper_chunks_path(paper_id)]
+    for path in paths:
+        with open(path, 'wb') as f: f.write(b"data")
+    collection = client.get_or_create_collection(name=app.shard_collection_name(paper_id), embedding_function=None)
+    collection.upsert(ids=[f"{paper_id}:{i}" for i in range(chunks)], documents=[f"chunk {i}" for i in range(chunks)],
+                      metadatas=[{"paper_id": paper_id, "chunk_index": i} for i in range(chunks)], embeddings=[vector(i) for i in range(chunks)])
+    app.paper_catalog.add(paper_id, filename, "paper.pdf", status=status, chunk_count=chunks, last_read_at=last_read_at, storage_bytes=storage_bytes)
+    return paper_id, paths
+
+
+def test_migration_moves_legacy_chunks_into_shards(store, monkeypatch):
+    app, client = store
+    monkeypatch.setitem(app.app.config, 'MIGRATION_BATCH_SIZE', 4) # Several batches
+    legacy = client.get_or_create_collection(name=app.LEGACY_COLLECTION_NAME, embedding_function=None)
+    papers = [str(uuid.uuid4()) for _ in range(3)]
+    expected = {f"{paper_id}:{i}": (paper_id, vector(n * 3 + i)) for n, paper_id in enumerate(papers) for i in range(3)}
+    legacy.add(ids=list(expected), documents=[f"text {chunk_id}" for chunk_id in expected],
+               metadatas=[{"paper_id": paper_id} for paper_id, _ in expected.values()], embeddings=[v for _, v in expected.values()])
+    legacy.add(ids=["orphan"], documents=["no paper id"], metadatas=[{"source": "x.pdf"}], embeddings=[vector(99)])
+
+    delete_collection = client.delete_collection
+    def interrupted(name): raise RuntimeError("killed before the legacy collection was dropped")
+    monkeypatch.setattr(client, 'delete_collection', interrupted)
+    with pytest.raises(RuntimeError): app.migrate_collections()
+    monkeypatch.setattr(client, 'delete_collection', delete_collection)
+
+    assert app.migrate_collections() == len(expected) # Re-run after the interruption: upserts the same ids again
+    assert shard_contents(app, client) == expected
+    assert app.LEGACY_COLLECTION_NAME not in [c.name for c in client.list_collections()]
+    assert app.migrate_collections() == 0
+    assert shard_contents(app, client) == expected
+
+
+def test_delete_paper_route(store):
+    app, client = store
+    paper_id, paths = add_paper(app, client)
+    other_id, other_paths = add_paper(app, client)
+    processing_id, _ = add_paper(app, client, status='processing')
+    http = app.app.test_client()
+
+    assert http.delete(f'/papers/{uuid.uuid4()}').status_code == 404
+    assert http.delete(f'/papers/{processing_id}').status_code == 409
+    assert http.delete('/papers/not-a-uuid').status_code == 400
+    response = http.delete(f'/papers/{paper_id}')
+
+    assert response.status_code == 200
+    remaining = {p for p, _ in shard_contents(app, client).values()}
+    assert paper_id not in remaining and {other_id, processing_id} <= remaining
+    assert not any(os.path.exists(path) for path in paths) and all(os.path.exists(path) for path in other_paths)
+    assert app.paper_catalog.get(paper_id) is None and app.paper_catalog.get(other_id)
+    assert http.delete(f'/papers/{paper_id}').status_code == 404
+
+
+def test_quota_evicts_least_recently_read(store, monkeypatch):
+    app, client = store
+    kept, older, old, recent = (add_paper(app, client, last_read_at=t)[0] for t in (100.0, 200.0, 300.0, 400.0))
+    ingesting, _ = add_paper(app, client, status='processing', last_read_at=50.0)
+    monkeypatch.setitem(app.app.config, 'STORAGE_QUOTA_MB', 2000 / (1024 * 1024)) # Room for two of the four 1000-byte ready papers
+
+    assert app.enforce_storage_quota(keep={kept}) == [older, old]
+    assert {p for p, _ in shard_contents(app, client).values()} == {kept, recent, ingesting}
+    assert app.paper_catalog.get(ingesting)['status'] == 'processing'
+    assert app.enforce_storage_quota(keep={kept}) == []
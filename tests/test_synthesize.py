@@ -0,0 +1,39 @@
+import threading
+import time
+import types
+import uuid
+
+TTS_LATENCY = 0.3
+
+
+class FakeSpeech:
+    def __init__(self):
+        self.calls = []; self._lock = threading.Lock()
+
+    def create(self, model, voice, input, response_format):
+        with self._lock: self.calls.append(input)
+        time.sleep(TTS_LATENCY)
+        return types.SimpleNamespace(content=f"MP3:{input}".encode('utf-8'))
+
+
+def test_first_segment_not_queued_behind_later_segments(app_module, monkeypatch):
+    app = app_module
+    speech = FakeSpeech()
+    monkeypatch.setattr(app, 'openai_client', types.SimpleNamespace(audio=types.SimpleNamespace(speech=speech)))
+    monkeypatch.setitem(app.upstream_limiters, 'tts', app.UpstreamLimiter('tts', 2, 10)) # Fewer slots than segments
+    monkeypatch.setitem(app.app.config, 'TTS_SEGMENT_MAX_CHARS', 60); monkeypatch.setitem(app.app.config, 'TTS_FIRST_SEGMENT_MAX_CHARS', 60)
+    tag = uuid.uuid4().hex[:8] # Fresh text, so nothing comes from the audio cache
+    text = " ".join(f"Sentence {i} of test {tag} is long enough to stand alone." for i in range(6))
+    segments = app.split_tts_text(text, 60, 60)
+    assert len(segments) > 2
+
+    client = app.app.test_client()
+    started = time.perf_counter()
+    response = client.post('/synthesize', json={"text": text}, buffered=False) # Returns once the first segment is synthesized
+    time_to_first_audio = time.perf_counter() - started
+    body = b"".join(response.response)
+
+    assert response.status_code == 200
+    assert time_to_first_audio < TTS_LATENCY * 1.6, f"first audio after {time_to_first_audio:.2f}s"
+    assert body == b"".join(f"MP3:{segment}".encode('utf-8') for segment in segments)
+    assert app.upstream_limiters['tts'].stats()["in_flight"] == 0
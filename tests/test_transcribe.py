@@ -0,0 +1,39 @@
+import io
+import types
+
+import pytest
+
+
+@pytest.mark.parametrize('size', [1001, 200 * 1024]) # Caught by the bounded read / by Content-Length before parsing
+def test_oversized_recording_rejected_without_whisper_call(app_module, monkeypatch, size):
+    app = app_module
+    calls = []
+    transcriptions = types.SimpleNamespace(create=lambda **kwargs: calls.append(kwargs))
+    monkeypatch.setattr(app, 'openai_client', types.SimpleNamespace(audio=types.SimpleNamespace(transcriptions=transcriptions)))
+    monkeypatch.setattr(app, 'ensure_ai_components', lambda: True)
+    monkeypatch.setitem(app.app.config, 'TRANSCRIBE_MAX_BYTES', 1000)
+
+    response = app.app.test_client().post('/transcribe', data={"audio_blob": (io.BytesIO(b"\0" * size), "clip.webm")},
+                                          content_type='multipart/form-data')
+
+    assert response.status_code == 413
+    assert not calls
+
+
+def test_large_recording_parsed_in_memory(app_module, monkeypatch):
+    app = app_module
+    import werkzeug.wrappers.request
+    def spooled(*args, **kwargs): raise AssertionError("recording spooled through werkzeug's default stream factory")
+    monkeypatch.setattr(werkzeug.wrappers.request, 'default_stream_factory', spooled)
+    calls = []
+    transcriptions = types.SimpleNamespace(create=lambda **kwargs: calls.append(kwargs) or types.SimpleNamespace(text="測試"))
+    monkeypatch.setattr(app, 'openai_client', types.SimpleNamespace(audio=types.SimpleNamespace(transcriptions=transcriptions)))
+    monkeypatch.setattr(app, 'ensure_ai_components', lambda: True)
+    monkeypatch.setitem(app.app.config, 'TRANSCRIBE_TRIM_SILENCE', False)
+    recording = b"\1" * (2 * 1024 * 1024) # Well past werkzeug's 500 KB spooling threshold
+
+    response = app.app.test_client().post('/transcribe', data={"audio_blob": (io.BytesIO(recording), "clip.webm")},
+                                          content_type='multipart/form-data')
+
+    assert response.status_code == 200 and response.get_json() == {"text": "測試"}
+    assert calls[0]["file"] == ("clip.webm", recording)
@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+import uuid
+
+LLM_LATENCY = 0.3
+
+
+class FakeLLM:
+    """Stands in for invoke_llm: answers single and JSON-array translation prompts with 'T:<text>'."""
+    def __init__(self):
+        self.texts = []; self._lock = threading.Lock()
+
+    def __call__(self, prompt):
+        time.sleep(LLM_LATENCY)
+        if "JSON 陣列" in prompt:
+            texts = json.loads(prompt.split("原文:\n", 1)[1].rsplit("\n\n翻譯:", 1)[0])
+            with self._lock: self.texts += texts
+            return json.dumps([f"T:{text}" for text in texts], ensure_ascii=False)
+        text = prompt.split("'''\n", 1)[1].rsplit("\n'''", 1)[0]
+        with self._lock: self.texts.append(text)
+        return f"T:{text}"
+
+
+def setup_llm(app, monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr(app, 'invoke_llm', llm); monkeypatch.setattr(app, 'llm', object())
+    monkeypatch.setattr(app, 'ensure_ai_components', lambda: True)
+    return llm
+
+
+def test_batch_counts_each_miss_once(app_module, monkeypatch):
+    app = app_module
+    setup_llm(app, monkeypatch)
+    short_text = f"short {uuid.uuid4().hex}"; long_text = f"long {uuid.uuid4().hex} " + "x" * app.app.config['TRANSLATION_BATCH_MAX_CHARS']
+    misses = app.translation_cache.counters["misses"]
+
+    response = app.app.test_client().post('/translate/batch', json={"texts": [short_text, long_text]})
+
+    assert response.get_json()["translations"] == [f"T:{short_text}", f"T:{long_text}"]
+    assert app.translation_cache.counters["misses"] - misses == 2
+
+
+def test_batch_miss_shares_in_flight_translation(app_module, monkeypatch):
+    app = app_module
+    llm = setup_llm(app, monkeypatch)
+    text = f"selected {uuid.uuid4().hex}"; other = f"other {uuid.uuid4().hex}"
+    client = app.app.test_client(); single = {}
+    thread = threading.Thread(target=lambda: single.update(response=client.post('/translate', json={"text": text})))
+    thread.start(); time.sleep(LLM_LATENCY / 3) # /translate is now waiting on the LLM
+
+    response = app.app.test_client().post('/translate/batch', json={"texts": [text, other]})
+    thread.join()
+
+    assert single["response"].get_json()["translation"] == f"T:{text}"
+    assert response.get_json() == {"translations": [f"T:{text}", f"T:{other}"], "cache": ["inflight", None]}
+    assert sorted(llm.texts) == sorted([text, other]) # text went to the LLM once
+
+
+def test_result_cache_prunes_periodically(app_module, monkeypatch, tmp_path):
+    app = app_module
+    monkeypatch.setattr(app.TextResultCache, 'PRUNE_INTERVAL', 4)
+    cache = app.TextResultCache(str(tmp_path / 'results.sqlite3'), 0, 5, 3600)
+    for i in range(20): cache.put(f"key{i}", "value")
+    assert cache.stats()["entries"] <= 5 + 4
+    assert cache.get("key19")[0] == "value"
+    indexes = {row[1] for row in cache._conn.execute("PRAGMA index_list(results)")}
+    assert "idx_results_created_at" in indexes
@@ -0,0 +1,16 @@
+import os
+
+
+def test_eviction_frees_down_to_low_water_mark(app_module, tmp_path, monkeypatch):
+    app = app_module
+    cache = app.AudioFileCache(str(tmp_path), max_bytes=1000)
+    scans = []; scandir = os.scandir
+    monkeypatch.setattr(app.os, 'scandir', lambda path: scans.append(path) or scandir(path))
+    for i in range(30):
+        cache.put(f"seg{i}", b"x" * 100)
+        os.utime(cache._path(f"seg{i}"), (i, i)) # Distinct mtimes: seg0 is the least recently used
+
+    assert cache.total_bytes <= 1000
+    assert cache.total_bytes == sum(entry.stat().st_size for entry in scandir(tmp_path))
+    assert len(scans) <= 11 # One scan per ~100 bytes freed would be 20
+    assert cache.get("seg29") is not None and cache.get("seg0") is None